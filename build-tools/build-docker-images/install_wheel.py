@@ -10,12 +10,25 @@ Handles entry_points, .data directories, and path traversal protection.
 """
 import configparser
 import glob
+import hashlib
+import json
 import os
 import re
 import shutil
 import sys
 import zipfile
 
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of wheels installed concurrently
+INSTALL_JOBS = int(os.environ.get("INSTALL_WHEEL_JOBS", os.cpu_count() or 1))
+
+# Record of the wheels installed in site-packages, by wheel sha256
+MANIFEST_NAME = ".install_wheel_manifest.json"
+
+# Reinstall wheels even if the manifest says they are installed
+INSTALL_FORCE = os.environ.get("INSTALL_WHEEL_FORCE", "") not in ("", "0")
+
 
 SCRIPT_TEMPLATE = """\
 #!{interpreter}
@@ -63,8 +76,8 @@ def safe_extract_member(archive, member, target_dir):
     return member_path
 
 
-def install_data_directory(archive, data_prefix, site_packages, scripts_dir):
-    scheme_map = {
+def get_scheme_map(site_packages, scripts_dir):
+    return {
         "purelib": site_packages,
         "platlib": site_packages,
         "scripts": scripts_dir,
@@ -72,48 +85,17 @@ def install_data_directory(archive, data_prefix, site_packages, scripts_dir):
         "data": sys.prefix,
     }
 
-    for member in archive.namelist():
-        if not member.startswith(data_prefix):
-            continue
-
-        relative = member[len(data_prefix):]
-        if not relative:
-            continue
-
-        parts = relative.split("/", 1)
-        scheme = parts[0]
-        if len(parts) < 2 or not parts[1]:
-            continue
-
-        target_base = scheme_map.get(scheme)
-        if target_base is None:
-            continue
-
-        dest_path = os.path.join(target_base, parts[1])
-        dest_dir = os.path.dirname(dest_path)
-        if not os.path.isdir(dest_dir):
-            os.makedirs(dest_dir, exist_ok=True)
-
-        if member.endswith("/"):
-            os.makedirs(dest_path, exist_ok=True)
-        else:
-            with archive.open(member) as src, open(dest_path, "wb") as dst:
-                shutil.copyfileobj(src, dst)
-
-            if scheme == "scripts":
-                os.chmod(dest_path, 0o755)
-
 
-def install_entry_points(dist_info_path, scripts_dir, interpreter):
-    entry_points_file = os.path.join(dist_info_path, "entry_points.txt")
-    if not os.path.exists(entry_points_file):
-        return
+def install_entry_points(entry_points, scripts_dir, interpreter):
+    scripts = []
+    if not entry_points:
+        return scripts
 
     config = configparser.ConfigParser()
-    config.read(entry_points_file)
+    config.read_string(entry_points)
 
     if not config.has_section("console_scripts"):
-        return
+        return scripts
 
     for name, value in config.items("console_scripts"):
         match = re.match(r"^(.+):(.+)$", value.strip())
@@ -134,6 +116,9 @@ def install_entry_points(dist_info_path, scripts_dir, interpreter):
         with open(script_path, "w") as f:
             f.write(script_content)
         os.chmod(script_path, 0o755)
+        scripts.append(script_path)
+
+    return scripts
 
 
 def remove_old_package(target_dir, dist_name, scripts_dir):
@@ -166,37 +151,244 @@ def remove_old_package(target_dir, dist_name, scripts_dir):
         print("  Removed: {}".format(os.path.basename(dist_info_dir)))
 
 
-def install_wheel(wheel_path, site_packages, scripts_dir, interpreter):
+def parse_wheel_name(wheel_path):
     filename = os.path.basename(wheel_path)
     parts = filename.split("-")
     if len(parts) < 3:
         raise ValueError("Invalid wheel filename: {}".format(filename))
-
-    dist_name = parts[0]
-    dist_version = parts[1]
+    return parts[0], parts[1]
+
+
+def plan_wheel(whl, dist_name, dist_version, site_packages, scripts_dir):
+    """
+    Single pass over the wheel members: validate each destination and
+    map it to its install location.
+    Returns the (member, destination) pairs to extract, the directories
+    to create, the scripts to make executable and the entry_points.txt
+    contents (None if the wheel has none).
+    """
+    scheme_map = get_scheme_map(site_packages, scripts_dir)
     data_prefix = "{}-{}.data/".format(dist_name, dist_version)
 
+    files = []
+    dirs = set()
+    scripts = set()
+    entry_points = None
+
+    for info in whl.infolist():
+        member = info.filename
+
+        if member.startswith(data_prefix):
+            relative = member[len(data_prefix):]
+            parts = relative.split("/", 1)
+            scheme = parts[0]
+            if len(parts) < 2 or not parts[1]:
+                continue
+            target_base = scheme_map.get(scheme)
+            if target_base is None:
+                continue
+            dest_path = safe_extract_member(whl, parts[1], target_base)
+            if scheme == "scripts" and not info.is_dir():
+                scripts.add(dest_path)
+        else:
+            dest_path = safe_extract_member(whl, member, site_packages)
+            if member.endswith(".dist-info/entry_points.txt") and \
+                    member.count("/") == 1:
+                entry_points = whl.read(info).decode("utf-8")
+
+        if info.is_dir():
+            dirs.add(dest_path)
+        else:
+            dirs.add(os.path.dirname(dest_path))
+            files.append((info, dest_path))
+
+    return files, dirs, scripts, entry_points
+
+
+def make_dirs(dirs):
+    """
+    Create the directories, skipping those created as the parent of
+    another one.
+    """
+    leaves = []
+    for path in sorted(dirs, reverse=True):
+        if leaves and leaves[-1].startswith(path + os.sep):
+            continue
+        leaves.append(path)
+    for path in leaves:
+        os.makedirs(path, exist_ok=True)
+
+
+def install_wheel(wheel_path, site_packages, scripts_dir, interpreter):
+    """
+    Install a wheel, return the paths of the installed files
+    """
+    filename = os.path.basename(wheel_path)
+    dist_name, dist_version = parse_wheel_name(wheel_path)
+
     print("Installing {} -> {}".format(filename, site_packages))
     remove_old_package(site_packages, dist_name, scripts_dir)
 
     with zipfile.ZipFile(wheel_path, "r") as whl:
-        for member in whl.namelist():
-            safe_extract_member(whl, member, site_packages)
+        files, dirs, scripts, entry_points = plan_wheel(
+            whl, dist_name, dist_version, site_packages, scripts_dir)
 
-        regular_members = [
-            m for m in whl.namelist() if not m.startswith(data_prefix)
-        ]
-        whl.extractall(site_packages, members=regular_members)
+        make_dirs(dirs)
 
-        install_data_directory(whl, data_prefix, site_packages, scripts_dir)
+        for info, dest_path in files:
+            with whl.open(info) as src, open(dest_path, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+
+    for script in scripts:
+        os.chmod(script, 0o755)
+
+    installed = [dest_path for _, dest_path in files]
+    installed += install_entry_points(entry_points, scripts_dir, interpreter)
+
+    print("  Done: {}".format(filename))
+    return installed
+
+
+def wheel_paths(wheel_path):
+    """
+    Names a wheel installs or removes: its top level entries in
+    site-packages and data schemes, and its distribution name.
+    Wheels with disjoint names can be installed concurrently.
+    """
+    dist_name, dist_version = parse_wheel_name(wheel_path)
+    data_prefix = "{}-{}.data/".format(dist_name, dist_version)
+
+    paths = {"dist:" + dist_name.replace("-", "_").lower()}
+    with zipfile.ZipFile(wheel_path, "r") as whl:
+        for member in whl.namelist():
+            if member.startswith(data_prefix):
+                parts = member[len(data_prefix):].split("/")
+                if len(parts) < 2 or not parts[1]:
+                    continue
+                if parts[0] in ("purelib", "platlib"):
+                    paths.add(parts[1])
+                else:
+                    paths.add("/".join(parts[:2]))
+            else:
+                paths.add(member.split("/")[0])
+                if member.endswith(".dist-info/entry_points.txt") and \
+                        member.count("/") == 1:
+                    config = configparser.ConfigParser()
+                    config.read_string(whl.read(member).decode("utf-8"))
+                    if config.has_section("console_scripts"):
+                        for name, _ in config.items("console_scripts"):
+                            paths.add("scripts/" + name)
+    return paths
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def load_manifest(site_packages):
+    """
+    Load the install manifest: wheel sha256 -> {"dist", "dist_info",
+    "record"}, "record" being the files installed by the wheel.
+    """
+    path = os.path.join(site_packages, MANIFEST_NAME)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(site_packages, manifest):
+    path = os.path.join(site_packages, MANIFEST_NAME)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def is_installed(manifest, sha256, site_packages):
+    """
+    The wheel with this sha256 was installed, and its distribution was
+    not removed or replaced since then.
+    """
+    entry = manifest.get(sha256)
+    if entry is None:
+        return False
+    return os.path.isfile(
+        os.path.join(site_packages, entry["dist_info"], "RECORD"))
+
+
+def manifest_entry(wheel_path, installed, site_packages):
+    dist_name, dist_version = parse_wheel_name(wheel_path)
+    return {
+        "dist": dist_name.replace("-", "_").lower(),
+        "dist_info": "{}-{}.dist-info".format(dist_name, dist_version),
+        "record": sorted(os.path.relpath(path, site_packages)
+                         for path in installed),
+    }
 
-    dist_info_pattern = os.path.join(
-        site_packages, "{}-*.dist-info".format(dist_name)
-    )
-    for dist_info_dir in glob.glob(dist_info_pattern):
-        install_entry_points(dist_info_dir, scripts_dir, interpreter)
 
-    print("  Done")
+def install_wheels(wheels, site_packages, scripts_dir, interpreter,
+                   jobs=INSTALL_JOBS, force=INSTALL_FORCE):
+    """
+    Install wheels concurrently. A wheel waits for the earlier wheels
+    sharing any path with it, so the result is the same as installing
+    them one after another in order.
+    Wheels found in the install manifest with the same sha256 are skipped,
+    unless "force" is set.
+    """
+    def install(whl, deps):
+        for dep in deps:
+            dep.result()
+        return install_wheel(whl, site_packages, scripts_dir, interpreter)
+
+    manifest = load_manifest(site_packages)
+    installing = set()
+    submitted = []
+    skipped = 0
+
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            # Earlier wheels only, the pool runs tasks in submission order
+            # so the dependencies of a task are always running or done
+            for whl in wheels:
+                sha256 = file_sha256(whl)
+                dist = parse_wheel_name(whl)[0].replace("-", "_").lower()
+                # An earlier wheel of the run would replace this one
+                if not force and dist not in installing and \
+                        is_installed(manifest, sha256, site_packages):
+                    print("Unchanged: {}".format(os.path.basename(whl)))
+                    skipped += 1
+                    continue
+                installing.add(dist)
+
+                paths = wheel_paths(whl)
+                deps = [future for _, _, other_paths, future in submitted
+                        if not paths.isdisjoint(other_paths)]
+                submitted.append((whl, sha256, paths,
+                                  executor.submit(install, whl, deps)))
+
+            for _, _, _, future in submitted:
+                future.result()
+    finally:
+        # Record the wheels installed so far, even if one failed. In
+        # order, an install replaces the entries of the same distribution
+        for whl, sha256, _, future in submitted:
+            if not future.done() or future.cancelled() or \
+                    future.exception():
+                continue
+            entry = manifest_entry(whl, future.result(), site_packages)
+            manifest = {key: value for key, value in manifest.items()
+                        if value["dist"] != entry["dist"]}
+            manifest[sha256] = entry
+        if submitted:
+            save_manifest(site_packages, manifest)
+
+    return skipped
 
 
 def collect_wheels(args):
@@ -224,10 +416,10 @@ def main():
     print("Target: {}".format(site_packages))
     print("Scripts: {}".format(scripts_dir))
 
-    for whl in wheels:
-        install_wheel(whl, site_packages, scripts_dir, interpreter)
+    skipped = install_wheels(wheels, site_packages, scripts_dir, interpreter)
 
-    print("\nInstalled {} wheel(s).".format(len(wheels)))
+    print("\nInstalled {} wheel(s), {} unchanged.".format(
+        len(wheels) - skipped, skipped))
 
 
 if __name__ == "__main__":
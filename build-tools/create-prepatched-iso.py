@@ -32,20 +32,31 @@
 # This can be removed if LAT is upgraded to py310 or above.
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any
 
 import argparse
+import contextlib
+import fcntl
 import glob
+import hashlib
+import json
 import logging
 import os
 import re
 import shutil
 import subprocess
+import sys
 import tarfile
 import tempfile
+import time
 import xml.etree.ElementTree as ET
 import yaml
 
+# Modules shared with the build tools
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "stx"))
+from file_utils import copy_file, link_file  # noqa: E402
+
 
 # === Logging === #
 
@@ -112,6 +123,31 @@ HTTP_FULL_ADDR = f"http://{HTTP_SERVER_IP}:8088"
 LAT_SDK_SYSROOT = "/opt/LAT/SDK/sysroots/x86_64-wrlinuxsdk-linux"
 PATCHES_FEED_PATH = f"/localdisk/loadbuild/{MYUNAME}/{PROJECT}/patches_feed"
 
+# Extracted input ISOs, keyed by the sha256 of the ISO. The build dir is
+# created on the same filesystem so the ISO contents can be hardlinked.
+ISO_CACHE_DIR = os.environ.get(
+    "PREPATCHED_ISO_CACHE",
+    f"/localdisk/loadbuild/{MYUNAME}/{PROJECT}/prepatched_iso_cache")
+
+# Default maximum size of the ISO cache in GiB, least recently used ISOs are
+# evicted. Overridden by PREPATCHED_ISO_CACHE_SIZE.
+ISO_CACHE_SIZE = 40
+
+# Paths (relative to the ISO root) of files modified in place while building
+# the output ISO. These are copied into the build dir instead of hardlinked,
+# so the cached trees are never altered. Note that mkisofs writes the boot
+# info table into isolinux.bin.
+ISO_COPIED_CONTENTS = ("isolinux", "patches", "upgrades")
+# In an ostree repo only the objects are immutable
+OSTREE_LINKED_CONTENTS = ("objects",)
+
+# Patch tooling, used to verify the patch signatures
+STX_PATCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "stx", "patch")
+
+# Number of patch tarballs unpacked while the feed is being populated
+UNPACK_JOBS = 4
+
 # Some command outputs are very long (e.g.: ostree history).
 # Max length before replacing them with "<omitted>" in the log.
 MAX_LOG_LENGTH = 2500
@@ -565,6 +601,11 @@ def clean_ostree(ostree_repo: str) -> None:
     """
     Delete all commits in the ostree repo except for the latest one.
 
+    The commits to keep are the heads of the refs in the repo. Every other
+    commit is dropped by a single 'ostree prune' that only walks the refs
+    with no parent history, instead of one prune (and one full traversal
+    of the object graph) per old commit.
+
     :param ostree_repo: Path to the ostree repository
     """
 
@@ -574,6 +615,8 @@ def clean_ostree(ostree_repo: str) -> None:
     if not os.path.isdir(ostree_repo):
         raise Exception(f"Ostree repo directory does not exist: {ostree_repo}")
 
+    start = time.monotonic()
+
     repo_history = get_ostree_history(ostree_repo)
 
     logger.debug("Ostree repo history before cleaning old commits:\n"
@@ -582,10 +625,22 @@ def clean_ostree(ostree_repo: str) -> None:
     commits = re.findall(pattern=r"^commit\s*([\w\d-]+)", string=repo_history,
                          flags=re.MULTILINE)
 
-    # Delete each commit except the latest one
-    for commit in commits[1:]:
-        cmd = f"ostree --repo={ostree_repo} prune --delete-commit={commit}"
-        run_command(cmd.split())
+    # The head of each ref is kept, everything else only reachable through
+    # parent links goes away
+    cmd = ["ostree", f"--repo={ostree_repo}", "refs"]
+    refs = run_command(cmd).split()
+    keep = set()
+    for ref in refs:
+        cmd = ["ostree", f"--repo={ostree_repo}", "rev-parse", ref]
+        keep.add(run_command(cmd).strip())
+
+    to_delete = [commit for commit in commits if commit not in keep]
+    logger.info(f"Keeping {len(keep)} commit(s), deleting {len(to_delete)}")
+
+    if to_delete:
+        cmd = ["ostree", f"--repo={ostree_repo}", "prune", "--refs-only",
+               "--depth=0"]
+        run_command(cmd)
 
     cmd = ["ostree", "summary", "--update", f"--repo={ostree_repo}"]
     run_command(cmd)
@@ -595,6 +650,375 @@ def clean_ostree(ostree_repo: str) -> None:
     logger.debug("Ostree repo history after cleaning old commits:\n"
                  f"{repo_history}")
 
+    remaining = re.findall(pattern=r"^commit\s*([\w\d-]+)",
+                           string=repo_history, flags=re.MULTILINE)
+    if set(remaining) & set(to_delete):
+        raise Exception("Failed to delete old commits from ostree repo")
+
+    logger.info(f"Ostree repo cleaned in {time.monotonic() - start:.1f}s")
+
+
+def file_sha256(path: str) -> str:
+    """Calculate the sha256 of a file
+
+    :param path: File path
+
+    :returns: sha256 hex digest
+    """
+
+    sha256 = hashlib.sha256()
+    with open(path, mode="rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def write_json_atomic(path: str, data: Any) -> None:
+    """Write a json file, readers never see a partially written file
+
+    :param path: json file path
+    :param data: Data to serialize
+    """
+
+    fd, tmp = tempfile.mkstemp(prefix=".json_", dir=os.path.dirname(path))
+    with os.fdopen(fd, mode="w") as file:
+        json.dump(data, file)
+    os.replace(tmp, path)
+
+
+def iso_sha256(iso_path: str, cache_dir: str = ISO_CACHE_DIR) -> str:
+    """Get the sha256 of an ISO
+
+    The checksums are remembered in the ISO cache along with the ISO size,
+    mtime and inode, an ISO that did not change is not hashed again.
+
+    :param iso_path: Path to ISO file
+    :param cache_dir: ISO cache directory
+
+    :returns: sha256 hex digest
+    """
+
+    index_path = os.path.join(cache_dir, "iso-sha256.json")
+    iso_path = os.path.realpath(iso_path)
+    st = os.stat(iso_path)
+    stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    try:
+        with open(index_path, mode="r") as file:
+            index = json.load(file)
+    except (OSError, ValueError):
+        index = {}
+
+    entry = index.get(iso_path)
+    if entry and entry["stamp"] == stamp:
+        return entry["sha256"]
+
+    logger.info(f"Calculating sha256 of {iso_path}...")
+    index[iso_path] = {"stamp": stamp, "sha256": file_sha256(iso_path)}
+    write_json_atomic(index_path, index)
+
+    return index[iso_path]["sha256"]
+
+
+def write_iso_manifest(iso_tree: str, manifest: str) -> None:
+    """Save the manifest of an extracted ISO tree
+
+    The manifest has the size and mtime of every file in the tree, so the
+    tree can be checked without hashing its contents again.
+
+    :param iso_tree: Path to the extracted ISO tree
+    :param manifest: Path to the manifest file
+    """
+
+    files = {}
+    total_size = 0
+    for root, _, names in os.walk(iso_tree):
+        for name in names:
+            path = os.path.join(root, name)
+            st = os.lstat(path)
+            files[os.path.relpath(path, iso_tree)] = [st.st_size,
+                                                      st.st_mtime_ns]
+            total_size += st.st_size
+
+    write_json_atomic(manifest, {"size": total_size, "files": files})
+
+
+def check_iso_manifest(iso_tree: str) -> bool:
+    """Check an extracted ISO tree against its manifest
+
+    :param iso_tree: Path to the extracted ISO tree
+
+    :returns: Whether the tree is complete and unmodified
+    """
+
+    try:
+        with open(f"{iso_tree}.manifest", mode="r") as file:
+            files = json.load(file)["files"]
+    except (OSError, ValueError, KeyError):
+        logger.warning(f"Missing or invalid manifest for {iso_tree}")
+        return False
+
+    found = 0
+    for root, _, names in os.walk(iso_tree):
+        for name in names:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, iso_tree)
+            st = os.lstat(path)
+            if files.get(rel) != [st.st_size, st.st_mtime_ns]:
+                logger.warning(f"Extracted ISO file changed: {rel}")
+                return False
+            found += 1
+
+    if found != len(files):
+        logger.warning(f"Extracted ISO has {len(files) - found} missing files")
+        return False
+
+    return True
+
+
+def remove_iso_tree(iso_tree: str) -> None:
+    """Remove an extracted ISO tree and its manifest from the ISO cache
+
+    :param iso_tree: Path to the extracted ISO tree
+    """
+
+    # The manifest goes first, a tree without manifest is never used
+    if os.path.exists(f"{iso_tree}.manifest"):
+        os.remove(f"{iso_tree}.manifest")
+    shutil.rmtree(iso_tree, ignore_errors=True)
+
+
+def iso_cache_max_size() -> int:
+    """Get the maximum size of the ISO cache
+
+    :returns: Size in bytes, from PREPATCHED_ISO_CACHE_SIZE (GiB) if valid
+    """
+
+    value = os.environ.get("PREPATCHED_ISO_CACHE_SIZE")
+    if value:
+        try:
+            size = int(value)
+            if size > 0:
+                return size << 30
+        except ValueError:
+            pass
+        logger.warning(f"Invalid PREPATCHED_ISO_CACHE_SIZE '{value}', "
+                       f"using {ISO_CACHE_SIZE} GiB")
+    return ISO_CACHE_SIZE << 30
+
+
+@contextlib.contextmanager
+def iso_cache_lock(cache_dir: str = ISO_CACHE_DIR):
+    """Hold the lock of the ISO cache
+
+    Builds running concurrently share the ISO cache, a tree must not be
+    evicted while another build extracts or stages it.
+
+    :param cache_dir: ISO cache directory
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, ".lock"), mode="w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def evict_iso_cache(cache_dir: str = ISO_CACHE_DIR,
+                    max_size: int | None = None,
+                    keep: str | None = None) -> None:
+    """Remove the least recently used ISOs until the cache fits max_size
+
+    The caller holds the lock of the ISO cache, see iso_cache_lock().
+
+    :param cache_dir: ISO cache directory
+    :param max_size: Maximum size of the cache in bytes, defaults to
+        iso_cache_max_size()
+    :param keep: Extracted ISO tree which must not be evicted
+    """
+
+    if max_size is None:
+        max_size = iso_cache_max_size()
+
+    trees = []
+    total_size = 0
+    for manifest in glob.glob(os.path.join(cache_dir, "*.manifest")):
+        try:
+            with open(manifest, mode="r") as file:
+                size = json.load(file)["size"]
+            # The manifest mtime is the LRU clock
+            mtime = os.stat(manifest).st_mtime
+        except (OSError, ValueError, KeyError):
+            continue
+        trees.append((mtime, size, manifest[:-len(".manifest")]))
+        total_size += size
+
+    for _, size, iso_tree in sorted(trees):
+        if total_size <= max_size:
+            break
+        if iso_tree == keep:
+            continue
+        logger.info(f"Evicting extracted ISO from cache: {iso_tree}")
+        remove_iso_tree(iso_tree)
+        total_size -= size
+
+
+def extract_iso(iso_path: str, cache_dir: str = ISO_CACHE_DIR) -> str:
+    """Extract the contents of an ISO into the ISO cache
+
+    The ISO is only mounted and copied the first time it is seen, later
+    calls return the tree already extracted for the same ISO content,
+    once checked against its manifest. The caller holds the lock of the
+    ISO cache, see iso_cache_lock().
+
+    :param iso_path: Path to ISO file
+    :param cache_dir: ISO cache directory
+
+    :returns: Path to the extracted ISO tree
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    iso_tree = os.path.join(cache_dir, iso_sha256(iso_path, cache_dir))
+
+    if os.path.isdir(iso_tree):
+        if check_iso_manifest(iso_tree):
+            logger.info(f"Using extracted ISO from cache: {iso_tree}")
+            os.utime(f"{iso_tree}.manifest")
+            return iso_tree
+
+        logger.warning("Extracted ISO in cache is damaged, extracting again")
+        remove_iso_tree(iso_tree)
+
+    logger.info("Extracting ISO into the cache...")
+    logger.info(f" - ISO: {iso_path}")
+    logger.info(f" - Extracted tree: {iso_tree}")
+
+    extract_tempdir = tempfile.mkdtemp(
+        prefix=f".{os.path.basename(iso_tree)}_", dir=cache_dir)
+
+    # Create tempdir for mounting
+    mount_tempdir = tempfile.mkdtemp(prefix='mount_tempdir_')
+
+    mount_iso(iso_path, mount_tempdir)
+
+    try:
+        # The slashes at the end of dir names are necessary for rsync
+        cmd = ["rsync", "-a", f"{mount_tempdir}/", f"{extract_tempdir}/"]
+        run_command(cmd)
+
+        # Calculate if copy was successful
+        missing_content = (set(os.listdir(mount_tempdir))
+                           - set(os.listdir(extract_tempdir)))
+        if missing_content:
+            raise Exception(f"Failed to extract ISO contents: {missing_content}")
+
+        # The tree only appears in the cache once complete
+        write_iso_manifest(extract_tempdir, f"{iso_tree}.manifest")
+        os.rename(extract_tempdir, iso_tree)
+
+    except Exception:
+        shutil.rmtree(extract_tempdir, ignore_errors=True)
+        raise
+
+    finally:
+        # Remove mountpoint
+        unmount_iso(mount_tempdir)
+        os.rmdir(mount_tempdir)
+
+    evict_iso_cache(cache_dir, keep=iso_tree)
+
+    return iso_tree
+
+
+def stage_tree(src: str, dst: str,
+               linked: tuple[str, ...] | None = None) -> int:
+    """Stage a directory tree into the build dir
+
+    Directories are created and files are hardlinked from :src:, or
+    reflinked/copied where hardlinks are not possible.
+
+    :param src: Source directory
+    :param dst: Target directory, created if needed
+    :param linked: If set, only paths relative to :src: under one of these
+        are hardlinked, everything else is copied
+
+    :returns: Number of files hardlinked
+    """
+
+    linked_files = 0
+
+    os.makedirs(dst, exist_ok=True)
+    shutil.copystat(src, dst)
+
+    for root, dirs, files in os.walk(src):
+        rel_root = os.path.relpath(root, src)
+        if rel_root == ".":
+            rel_root = ""
+
+        for name in dirs:
+            src_dir = os.path.join(root, name)
+            dst_dir = os.path.join(dst, rel_root, name)
+            if os.path.islink(src_dir):
+                os.symlink(os.readlink(src_dir), dst_dir)
+                continue
+            os.makedirs(dst_dir, exist_ok=True)
+            shutil.copystat(src_dir, dst_dir)
+
+        for name in files:
+            rel = os.path.join(rel_root, name)
+            src_file = os.path.join(root, name)
+            dst_file = os.path.join(dst, rel)
+            if os.path.islink(src_file):
+                os.symlink(os.readlink(src_file), dst_file)
+            elif linked is not None and not any(
+                    rel.startswith(f"{path}/") for path in linked):
+                copy_file(src_file, dst_file)
+            else:
+                link_file(src_file, dst_file)
+                linked_files += 1
+
+    return linked_files
+
+
+def stage_iso_contents(iso_tree: str, target_dir: str, items: list[str],
+                       verbose: bool = False) -> None:
+    """Stage top level items of an extracted ISO into the build dir
+
+    :param iso_tree: Path to the extracted ISO tree
+    :param target_dir: Directory where to stage the ISO contents
+    :param items: Names of the top level files and directories to stage
+    :param verbose: Whether or not to log each staged item
+    """
+
+    for item in items:
+        src = os.path.join(iso_tree, item)
+        dst = os.path.join(target_dir, item)
+
+        linked_files = 0
+
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), dst)
+        elif item in ISO_COPIED_CONTENTS:
+            # The item is modified by the build
+            if os.path.isdir(src):
+                shutil.copytree(src, dst, symlinks=True,
+                                copy_function=copy_file)
+            else:
+                copy_file(src, dst)
+        elif os.path.isdir(src):
+            linked = OSTREE_LINKED_CONTENTS if item == "ostree_repo" else None
+            linked_files = stage_tree(src, dst, linked)
+        else:
+            link_file(src, dst)
+            linked_files = 1
+
+        if verbose:
+            logger.info(f" - Staged '{item}' ({linked_files} files hardlinked)")
+
 
 def copy_iso_contents_exclude_selected(
         iso_path: str, target_dir: str,
@@ -605,6 +1029,9 @@ def copy_iso_contents_exclude_selected(
 
     To copy only specific contents, check copy_specific_iso_contents()
 
+    The ISO is extracted once into the ISO cache, files which are not
+    modified by the build are hardlinked from there.
+
     :param iso_path: Path to ISO file
     :param target_dir: Directory where to copy the ISO contents
     :param exclude_list: List with names of files and directories to exclude.
@@ -621,40 +1048,23 @@ def copy_iso_contents_exclude_selected(
 
     logger.info(f" - Excluded contents: {exclude_list}")
 
-    # Create tempdir for mounting
-    mount_tempdir = tempfile.mkdtemp(prefix='mount_tempdir_')
-
-    mount_iso(iso_path, mount_tempdir)
-
-    # The slashes at the end of dir names are necessary for rsync
-    cmd = ["rsync", "-a"]
-
-    if verbose:
-        cmd += ["-v"]
-
-    for item in exclude_list:
-        path = os.path.join(mount_tempdir, item)
-        if os.path.isfile(path):
-            cmd += ["--exclude", item]
-        elif os.path.isdir(path):
-            # Syntax to account for all internal dir content
-            cmd += ["--exclude", f"{item}/***"]
-        else:
-            raise Exception(f"Item in exclude list not in source ISO: {item}")
+    # No other build evicts the tree before it is staged
+    with iso_cache_lock():
+        iso_tree = extract_iso(iso_path)
+        iso_contents = set(os.listdir(iso_tree))
 
-    cmd += [f"{mount_tempdir}/", f"{target_dir}/"]
+        for item in exclude_list:
+            if item not in iso_contents:
+                raise Exception("Item in exclude list not in source ISO: "
+                                f"{item}")
 
-    run_command(cmd)
+        stage_iso_contents(iso_tree, target_dir,
+                           sorted(iso_contents - set(exclude_list)), verbose)
 
     # Calculate if copy was successful
-    iso_contents = set(os.listdir(mount_tempdir))
     target_dir_contents = set(os.listdir(target_dir))
     missing_content = iso_contents - target_dir_contents - set(exclude_list)
 
-    # Remove mountpoint
-    unmount_iso(mount_tempdir)
-    os.rmdir(mount_tempdir)
-
     # Report errors if any
     if missing_content:
         raise Exception(f"Failed to copy ISO contents: {missing_content}")
@@ -666,6 +1076,9 @@ def copy_iso_contents_include_selected(iso_path: str, target_dir: str,
 
     """Copy ONLY selected ISO contents to target dir
 
+    The ISO is extracted once into the ISO cache, files which are not
+    modified by the build are hardlinked from there.
+
     :param iso_path: Path to ISO file
     :param target_dir: Path to directory where to copy the ISO contents
     :param include_list: List with names of files and directories to copy. Must
@@ -682,43 +1095,213 @@ def copy_iso_contents_include_selected(iso_path: str, target_dir: str,
 
     logger.info(f" - Contents to include: {include_list}")
 
-    # Create tempdir for mounting
-    mount_tempdir = tempfile.mkdtemp(prefix='mount_tempdir_')
+    # No other build evicts the tree before it is staged
+    with iso_cache_lock():
+        iso_tree = extract_iso(iso_path)
+        iso_contents = set(os.listdir(iso_tree))
 
-    mount_iso(iso_path, mount_tempdir)
+        for item in include_list:
+            if item not in iso_contents:
+                raise Exception(f"Invalid content to copy: {item}")
 
-    cmd = ["rsync", "-a"]
+        # Content taken from the secondary ISO replaces the base one
+        for item in include_list:
+            path = os.path.join(target_dir, item)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
 
-    if verbose:
-        cmd += ["-v"]
-
-    for item in include_list:
-        path = os.path.join(mount_tempdir, item)
-        if os.path.isfile(path):
-            cmd += ["--include", item]
-        elif os.path.isdir(path):
-            # Syntax to include all internal dir content
-            cmd += ["--include", f"{item}/***"]
-        else:
-            raise Exception(f"Invalid content to copy: {item}")
-
-    cmd += ["--exclude", "*", f"{mount_tempdir}/", f"{target_dir}/"]
-
-    run_command(cmd)
+        stage_iso_contents(iso_tree, target_dir, include_list, verbose)
 
     # Calculate if copy was successful
     target_dir_contents = set(os.listdir(target_dir))
     missing_content = set(include_list) - target_dir_contents
 
-    # Remove mountpoint
-    unmount_iso(mount_tempdir)
-    os.rmdir(mount_tempdir)
-
     # Report errors if any
     if missing_content:
         raise Exception(f"Failed to copy ISO contents: {missing_content}")
 
 
+def open_nested_tar(outer: tarfile.TarFile, name: str) -> tarfile.TarFile:
+    """Open a tarball stored inside another tarball as a stream
+
+    The members are read lazily from the outer tarball, the nested tarball
+    is never written to disk.
+
+    :param outer: Opened outer tarball
+    :param name: Name of the nested tarball
+
+    :returns: Nested tarball, in stream mode
+    """
+
+    member = outer.extractfile(name)
+    if member is None:
+        raise Exception(f"'{name}' is not a regular file in {outer.name}")
+
+    return tarfile.open(fileobj=member, mode="r|")
+
+
+def save_member(tar: tarfile.TarFile, member: tarfile.TarInfo,
+                path: str) -> None:
+    """Write a tarball member to its final destination
+
+    :param tar: Opened tarball
+    :param member: Member to write
+    :param path: Destination file path
+    """
+
+    with tar.extractfile(member) as src, open(path, mode="wb") as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.chmod(path, member.mode)
+
+
+def verify_patch_signatures(patches: list[str]) -> None:
+    """Verify the detached signatures of all the patches
+
+    The patches are verified concurrently, against the formal and the
+    developer certificates.
+
+    :param patches: Paths to the patch files
+    """
+
+    logger.info("Verifying patch signatures...")
+
+    if STX_PATCH_DIR not in sys.path:
+        sys.path.append(STX_PATCH_DIR)
+    try:
+        from signing import patch_verify
+    except ImportError as e:
+        logger.warning(f"Patch signatures not verified, missing module: {e}")
+        return
+
+    context = patch_verify.VerificationContext.from_cert_type(
+        patch_verify.cert_type_all)
+    results = context.verify_patches(patches)
+
+    failed = [patch for patch, verified in results.items() if not verified]
+    if failed:
+        raise Exception(f"Invalid patch signatures: {failed}")
+
+
+def read_patch_metadata(patch: str, patch_tempdir: str) -> dict:
+    """Read the metadata of a patch file
+
+    Parse the metadata.xml straight from the patch, and save it along with
+    the precheck scripts (if any) into :patch_tempdir:, under a directory
+    named after its sw_version. The debs are extracted separately, see
+    unpack_patch_debs().
+
+    :param patch: Path to the patch file
+    :param patch_tempdir: Directory where to save the patch contents
+
+    :returns: Dict with the sw_version, package names and paths of the patch
+    """
+
+    with tarfile.open(patch) as f:
+
+        # We read the metadata.xml from the metadata.tar
+        with open_nested_tar(f, 'metadata.tar') as metadata_tar:
+            for member in metadata_tar:
+                if member.name == 'metadata.xml':
+                    metadata_xml = metadata_tar.extractfile(member).read()
+                    break
+            else:
+                raise Exception(f"No metadata.xml in patch {patch}")
+
+        # Get sw_version value and save metadata.xml using sw_version as suffix
+        xml_root = ET.fromstring(metadata_xml)
+        sw_version = xml_root.find('sw_version').text
+        component = xml_root.find('component').text
+        os.makedirs(f"{patch_tempdir}/{sw_version}/metadata")
+        metadata_path = (f"{patch_tempdir}/{sw_version}/metadata/{component}-{sw_version}"
+            "-metadata.xml")
+        with open(metadata_path, mode="wb") as file:
+            file.write(metadata_xml)
+
+        # Packages names need to include version and revision
+        # e.g.: logmgmt_1.0-1.stx.10
+        packages = []
+        for i in xml_root.find('packages').findall('deb'):
+            packages.append(i.text.split("_")[0])
+
+        # Patches can contain precheck scripts, we need to verify if
+        # they exist and, if so, move them to the pre-patched iso.
+        precheck = False
+        path_precheck = ''
+        path_upgrade_utils = ''
+        if "deploy-precheck" in f.getnames() and "upgrade_utils.py" in f.getnames():
+            precheck = True
+            precheck_folder = f"{patch_tempdir}/{sw_version}/precheck"
+            os.makedirs(f"{precheck_folder}")
+            path_precheck = f"{precheck_folder}/deploy-precheck"
+            path_upgrade_utils = f"{precheck_folder}/upgrade_utils.py"
+            save_member(f, f.getmember('deploy-precheck'), path_precheck)
+            save_member(f, f.getmember('upgrade_utils.py'), path_upgrade_utils)
+
+    return {
+        "file": patch,
+        "sw_version": sw_version,
+        "path": f"{patch_tempdir}/{sw_version}",
+        "packages": packages,
+        "metadata": metadata_path,
+        "precheck": precheck,
+        "path_precheck": path_precheck,
+        "path_upgrade_utils": path_upgrade_utils
+        }
+
+
+def unpack_patch_debs(patch: dict) -> None:
+    """Extract the debs of a patch
+
+    The members of software.tar are streamed out of the patch, each .deb
+    file is written once, directly to the 'debs' directory of the patch.
+    Only regular files are written, at their path in software.tar; paths
+    out of the 'debs' directory are refused.
+
+    :param patch: Patch data, as returned by read_patch_metadata()
+    """
+
+    debs_dir = f"{patch['path']}/debs"
+
+    with tarfile.open(patch["file"]) as f:
+        with open_nested_tar(f, 'software.tar') as software_tar:
+            for member in software_tar:
+                if not member.isfile():
+                    continue
+                name = os.path.normpath(member.name)
+                if os.path.isabs(name) or name == ".." or \
+                        name.startswith(".." + os.sep):
+                    logger.warning(f"Skipping unsafe member {member.name} "
+                                   f"of {patch['file']}")
+                    continue
+                deb_path = os.path.join(debs_dir, name)
+                os.makedirs(os.path.dirname(deb_path), exist_ok=True)
+                save_member(software_tar, member, deb_path)
+
+    logger.info(f"Patch {patch['sw_version']} unpacked sucessfully.")
+
+
+def add_debs_to_feed(feed: str, component: str, debs: list[str]) -> None:
+    """Add debs to a component of the apt-ostree feed
+
+    All the debs are added with a single 'apt-ostree repo add' so the
+    feed is only loaded and indexed once per component.
+
+    :param feed: Path to the apt-ostree feed
+    :param component: Feed component, the patch sw_version
+    :param debs: Paths to the deb files
+    """
+
+    logger.info(f"Adding {len(debs)} debs to feed component {component}...")
+
+    cmd = ["apt-ostree", "repo", "add", "--feed", feed,
+           "--release", "bullseye", "--component", component]
+    cmd += debs
+    logger.debug('Running command: %s', cmd)
+    subprocess.check_call(cmd, shell=False)
+
+
 # === Main === #
 
 def main():
@@ -791,8 +1374,11 @@ def main():
         logger.debug(f"- {key} = {value}")
 
     # Create temporary directories
-    # Tempdir for setting up ISO contents
-    build_tempdir = tempfile.mkdtemp(prefix='build_tempdir_')
+    # Tempdir for setting up ISO contents, next to the ISO cache so files
+    # can be hardlinked from it
+    os.makedirs(ISO_CACHE_DIR, exist_ok=True)
+    build_tempdir = tempfile.mkdtemp(prefix='build_tempdir_',
+                                     dir=os.path.dirname(ISO_CACHE_DIR))
     # Tempdir for patches' metadata and debs
     patch_tempdir = tempfile.mkdtemp(prefix='patch_tempdir_')
 
@@ -831,6 +1417,8 @@ def main():
         if not all([os.path.isfile(patch) for patch in args.patch]):
             raise Exception("One or more patch files provided do not exist")
 
+        verify_patch_signatures(args.patch)
+
         if os.path.exists(args.output):
             raise Exception(f"Output filepath already exists: {args.output}")
 
@@ -875,9 +1463,8 @@ def main():
         logger.info("=> Copying base ostree repository from inputs...")
         if base_ostree_repo:
             # A custom ostree_repo was provided to serve as base
-            cmd = ["rsync", "-a", f'{base_ostree_repo}/',
-                   f"{build_tempdir}/ostree_repo"]
-            run_command(cmd)
+            stage_tree(base_ostree_repo, f"{build_tempdir}/ostree_repo",
+                       linked=OSTREE_LINKED_CONTENTS)
 
         else:
             # As fallback, use ostree_repo from main Input ISO
@@ -894,72 +1481,16 @@ def main():
                "--release", "bullseye", "--origin", "updates"]
         run_command(cmd)
 
-        logger.info('=> Unpacking patches...')
-        latest_patch_number = 0
-        # For each patch, extract the metadata.xml and the deb files
-        # and save the sw_version and package names to be used on apt-ostree
-        patches_data = []
-        for patch in patches:
-            with tempfile.TemporaryDirectory() as extract_folder:
-                with tarfile.open(patch) as f:
-
-                    # We extract the metadata.xml from the metadata.tar
-                    f.extract('metadata.tar', f"{extract_folder}/")
-                    metadata_tar = tarfile.open(f"{extract_folder}/metadata.tar")
-                    metadata_tar.extract('metadata.xml', f"{extract_folder}/")
-
-                    # Get sw_version value and save metadata.xml using sw_version as suffix
-                    xml_root = ET.parse(f"{extract_folder}/metadata.xml").getroot()
-                    sw_version = xml_root.find('sw_version').text
-                    component = xml_root.find('component').text
-                    os.makedirs(f"{patch_tempdir}/{sw_version}/metadata")
-                    metadata_path = (f"{patch_tempdir}/{sw_version}/metadata/{component}-{sw_version}"
-                        "-metadata.xml")
-                    shutil.copy(f"{extract_folder}/metadata.xml", metadata_path)
-
-                    # From inside software.tar we extract every .deb file
-                    f.extract('software.tar', f"{extract_folder}/")
-                    software_tar = tarfile.open(f"{extract_folder}/software.tar")
-                    software_tar.extractall(f"{patch_tempdir}/{sw_version}/debs/")
-                    # Packages names need to include version and revision
-                    # e.g.: logmgmt_1.0-1.stx.10
-                    packages = []
-                    for i in xml_root.find('packages').findall('deb'):
-                        packages.append(i.text.split("_")[0])
-
-                    # Patches can contain precheck scripts, we need to verify if
-                    # they exist and, if so, move them to the pre-patched iso.
-                    precheck = False
-                    path_precheck = ''
-                    path_upgrade_utils = ''
-                    if "deploy-precheck" in f.getnames() and "upgrade_utils.py" in f.getnames():
-                        precheck = True
-                        f.extract('deploy-precheck', f"{extract_folder}/")
-                        f.extract('upgrade_utils.py', f"{extract_folder}/")
-                        precheck_folder = f"{patch_tempdir}/{sw_version}/precheck"
-                        os.makedirs(f"{precheck_folder}")
-                        path_precheck = f"{precheck_folder}/deploy-precheck"
-                        path_upgrade_utils = f"{precheck_folder}/upgrade_utils.py"
-                        shutil.copy(f"{extract_folder}/deploy-precheck", path_precheck)
-                        shutil.copy(f"{extract_folder}/upgrade_utils.py", path_upgrade_utils)
-
-                    # Now we save the information we extract for later use
-                    patches_data.append({
-                        "sw_version": sw_version,
-                        "path": f"{patch_tempdir}/{sw_version}",
-                        "packages": packages,
-                        "metadata": metadata_path,
-                        "precheck": precheck,
-                        "path_precheck": path_precheck,
-                        "path_upgrade_utils": path_upgrade_utils
-                        })
-
-                    # Save the biggest version from the patches we have
-                    patch_num = int(sw_version.split(".")[-1])
-
-                    latest_patch_number = max(patch_num, latest_patch_number)
-
-                    logger.info(f'Patch {sw_version} unpacked sucessfully.')
+        logger.info('=> Reading patches metadata...')
+        # For each patch, extract the metadata.xml and save the sw_version
+        # and package names to be used on apt-ostree. The debs are unpacked
+        # later, in the background, while earlier patches are committed.
+        patches_data = [read_patch_metadata(patch, patch_tempdir)
+                        for patch in patches]
+
+        # Save the biggest version from the patches we have
+        latest_patch_number = max(int(patch["sw_version"].split(".")[-1])
+                                  for patch in patches_data)
 
         # Here we setup our gpg client if needed
         if sign_gpg:
@@ -979,54 +1510,59 @@ def main():
         # after that we install it on the ostree repository
         logger.info('Populate ostree repository with .deb files...')
         patches_data = sorted(patches_data, key=lambda x: x['sw_version'])
-        for patch in patches_data:
-            # Scan /debs/ folder and load each patch onto the reprepo feed
 
-            debs_dir = os.path.join(patch["path"], "debs/")
-            if not os.path.isdir(debs_dir):
-                msg = f"Patch '{patch['sw_version']}' does not contain any deb pkgs. " \
-                      "Skipping creation of corresponding ostree commit."
-                logger.warning(msg)
-                #TODO: Re-evaluate GPG signing for empty patches.
+        # Debs are unpacked in sw_version order, ahead of the ostree commits
+        logger.info('=> Unpacking patches...')
+        with ThreadPoolExecutor(max_workers=UNPACK_JOBS) as unpack_pool:
+            unpacked = [unpack_pool.submit(unpack_patch_debs, patch)
+                        for patch in patches_data]
+
+            for patch, unpack in zip(patches_data, unpacked):
+                # Wait until the debs of this patch are available
+                unpack.result()
+
+                # Scan /debs/ folder and load each patch onto the reprepro feed
+                debs_dir = os.path.join(patch["path"], "debs/")
+                if not os.path.isdir(debs_dir) or not os.listdir(debs_dir):
+                    msg = f"Patch '{patch['sw_version']}' does not contain any deb pkgs. " \
+                          "Skipping creation of corresponding ostree commit."
+                    logger.warning(msg)
+                    #TODO: Re-evaluate GPG signing for empty patches.
+
+                else:
+                    # Populate apt repo
+                    debs = [os.path.join(debs_dir, deb)
+                            for deb in sorted(os.listdir(debs_dir))]
+                    add_debs_to_feed(PATCHES_FEED_PATH, patch['sw_version'], debs)
+
+                    # Now with every deb loaded we commit it in the ostree repository
+                    # apt-ostree requires an http connection to access the host files
+                    # so we give the full http path using the ip
+                    full_feed_path = f'\"{HTTP_FULL_ADDR}{PATCHES_FEED_PATH} bullseye\"'
+                    cmd = ["apt-ostree", "compose", "install", "--repo", f"{build_tempdir}/ostree_repo"]
+                    # If we have ostree setup we will use the gpg key
+                    if sign_gpg:
+                        gpg_key = get_value_from_yaml("gpg.ostree.gpgid")
+                        cmd += ["--gpg-key", gpg_key]
+                    pkgs = " ".join(patch["packages"])
+                    cmd += ["--branch", "starlingx", "--feed", full_feed_path, "--component",
+                        patch['sw_version'], pkgs]
 
-            else:
-                # Populate apt repo
-                debs = os.listdir(debs_dir)
-                for deb in debs:
-                    cmd = ["apt-ostree", "repo", "add", "--feed", PATCHES_FEED_PATH,
-                        "--release", "bullseye", "--component", patch['sw_version'],
-                        os.path.join(f"{patch['path']}/debs/", deb)]
                     logger.debug('Running command: %s', cmd)
                     subprocess.check_call(cmd, shell=False)
 
-                # Now with every deb loaded we commit it in the ostree repository
-                # apt-ostree requires an http connection to access the host files
-                # so we give the full http path using the ip
-                full_feed_path = f'\"{HTTP_FULL_ADDR}{PATCHES_FEED_PATH} bullseye\"'
-                cmd = ["apt-ostree", "compose", "install", "--repo", f"{build_tempdir}/ostree_repo"]
-                # If we have ostree setup we will use the gpg key
-                if sign_gpg:
-                    gpg_key = get_value_from_yaml("gpg.ostree.gpgid")
-                    cmd += ["--gpg-key", gpg_key]
-                pkgs = " ".join(patch["packages"])
-                cmd += ["--branch", "starlingx", "--feed", full_feed_path, "--component",
-                    patch['sw_version'], pkgs]
-
-                logger.debug('Running command: %s', cmd)
-                subprocess.check_call(cmd, shell=False)
-
-            # Check if patch has precheck scripts, if yes move then to the upgrades folder
-            if patch["precheck"]:
-                shutil.copy(patch["path_precheck"], f"{build_tempdir}/upgrades")
-                shutil.copy(patch["path_upgrade_utils"], f"{build_tempdir}/upgrades")
-
-            # Copy only the patch metadata with the biggest patch version to ISO
-            patch_num = int(patch["sw_version"].split(".")[-1])
-            if latest_patch_number == patch_num:
-                # Metadata inside upgrades requires ostree information
-                update_metadata_info(patch["metadata"], build_tempdir)
-                shutil.copy(patch["metadata"], f"{build_tempdir}/patches")
-                shutil.copy(patch["metadata"], f"{build_tempdir}/upgrades")
+                # Check if patch has precheck scripts, if yes move then to the upgrades folder
+                if patch["precheck"]:
+                    shutil.copy(patch["path_precheck"], f"{build_tempdir}/upgrades")
+                    shutil.copy(patch["path_upgrade_utils"], f"{build_tempdir}/upgrades")
+
+                # Copy only the patch metadata with the biggest patch version to ISO
+                patch_num = int(patch["sw_version"].split(".")[-1])
+                if latest_patch_number == patch_num:
+                    # Metadata inside upgrades requires ostree information
+                    update_metadata_info(patch["metadata"], build_tempdir)
+                    shutil.copy(patch["metadata"], f"{build_tempdir}/patches")
+                    shutil.copy(patch["metadata"], f"{build_tempdir}/upgrades")
 
         # Update ostree summary
         cmd = ["ostree", "summary", "--update", f"--repo={build_tempdir}/ostree_repo"]
@@ -21,10 +21,16 @@
 # Realization of its real RESTAPI(go)
 # https://github.com/molior-dbs/aptly
 from aptly_api import Client
+from aptly_api.base import AptlyAPIException
 from aptly_api.parts.tasks import Task
 from aptly_api.parts.packages import Package
+from concurrent.futures import Future, ThreadPoolExecutor
 from debian import debian_support
+import debian.deb822
+import hashlib
 import os
+import requests
+import threading
 import time
 from typing import Optional, NamedTuple
 
@@ -34,9 +40,97 @@ PREFIX_MERGE = 'deb-merge-'
 SIGN_KEY = '8C58D092AD39022571D1F57AFA689A0116E3E718'
 SIGN_PASSWD = 'starlingx'
 DEFAULT_TIMEOUT_COUNT = 1
+# Poll interval(seconds) of aptly tasks, grows while nothing completes
+TASK_POLL_MIN = 0.2
+TASK_POLL_MAX = 5
+# Number of independent repository operations run concurrently
+DEFAULT_TASK_JOBS = 4
+# Package names per aptly package query, package keys per add/delete task
+PKG_QUERY_CHUNK = 100
+PKG_REFS_CHUNK = 1000
+# Snapshot description of a mirror, records the upstream content it was taken from
+UPSTREAM_FINGERPRINT = 'upstream-sha256: '
 STX_DIST = os.environ.get('STX_DIST')
 DEBIAN_DISTRIBUTION = os.environ.get('DEBIAN_DISTRIBUTION')
 
+# Build an aptly package query, the filtering is done by aptly.
+# name: package name, may contain shell style wildcards
+# version: package version
+# arch: architecture, 'source' for source packages
+def pkg_query(name=None, version=None, arch=None):
+    '''Return an aptly package query matching name, version and architecture.'''
+    conditions = []
+    if name:
+        if any(c in name for c in '*?['):
+            conditions.append('Name (%% %s)' % name)
+        else:
+            conditions.append('Name (= %s)' % name)
+    if version:
+        conditions.append('Version (= %s)' % version)
+    if arch:
+        conditions.append('$Architecture (= %s)' % arch)
+    if not conditions:
+        return 'Name'
+    return ', '.join(conditions)
+
+
+# Track a set of running aptly tasks from one polling thread.
+# The interval between polling rounds starts at TASK_POLL_MIN and backs off
+# up to TASK_POLL_MAX while no task completes.
+class AptlyTaskTracker():
+    def __init__(self, aptly, logger):
+        self.aptly = aptly
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        # pending[task_id] = [task, future, deadline]
+        self.pending = dict()
+        self.poller = None
+
+    # Start tracking "task" for up to "timeout" seconds
+    # Return: Future, its result is SUCCEEDED, FAILED or TIMEOUTED
+    def track(self, task, timeout):
+        '''Return a future which is resolved when the aptly task completes.'''
+        future = Future()
+        with self.lock:
+            self.pending[task.id] = [task, future, time.monotonic() + timeout]
+            if not self.poller or not self.poller.is_alive():
+                self.poller = threading.Thread(target=self.__poll, name='aptly-tasks', daemon=True)
+                self.poller.start()
+            self.wakeup.notify()
+        return future
+
+    def __poll(self):
+        interval = TASK_POLL_MIN
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.poller = None
+                    return
+                self.wakeup.wait(interval)
+                tracked = dict(self.pending)
+            done = dict()
+            now = time.monotonic()
+            for task_id, (task, future, deadline) in tracked.items():
+                try:
+                    state = self.aptly.tasks.show(task_id).state
+                except Exception as e:
+                    self.logger.debug('Aptly task %d(%s) state unknown: %s' % (task.id, task.name, e))
+                    state = None
+                if state == 'SUCCEEDED' or state == 'FAILED':
+                    done[task_id] = state
+                elif now > deadline:
+                    self.logger.warning('Aptly task %d(%s) timeouts.' % (task.id, task.name))
+                    done[task_id] = 'TIMEOUTED'
+            with self.lock:
+                for task_id, state in done.items():
+                    self.pending.pop(task_id)[1].set_result(state)
+            if done:
+                interval = TASK_POLL_MIN
+            else:
+                interval = min(interval * 1.5, TASK_POLL_MAX)
+
+
 # Class used to manage aptly data base, it can:
 #     create_remote: Create a repository link to a remote mirror
 #     deploy_remote: Sync and deploy a remote mirror
@@ -46,11 +140,13 @@ DEBIAN_DISTRIBUTION = os.environ.get('DEBIAN_DISTRIBUTION')
 #     upload_pkg_local: Upload a deb package into a local repository
 #     delete_pkg_local: Remove a deb package from a local repository
 #     pkg_exist: Search a package in a set of repos
+#     iter_pkgs: Iterate the packages of a repo, filtered by aptly
 #     copy_pkgs: Copy packages from one repo to another
 #     deploy_local: Deploy a local repository
 #     list_local: List all local repositories
 #     remove_local: Delete a local repository
 #     clean_all: Clean all meta data including repo, public, distribution, package, task
+#     submit: Run an operation in the background and return its future
 
 
 class Deb_aptly():
@@ -59,6 +155,8 @@ class Deb_aptly():
         self.logger = logger
         self.url = url
         self.aptly = Client(self.url)
+        self.tasks = AptlyTaskTracker(self.aptly, self.logger)
+        self.executor = None
         self.logger.info('Aptly connected, version: %s', self.aptly.misc.version())
         self._db_health_check()
         if origin:
@@ -159,76 +257,75 @@ class Deb_aptly():
         if not name.startswith(PREFIX_MERGE):
             self.logger.error('%s did not start with %s, Failed.' % (name, PREFIX_MERGE))
             return False
-        package_refs = []
         # package_uniq_dict[pkgname_arch] = [package.key, snapshot]
         package_uniq_dict = dict()
         source_snapshots = [x.strip() for x in source_snapshots if x.strip() != '']
         # remove duplicates (keep order)
         source_snapshots = list(dict.fromkeys(source_snapshots))
-        snap_list = self.aptly.snapshots.list()
+        snap_names = set(snap.name for snap in self.aptly.snapshots.list())
         for snapshot in source_snapshots:
-            snap_exist = False
-            for snap in snap_list:
-                if snap.name == snapshot:
-                    snap_exist = True
-                    package_list = self.aptly.snapshots.list_packages(snap.name, with_deps=False, detailed=False)
-                    # Debug only
-                    # package_list.sort()
-                    # self.logger.debug('%s packages in repo %s' % (len(package_list), snapshot))
-                    for package in package_list:
-                        key_list = package.key.split()
-                        # 0: pkg_arch  1: pkg_name  2: pkg_version 3: pkg_key of aptly
-                        pkgname_arch = '_'.join([key_list[1], key_list[0]])
-                        # Source packages are useless for LAT, ignore them.
-                        if "Psource" == key_list[0]:
-                            continue
-                        # Check and drop duplicate packages
-                        if pkgname_arch in package_uniq_dict.keys():
-                            need_replace = False
-                            orig_version = package_uniq_dict[pkgname_arch][0].split()[2]
-                            if STX_DIST in orig_version and STX_DIST not in key_list[2]:
-                                self.logger.warn('STX package %s %s has been eclipsed by upstream version %s' %
-                                                 (pkgname_arch, orig_version, key_list[2]))
-                            if debian_support.version_compare(key_list[2], orig_version) > 0:
-                                self.logger.warn('Drop duplicate package: %s.' %
-                                                 ' of '.join(package_uniq_dict[pkgname_arch]))
-                                package_refs.remove(package_uniq_dict[pkgname_arch][0])
-                                package_refs.append(package.key)
-                                package_uniq_dict[pkgname_arch] = [package.key, snapshot]
-                            else:
-                                self.logger.warn('Drop duplicate package: %s of %s.' % (package.key, snapshot))
-                            continue
-                        package_uniq_dict[pkgname_arch] = [package.key, snapshot]
-                        package_refs.append(package.key)
-                    break
-            if not snap_exist:
+            if snapshot not in snap_names:
                 self.logger.error('snapshot %s does not exist, merge failed.' % snapshot)
                 return False
+        # List the packages of all source snapshots concurrently. A pool of its own,
+        # merge_repos may itself run in self.executor.
+        with ThreadPoolExecutor(max_workers=DEFAULT_TASK_JOBS) as executor:
+            package_lists = list(executor.map(
+                lambda snapshot: self.aptly.snapshots.list_packages(snapshot, with_deps=False, detailed=False),
+                source_snapshots))
+        for snapshot, package_list in zip(source_snapshots, package_lists):
+            # Debug only
+            # package_list.sort()
+            # self.logger.debug('%s packages in repo %s' % (len(package_list), snapshot))
+            for package in package_list:
+                key_list = package.key.split()
+                # 0: pkg_arch  1: pkg_name  2: pkg_version 3: pkg_key of aptly
+                pkgname_arch = '_'.join([key_list[1], key_list[0]])
+                # Source packages are useless for LAT, ignore them.
+                if "Psource" == key_list[0]:
+                    continue
+                # Check and drop duplicate packages
+                if pkgname_arch in package_uniq_dict:
+                    orig_version = package_uniq_dict[pkgname_arch][0].split()[2]
+                    if STX_DIST in orig_version and STX_DIST not in key_list[2]:
+                        self.logger.warn('STX package %s %s has been eclipsed by upstream version %s' %
+                                         (pkgname_arch, orig_version, key_list[2]))
+                    if debian_support.version_compare(key_list[2], orig_version) > 0:
+                        self.logger.warn('Drop duplicate package: %s.' %
+                                         ' of '.join(package_uniq_dict[pkgname_arch]))
+                        package_uniq_dict[pkgname_arch] = [package.key, snapshot]
+                    else:
+                        self.logger.warn('Drop duplicate package: %s of %s.' % (package.key, snapshot))
+                    continue
+                package_uniq_dict[pkgname_arch] = [package.key, snapshot]
+        package_refs = [pkg_snap[0] for pkg_snap in package_uniq_dict.values()]
 
         # Remove a same name publish if exists
         # For exist snapshot called NAME, we will:
         # 1, rename it to backup-NAME
         # 2, Create a new snapshot: NAME
         # 3, delete snapshot backup-name
+        # The publication and the backup snapshot are dropped concurrently
         backup_name = None
+        drop_tasks = []
         publish_list = self.aptly.publish.list()
         for publish in publish_list:
             if publish.prefix == name:
-                task = self.aptly.publish.drop(prefix=name, distribution=publish.distribution, force_delete=True)
-                task_state = self.__wait_for_task(task)
-                if task_state != 'SUCCEEDED':
-                    self.logger.warning('Drop publication failed %s : %s' % (name, task_state))
-                    return False
+                drop_tasks.append(['publication ' + name,
+                                   self.aptly.publish.drop(prefix=name, distribution=publish.distribution,
+                                                           force_delete=True)])
         # Remove the backup snapshot if it exists
         snap_list = self.aptly.snapshots.list()
         for snap in snap_list:
             if snap.name == 'backup-' + name:
                 backup_name = 'backup-' + name
-                task = self.aptly.snapshots.delete(snapshotname=backup_name, force=True)
-                task_state = self.__wait_for_task(task)
-                if task_state != 'SUCCEEDED':
-                    self.logger.warning('Drop snapshot failed %s : %s' % (backup_name, task_state))
-                    return False
+                drop_tasks.append(['snapshot ' + backup_name,
+                                   self.aptly.snapshots.delete(snapshotname=backup_name, force=True)])
+        task_states = self.__wait_for_tasks([task for _, task in drop_tasks])
+        for (drop_name, _), task_state in zip(drop_tasks, task_states):
+            if task_state != 'SUCCEEDED':
+                self.logger.warning('Drop %s failed : %s' % (drop_name, task_state))
+                return False
         # Rename the snapshot if it exists
         for snap in snap_list:
             if snap.name == name:
@@ -257,30 +354,34 @@ class Deb_aptly():
     # Create a snapshot based on "name" with same name
     # local: True ==> local_repo False ==> remote_mirror
     # Return False if failed
-    def __create_snapshot(self, name, local):
+    def __create_snapshot(self, name, local, description=None):
         '''For local-repo or remote-repo, create a snapshot for it, prepare for later deploy.'''
         # Remove a same name publish if exists
         # For exist snapshot called NAME, we will:
         # 1, rename it to backup-NAME
         # 2, Create a new snapshot: NAME
         # 3, delete snapshot backup-name
+        # The publication and a stale backup snapshot are dropped concurrently
         backup_name = None
+        drop_tasks = []
         publish_list = self.aptly.publish.list()
         for publish in publish_list:
             if publish.prefix == name:
-                task = self.aptly.publish.drop(prefix=name, distribution=publish.distribution, force_delete=True)
-                task_state = self.__wait_for_task(task)
-                if task_state != 'SUCCEEDED':
-                    self.logger.warning('Remove publication failed %s : %s' % (name, task_state))
+                drop_tasks.append(self.aptly.publish.drop(prefix=name, distribution=publish.distribution,
+                                                          force_delete=True))
+        publish_drops = len(drop_tasks)
         # Rename the snapshot if exists
         snap_list = self.aptly.snapshots.list()
 
         exists = [snap for snap in snap_list if snap.name == name]
         backup_exists = [snap for snap in snap_list if snap.name == 'backup-' + name]
+        if exists and backup_exists:
+            drop_tasks.append(self.aptly.snapshots.delete('backup-' + name, force=True))
+        for task_state in self.__wait_for_tasks(drop_tasks)[:publish_drops]:
+            if task_state != 'SUCCEEDED':
+                self.logger.warning('Remove publication failed %s : %s' % (name, task_state))
         if exists:
             backup_name = 'backup-' + name
-            if backup_exists:
-                self.__wait_for_task(self.aptly.snapshots.delete(backup_name, force=True))
             self.__wait_for_task(self.aptly.snapshots.update(name, backup_name))
 
         # crate a snapshot
@@ -288,7 +389,7 @@ class Deb_aptly():
         if local:
             task = self.aptly.snapshots.create_from_repo(name, name)
         else:
-            task = self.aptly.snapshots.create_from_mirror(name, name)
+            task = self.aptly.snapshots.create_from_mirror(name, name, description=description)
         task_state = self.__wait_for_task(task)
         if task_state != 'SUCCEEDED':
             if backup_name:
@@ -307,36 +408,55 @@ class Deb_aptly():
     # Return: SUCCEEDED, FAILED, TIMEOUTED, EINVAL
     def __wait_for_task(self, task, count=DEFAULT_TIMEOUT_COUNT):
         '''Wait for an aptly task for one or more minutes'''
-        # Some functions return object that are not of type 'Task' when the job completed successfully
-        if not isinstance(task, Task):
-            return 'SUCCEEDED'
-        # Perhaps the job completed immediately, without spawning a task
-        if task.state == 'SUCCEEDED' or task.state == 'FAILED':
-            return task.state
+        return self.__wait_for_tasks([task], count)[0]
+
+    # Wait for several independent aptly tasks, each up to a maximum of "count" minutes.
+    # The tasks are tracked together, so their run time overlaps.
+    # Return: list of task states, in the order of "tasks"
+    def __wait_for_tasks(self, tasks, count=DEFAULT_TIMEOUT_COUNT):
+        '''Wait for a set of aptly tasks running concurrently'''
         if count not in range(1, 30):
-            self.logger.error('Requested wait of % minutes is greater than 30 minutes max wait.', count)
-            return 'EINVAL'
+            self.logger.error('Requested wait of %d minutes is greater than 30 minutes max wait.', count)
+            return ['EINVAL'] * len(tasks)
         timeout_factor = os.environ.get('REPOMGR_REQ_TIMEOUT_FACTOR')
         if timeout_factor and timeout_factor.isdigit() and int(timeout_factor) != 0:
             count *= int(timeout_factor)
-        while count > 0:
-            count -= 1
-            try:
-                # Function wait_for_task_by_id will return in 60 seconds, or timeout.
-                self.aptly.tasks.wait_for_task_by_id(task.id)
-            except Exception as e:
-                if count > 0:
-                    self.logger.debug('Aptly task %d(%s) is still running' % (task.id, task.name))
-                else:
-                    self.logger.debug('%s' % e)
-                continue
+        states = []
+        for task in tasks:
+            # Some functions return object that are not of type 'Task' when the job completed successfully
+            if not isinstance(task, Task):
+                states.append('SUCCEEDED')
+            # Perhaps the job completed immediately, without spawning a task
+            elif task.state == 'SUCCEEDED' or task.state == 'FAILED':
+                states.append(task.state)
             else:
-                # return 'SUCCEEDED' or 'FAILED'
-                return self.aptly.tasks.show(task.id).state
-        self.logger.warn('Aptly task %d(%s) timeouts.' % (task.id, task.name))
-        self.logger.info('Environment variable REPOMGR_REQ_TIMEOUT_FACTOR can be used to increase timeout value.')
-        self.logger.info('For example, set it to "5" can increase the timeout value by 5 times.')
-        return 'TIMEOUTED'
+                states.append(self.tasks.track(task, count * 60))
+        states = [state.result() if isinstance(state, Future) else state for state in states]
+        if 'TIMEOUTED' in states:
+            self.logger.info('Environment variable REPOMGR_REQ_TIMEOUT_FACTOR can be used to increase timeout value.')
+            self.logger.info('For example, set it to "5" can increase the timeout value by 5 times.')
+        return states
+
+    # Run "func" of this class in the background, independent operations,
+    # for example deploying different repositories, overlap their aptly tasks.
+    # Output: Future
+    def submit(self, func, *args, **kwargs):
+        '''Run a repository operation asynchronously, return its future.'''
+        if not self.executor:
+            self.executor = ThreadPoolExecutor(max_workers=DEFAULT_TASK_JOBS)
+        return self.executor.submit(func, *args, **kwargs)
+
+    def deploy_local_async(self, name, suffix=''):
+        '''Deploy a local repository asynchronously, return its future.'''
+        return self.submit(self.deploy_local, name, suffix)
+
+    def deploy_remote_async(self, name):
+        '''Deploy a mirror asynchronously, return its future.'''
+        return self.submit(self.deploy_remote, name)
+
+    def merge_repos_async(self, name, source_snapshots):
+        '''Merge repositories asynchronously, return its future.'''
+        return self.submit(self.merge_repos, name, source_snapshots)
 
     # Publish a local repository directly, without snapshot or signature
     # If an old publish exists, drop it firstly and then create a new one.
@@ -423,29 +543,99 @@ class Deb_aptly():
                 return repo_str
         return None
 
+    # Fingerprint the upstream content a mirror is built from: the checksums,
+    # listed in the upstream Release file, of the indexes of the mirrored
+    # components and architectures. Changes to other components, or to the
+    # Date field only, do not change the fingerprint.
+    # Output: None if the upstream Release file is not available
+    def __upstream_fingerprint(self, remote):
+        '''Fingerprint the indexes of a mirror in the upstream Release file.'''
+        dists_url = '/'.join([remote.archiveurl.rstrip('/'), 'dists', remote.distribution, ''])
+        release = None
+        for release_file in ['InRelease', 'Release']:
+            try:
+                response = requests.get(dists_url + release_file, timeout=60)
+            except requests.RequestException as e:
+                self.logger.debug('Failed to get %s%s: %s', dists_url, release_file, e)
+                continue
+            if response.status_code == 200:
+                release = response.text
+                break
+        if release is None:
+            return None
+
+        release_meta = debian.deb822.Release(release)
+        components = remote.components or release_meta.get('Components', '').split()
+        architectures = remote.architectures or release_meta.get('Architectures', '').split()
+        with_sources = getattr(remote, 'download_sources', False)
+        index_dirs = []
+        for component in components:
+            index_dirs += ['%s/binary-%s/' % (component, arch) for arch in architectures + ['all']]
+            if with_sources:
+                index_dirs.append('%s/source/' % component)
+        indexes = sorted(' '.join([index['sha256'], index['name']])
+                         for index in release_meta.get('SHA256', [])
+                         if index['name'].startswith(tuple(index_dirs)))
+        # Flat repositories, or no checksum of the indexes: fall back to the whole file
+        if not indexes:
+            indexes = [hashlib.sha256(release.encode()).hexdigest()]
+        fingerprint = hashlib.sha256()
+        fingerprint.update(repr([remote.archiveurl, remote.distribution, sorted(components),
+                                 sorted(architectures), with_sources]).encode())
+        fingerprint.update('\n'.join(indexes).encode())
+        return fingerprint.hexdigest()
+
+    # Return the publication of an up to date mirror, None if it needs an update
+    def __deployed_mirror(self, name, fingerprint):
+        '''Find the publication of a mirror snapshot taken from the same upstream content.'''
+        snapshot = None
+        for snap in self.aptly.snapshots.list():
+            if snap.name == name:
+                snapshot = snap
+                break
+        if not snapshot or snapshot.description != UPSTREAM_FINGERPRINT + fingerprint:
+            return None
+        for publish in self.aptly.publish.list():
+            if publish.prefix == name:
+                return publish.prefix + ' ' + publish.distribution
+        return None
+
+    # Return the remote(mirror) called "name", or None
+    def get_remote(self, name):
+        '''Get a remote repository/mirror by name.'''
+        for remote in self.aptly.mirrors.list():
+            if remote.name == name:
+                return remote
+        return None
+
     # sync a remote mirror and deploy it
     # Input: the name of the remote
     # Output: bool
     def deploy_remote(self, name):
         '''Deploy a mirror, it will sync/update, snapshot and publish at last.
         It may take minutes, depends on the size of the mirror and the bandwidth,
+        Nothing is done if the upstream content has not changed since the last deploy.
         '''
         if not name.startswith(PREFIX_REMOTE):
             self.logger.warning('%s has no %s prefix, not a remote repository.', name, PREFIX_REMOTE)
             return None
 
-        remote_list = self.aptly.mirrors.list()
-        remote = None
-        for remote in remote_list:
-            if remote.name == name:
-                break
-
+        remote = self.get_remote(name)
         if not remote:
             self.logger.warning('mirror %s not find, please create it firstly.', name)
             return None
 
+        description = None
+        fingerprint = self.__upstream_fingerprint(remote)
+        if fingerprint:
+            repo_str = self.__deployed_mirror(name, fingerprint)
+            if repo_str:
+                self.logger.info('Upstream of mirror %s is unchanged, skip updating it.', name)
+                return repo_str
+            description = UPSTREAM_FINGERPRINT + fingerprint
+
         if self.__update_mirror(name):
-            if self.__create_snapshot(name, False):
+            if self.__create_snapshot(name, False, description):
                 return self.__publish_snap(name)
         return None
 
@@ -489,10 +679,9 @@ class Deb_aptly():
 
         # find and remove related publish
         publish_list = self.aptly.publish.list()
-        for publish in publish_list:
-            if publish.prefix == name:
-                task = self.aptly.publish.drop(prefix=name, distribution=publish.distribution, force_delete=True)
-                self.__wait_for_task(task)
+        self.__wait_for_tasks([self.aptly.publish.drop(prefix=name, distribution=publish.distribution,
+                                                       force_delete=True)
+                               for publish in publish_list if publish.prefix == name])
 
         # find and remove related snapshot
         snap_list = self.aptly.snapshots.list()
@@ -623,49 +812,86 @@ class Deb_aptly():
     #       pkg_name: the path-name of the deb file
     #       pkg_type: 'binary' or 'source'
     #       pkg_version: version of the deb file
-    # Output: None
+    # Output: the number of deleted packages
     def delete_pkg_local(self, local_repo, pkg_name, pkg_type, pkg_version=None):
         '''Delete a binary package from a local repository.'''
         # self.logger.debug('delete_pkg_local not supported yet.')
         if pkg_type not in {'binary', 'source'}:
             self.logger.error('package type must be one of either "binary" or "source"')
-            return
-        query = 'Name (= %s)' % pkg_name
-        if pkg_version:
-            query += ', Version (= %s)' % pkg_version
-        # If we want more detailed info, add "detailed=True, with_deps=True" for search_packages.
-        search_result = self.aptly.repos.search_packages(local_repo, query=query)
-        self.logger.debug('delete_pkg_local found %d packages.' % len(search_result))
-        for pkg in search_result:
-            if (pkg_type == 'source' and pkg.key.split()[0] == 'Psource') or \
-                (pkg_type != 'source' and pkg.key.split()[0] != 'Psource'):
-                task = self.aptly.repos.delete_packages_by_key(local_repo, pkg.key)
-                task_state = self.__wait_for_task(task)
-                if task_state != 'SUCCEEDED':
-                    self.logger.warning('Delete package failed %s : %s' % (pkg_name, task_state))
+            return 0
+        del_keys = [key for key in self.iter_pkgs(local_repo, pkg_query(pkg_name, pkg_version))
+                    if (pkg_type == 'source') == (key.split()[0] == 'Psource')]
+        self.logger.debug('delete_pkg_local found %d packages.' % len(del_keys))
+        if del_keys:
+            task_state = self.__change_pkg_keys(local_repo, del_keys, delete=True)
+            if task_state:
+                self.logger.warning('Delete package failed %s : %s' % (pkg_name, task_state))
+        return len(del_keys)
 
-    def pkg_list(self, repo_list):
-        '''list packages available from any of the listed repos, local or remote.'''
-        pkg_list=[]
-        for repo_name in repo_list:
+    # Delete packages of a local repository by their aptly keys, in batches
+    # Output: True if all deleted
+    def delete_pkg_keys(self, local_repo, pkg_keys):
+        '''Delete packages from a local repository by package keys.'''
+        task_state = self.__change_pkg_keys(local_repo, list(pkg_keys), delete=True)
+        if task_state:
+            self.logger.warning('Delete packages from %s failed: %s' % (local_repo, task_state))
+            return False
+        return True
+
+    # Check whether a local repository or a remote(mirror) exists, without listing all of them
+    def repo_exist(self, repo_name):
+        '''Check whether a local repository or mirror exists.'''
+        try:
             if repo_name.startswith(PREFIX_LOCAL):
-                query = 'Name'
-                pkgs_raw = self.aptly.repos.search_packages(repo_name, query=query)
-                pkgs_key = [pkg.key for pkg in pkgs_raw]
+                self.aptly.repos.show(repo_name)
             elif repo_name.startswith(PREFIX_REMOTE):
-                pkgs_key = self.aptly.mirrors.list_packages(repo_name)
-            for key in pkgs_key:
-                if isinstance(key, Package):
-                    key = key.key
-                pkg_name = key.split()[1]
-                pkg_ver = key.split()[2]
-                pkg_arch = key.split()[0][1:]
+                self.aptly.mirrors.show(repo_name)
+            else:
+                return False
+        except AptlyAPIException as e:
+            # Other errors (connection, server) must not look like a missing repo
+            if e.status_code != 404:
+                raise
+            self.logger.debug('Repository %s: %s', repo_name, e)
+            return False
+        return True
+
+    # Iterate the package keys of a local repository or a remote(mirror)
+    # query: aptly package query, see pkg_query(). None means all packages.
+    # The aptly REST API does not page package lists, the whole (filtered)
+    # list is received before the first key is returned.
+    def iter_pkgs(self, repo_name, query=None):
+        '''Iterate the package keys of a repository, filtered by aptly.'''
+        if repo_name.startswith(PREFIX_LOCAL):
+            pkgs = self.aptly.repos.search_packages(repo_name, query=query or 'Name')
+        elif repo_name.startswith(PREFIX_REMOTE):
+            if query:
+                pkgs = self.aptly.mirrors.list_packages(repo_name, query=query)
+            else:
+                pkgs = self.aptly.mirrors.list_packages(repo_name)
+        else:
+            return
+        for pkg in pkgs:
+            if isinstance(pkg, Package):
+                pkg = pkg.key
+            yield pkg
+
+    # Iterate package file names: name_version_arch.deb or name_version.dsc
+    def iter_pkg_files(self, repo_list, query=None):
+        '''Iterate packages available from any of the listed repos, local or remote.'''
+        for repo_name in repo_list:
+            for key in self.iter_pkgs(repo_name, query):
+                # 0: pkg_arch  1: pkg_name  2: pkg_version
+                pkg_arch, pkg_name, pkg_ver = key.split()[0:3]
+                pkg_arch = pkg_arch[1:]
                 if pkg_arch == 'source':
-                    pkg_list.append("%s_%s.dsc" % (pkg_name, pkg_ver))
+                    yield "%s_%s.dsc" % (pkg_name, pkg_ver)
                 else:
-                    pkg_list.append("%s_%s_%s.deb" % (pkg_name, pkg_ver, pkg_arch))
-        return pkg_list
+                    yield "%s_%s_%s.deb" % (pkg_name, pkg_ver, pkg_arch)
 
+    def pkg_list(self, repo_list, query=None):
+        '''list packages available from any of the listed repos, local or remote.'''
+        return list(self.iter_pkg_files(repo_list, query))
 
     # Search a package in a set of repos, return True if find, or False
     # repolist: a list of repo names, including local repo and mirror
@@ -674,35 +900,49 @@ class Deb_aptly():
     # pkg_version:  the version of the package, None means version insensitive
     def pkg_exist(self, repo_list, pkg_name, architecture, pkg_version=None):
         '''Search a package in a bundle of repositories including local repo and remote one.'''
+        query = pkg_query(pkg_name, pkg_version)
         for repo_name in repo_list:
-            if repo_name.startswith(PREFIX_LOCAL):
-                if not pkg_version:
-                    query = pkg_name
-                else:
-                    query = pkg_name + ' (' + pkg_version + ')'
-                # If we want more detailed info, add "detailed=True, with_deps=True" for search_packages.
-                search_result = self.aptly.repos.search_packages(repo_name, query=query)
-                for pkg in search_result:
-                    if architecture != 'source' and pkg.key.split()[0] != 'Psource':
-                        self.logger.debug('pkg_exist find package %s in %s.', pkg_name, repo_name)
-                        return True
-                    if architecture == 'source' and pkg.key.split()[0] == 'Psource':
-                        self.logger.debug('pkg_exist find package %s in %s.', pkg_name, repo_name)
-                        return True
-            elif repo_name.startswith(PREFIX_REMOTE):
-                pkgs = self.aptly.mirrors.list_packages(repo_name)
-                for pkg in pkgs:
-                    if isinstance(pkg, Package):
-                        pkg = pkg.key
-                    if pkg.split()[1] == pkg_name:
-                        if architecture != 'source' and pkg.split()[0] != 'Psource' and (not pkg_version or pkg_version == pkg.split()[2]):
-                            self.logger.debug('pkg_exist found package %s in %s.', pkg_name, repo_name)
-                            return True
-                        if architecture == 'source' and pkg.split()[0] == 'Psource' and (not pkg_version or pkg_version == pkg.split()[2]):
-                            self.logger.debug('pkg_exist found package %s in %s.', pkg_name, repo_name)
-                            return True
+            for key in self.iter_pkgs(repo_name, query):
+                if (architecture == 'source') == (key.split()[0] == 'Psource'):
+                    self.logger.debug('pkg_exist found package %s in %s.', pkg_name, repo_name)
+                    return True
         return False
 
+    # List the package keys of a local repository or a mirror
+    # names: only list packages with these names, filtered by aptly. None means all packages.
+    # Output: list of package keys
+    def __list_pkg_keys(self, repo_name, local, names=None):
+        '''List package keys of a repository, optionally filtered on the server by package name.'''
+        queries = ['Name']
+        if names is not None:
+            names = sorted(names)
+            queries = [' | '.join(['Name (= %s)' % pkg for pkg in names[i:i + PKG_QUERY_CHUNK]])
+                       for i in range(0, len(names), PKG_QUERY_CHUNK)]
+        pkg_keys = []
+        for query in queries:
+            if local:
+                pkgs = self.aptly.repos.search_packages(repo_name, query=query)
+            elif names is None:
+                pkgs = self.aptly.mirrors.list_packages(repo_name)
+            else:
+                pkgs = self.aptly.mirrors.list_packages(repo_name, query=query)
+            pkg_keys.extend(pkg.key if isinstance(pkg, Package) else pkg for pkg in pkgs)
+        return pkg_keys
+
+    # Add or delete package keys of a local repository, PKG_REFS_CHUNK keys per aptly task
+    # Output: None or the failed task state
+    def __change_pkg_keys(self, repo_name, pkg_keys, delete=False):
+        '''Add or delete packages of a local repository in chunks.'''
+        for i in range(0, len(pkg_keys), PKG_REFS_CHUNK):
+            if delete:
+                task = self.aptly.repos.delete_packages_by_key(repo_name, *pkg_keys[i:i + PKG_REFS_CHUNK])
+            else:
+                task = self.aptly.repos.add_packages_by_key(repo_name, *pkg_keys[i:i + PKG_REFS_CHUNK])
+            task_state = self.__wait_for_task(task)
+            if task_state != 'SUCCEEDED':
+                return task_state
+        return None
+
     # Copy a set of packages from one repository into another
     # source: the repository name that packages been copied from
     # dest: the repository name that packages been copied to
@@ -711,81 +951,66 @@ class Deb_aptly():
     # overwrite: True or False. Overwrite existing packages or not
     def copy_pkgs(self, source, dest, pkg_list, pkg_type='binary', overwrite=True):
         '''Copy package from one repository to another local repository'''
-        dest_exist = False
-        source_exist = False
-        # package key list of destination and source repository
-        dest_pkg_keys = list()
-        src_pkg_keys = list()
         if source == dest:
             self.logger.error('%s and %s are the same repository.' % (source, dest))
             return False
-        for repo in self.aptly.repos.list():
-            if dest == repo.name:
-                dest_exist = True
-                pkgs = self.aptly.repos.search_packages(dest, query='Name')
-                dest_pkg_keys = [pkg.key for pkg in pkgs]
-            if source == repo.name:
-                source_exist = True
-                pkgs = self.aptly.repos.search_packages(source, query='Name')
-                src_pkg_keys = [pkg.key for pkg in pkgs]
-        if not dest_exist:
+        local_repos = set(repo.name for repo in self.aptly.repos.list())
+        if dest not in local_repos:
             self.logger.warning('Destination repository %s does not exist.', dest)
             return False
-        if not source_exist:
-            for repo in self.aptly.mirrors.list():
-                if source == repo.name:
-                    source_exist = True
-                    src_pkg_keys = self.aptly.mirrors.list_packages(source)
-                    break
-        if not source_exist:
+        source_local = source in local_repos
+        if not source_local and source not in set(repo.name for repo in self.aptly.mirrors.list()):
             self.logger.warning('Source repository %s dose not exist.', source)
             return False
+
+        # Let aptly filter a few packages, list all packages for bulk copies
+        pkg_names = set(pkg_list)
+        query_names = pkg_names if len(pkg_names) <= PKG_QUERY_CHUNK else None
+        src_pkg_keys = self.__list_pkg_keys(source, source_local, query_names)
+        dest_pkg_keys = self.__list_pkg_keys(dest, True, query_names)
+        dest_key_set = set(dest_pkg_keys)
+        # dest_pkg_index[(package type/arch, package name)] = first package key in destination
+        dest_pkg_index = dict()
+        for dest_key in dest_pkg_keys:
+            dest_pkg_index.setdefault(tuple(dest_key.split()[0:2]), dest_key)
+
         del_keys = list()
         add_keys = list()
+        pkg_found = set()
         for key in src_pkg_keys:
-            if isinstance(key, Package):
-                key = key.key
-            package_name = key.split()[1]
-            package_type = key.split()[0]
-            if package_name not in pkg_list:
+            # [0] package type/arch: Psource, Pamd64, Pall. [1] package name
+            package_type, package_name = key.split()[0:2]
+            if package_name not in pkg_names or package_name in pkg_found:
                 continue
             if (pkg_type == 'source' and package_type != 'Psource') or (pkg_type == 'binary' and package_type == 'Psource'):
                 continue
             # Find a package in source repository to be copied.
-            pkg_list.remove(package_name)
+            pkg_found.add(package_name)
             # Already exists in destination repository
-            if key in dest_pkg_keys:
+            if key in dest_key_set:
                 continue
-            pkg_in_dest = False
-            for dest_key in dest_pkg_keys:
-                # [0] package type/arch: Psource, Pamd64, Pall. [1] package name
-                if package_type == dest_key.split()[0] and package_name == dest_key.split()[1]:
-                    pkg_in_dest = True
-                    if overwrite:
-                        del_keys.append(dest_key)
-                        add_keys.append(key)
-                    break
-            if not pkg_in_dest:
+            dest_key = dest_pkg_index.get((package_type, package_name))
+            if not dest_key:
+                add_keys.append(key)
+            elif overwrite:
+                del_keys.append(dest_key)
                 add_keys.append(key)
-            if not pkg_list:
-                break
 
         # check to see if any packages not find in source repository
-        if pkg_list:
-            self.logger.warning('Copy package error, %s package %s not exist in %s' % (pkg_type, ' '.join(pkg_list), source))
+        pkg_missing = [pkg for pkg in pkg_list if pkg not in pkg_found]
+        if pkg_missing:
+            self.logger.warning('Copy package error, %s package %s not exist in %s' % (pkg_type, ' '.join(pkg_missing), source))
             return False
         # Remove duplicate packages from destination repository
         if del_keys:
-            task = self.aptly.repos.delete_packages_by_key(dest, *del_keys)
-            task_state = self.__wait_for_task(task)
-            if task_state != 'SUCCEEDED':
+            task_state = self.__change_pkg_keys(dest, del_keys, delete=True)
+            if task_state:
                 self.logger.warning('Delete packages failed: %s\n%s' % (task_state, '\n'.join(del_keys)))
                 return False
         # Insert packages into destination repository
         if add_keys:
-            task = self.aptly.repos.add_packages_by_key(dest, *add_keys)
-            task_state = self.__wait_for_task(task)
-            if task_state != 'SUCCEEDED':
+            task_state = self.__change_pkg_keys(dest, add_keys)
+            if task_state:
                 self.logger.warning('Copy packages failed: %s\n%s' % (task_state, '\n'.join(add_keys)))
                 return False
         return True
@@ -845,18 +1070,21 @@ class Deb_aptly():
             return None
 
         # find and remove related publish
+        # The publications are independent, drop them concurrently
+        drop_tasks = []
         publish_list = self.aptly.publish.list()
         for publish in publish_list:
             # Remove all related publish including quick publish
             if publish.prefix.startswith(name + '-') or publish.prefix == name:
                 try:
-                    task = self.aptly.publish.drop(prefix=publish.prefix, distribution=DEBIAN_DISTRIBUTION, force_delete=True)
-                    task_state = self.__wait_for_task(task)
-                    if task_state != 'SUCCEEDED':
-                        self.logger.warning('Drop publish failed %s : %s', name, task_state)
+                    drop_tasks.append(self.aptly.publish.drop(prefix=publish.prefix, distribution=DEBIAN_DISTRIBUTION,
+                                                              force_delete=True))
                 except Exception as e:
                     self.logger.warning('Drop publish %s/%s: %s (ignored)',
                                         publish.prefix, DEBIAN_DISTRIBUTION, e)
+        for task_state in self.__wait_for_tasks(drop_tasks):
+            if task_state != 'SUCCEEDED':
+                self.logger.warning('Drop publish failed %s : %s', name, task_state)
 
         # find and remove related snapshot
         snap_list = self.aptly.snapshots.list()
@@ -887,39 +1115,40 @@ class Deb_aptly():
     # database. Please use it carefully.
     def clean_all(self):
         '''Clean all metadata including remote, repository, public, distribution, task and content.'''
+        # Objects of a kind are independent, drop each kind concurrently
         # clean publishes
         pub_list = self.aptly.publish.list()
         self.logger.info('%d publish', len(pub_list))
+        tasks = []
         for pub in pub_list:
             self.logger.info('Drop publish %s : %s', pub.prefix, pub.distribution)
-            task = self.aptly.publish.drop(prefix=pub.prefix, distribution=pub.distribution, force_delete=True)
-            task_state = self.__wait_for_task(task)
+            tasks.append(self.aptly.publish.drop(prefix=pub.prefix, distribution=pub.distribution, force_delete=True))
+        for pub, task_state in zip(pub_list, self.__wait_for_tasks(tasks)):
             if task_state != 'SUCCEEDED':
                 self.logger.warning('Drop publish failed %s : %s', pub.prefix, task_state)
         # clean snapshots
         snap_list = self.aptly.snapshots.list()
         self.logger.info('%d snapshot', len(snap_list))
+        tasks = []
         for snap in snap_list:
             self.logger.info('Drop snapshot %s', snap.name)
-            task = self.aptly.snapshots.delete(snapshotname=snap.name, force=True)
-            task_state = self.__wait_for_task(task)
+            tasks.append(self.aptly.snapshots.delete(snapshotname=snap.name, force=True))
+        for snap, task_state in zip(snap_list, self.__wait_for_tasks(tasks)):
             if task_state != 'SUCCEEDED':
                 self.logger.warning('Drop snapshot failed %s : %s', snap.name, task_state)
 
         # clean mirrors
         mirror_list = self.aptly.mirrors.list()
         self.logger.info('%d mirror', len(mirror_list))
-        for mirror in mirror_list:
-            task = self.aptly.mirrors.drop(name=mirror.name, force=True)
-            task_state = self.__wait_for_task(task)
+        tasks = [self.aptly.mirrors.drop(name=mirror.name, force=True) for mirror in mirror_list]
+        for mirror, task_state in zip(mirror_list, self.__wait_for_tasks(tasks)):
             if task_state != 'SUCCEEDED':
                 self.logger.warning('Drop mirror failed %s : %s', mirror.name, task_state)
         # clean local repos
         repo_list = self.aptly.repos.list()
         self.logger.info('%d repo', len(repo_list))
-        for repo in repo_list:
-            task = self.aptly.repos.delete(reponame=repo.name, force=True)
-            task_state = self.__wait_for_task(task)
+        tasks = [self.aptly.repos.delete(reponame=repo.name, force=True) for repo in repo_list]
+        for repo, task_state in zip(repo_list, self.__wait_for_tasks(tasks)):
             if task_state != 'SUCCEEDED':
                 self.logger.warning('Drop repo failed %s : %s', repo.name, task_state)
         # clean file folders
@@ -17,6 +17,7 @@ import apt_pkg
 import debian.deb822
 from debian.debian_support import BaseVersion
 import discovery
+import dl_cache
 import git
 import hashlib
 import logging
@@ -28,6 +29,7 @@ import subprocess
 import sys
 import tempfile
 import utils
+from file_utils import clone_file, link_file
 from utils import run_shell_cmd, run_shell_cmd_full, get_download_url
 import yaml
 
@@ -228,6 +230,50 @@ def download(url, savepath, logger):
     return True
 
 
+def detach_file(path):
+    '''
+    Remove path before it is rewritten in place: a staged file may be a
+    hardlink into the local mirror which must never be modified
+    '''
+    if os.path.lexists(path) and not os.path.isdir(path):
+        os.remove(path)
+
+
+def stage_tree(src, dst, logger, hardlink=False, follow_symlinks=False):
+    '''
+    Stage the directory src as dst (merged into dst if it exists), like
+    `cp -r src dst` or `cp -rL` if follow_symlinks is set, but in O(files):
+    hardlink: files are hardlinked, only for trees whose files are never
+              modified in place afterwards (see detach_file)
+    otherwise: files are reflinked where supported, else copied
+    '''
+    src = os.path.abspath(src)
+    os.makedirs(dst, exist_ok=True)
+    for root, dirs, files in os.walk(src, followlinks=follow_symlinks):
+        dst_root = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(dst_root, exist_ok=True)
+        for name in list(dirs):
+            if not follow_symlinks and os.path.islink(os.path.join(root, name)):
+                # Not descended by os.walk, recreate the link itself
+                dirs.remove(name)
+                files.append(name)
+        for name in files:
+            src_file = os.path.join(root, name)
+            dst_file = os.path.join(dst_root, name)
+            if os.path.islink(src_file) and not follow_symlinks:
+                detach_file(dst_file)
+                os.symlink(os.readlink(src_file), dst_file)
+            elif os.path.isfile(src_file):
+                if hardlink:
+                    link_file(os.path.realpath(src_file), dst_file)
+                else:
+                    detach_file(dst_file)
+                    clone_file(src_file, dst_file)
+            else:
+                # Special files, dangling symlinks: leave them to cp
+                run_shell_cmd('cp -a %s %s' % (src_file, dst_file), logger)
+
+
 def is_git_repo(path):
     try:
         _ = git.Repo(path).git_dir
@@ -292,6 +338,7 @@ class Parser():
         self.versions = dict()
         self.pkginfo = dict()
         self.dsc_sha256 = None
+        self.dl_cache = dl_cache.DownloadCache(self.logger)
 
         self.revision_ignore = revision_ignore
 
@@ -637,6 +684,7 @@ class Parser():
                         cmd += '-C %s'
                     run_shell_cmd("mkdir -p %s" % dir_name, self.logger)
                     run_shell_cmd(cmd % (dl_path, dir_name), self.logger)
+                    detach_file(dl_path)
                     run_shell_cmd(cmdc % (dl_path, dir_name), self.logger)
 
                 run_shell_cmd('cp -rL %s %s' % (dl_path, self.pkginfo["srcdir"]),
@@ -780,6 +828,7 @@ class Parser():
 
         srcname = os.path.basename(self.pkginfo["srcdir"])
         origtargz = self.pkginfo["debname"] + '_' + self.versions["upstream_version"] + '.orig.tar.gz'
+        detach_file(os.path.join(self.pkginfo["packdir"], origtargz))
         run_shell_cmd('cd %s; tar czf %s %s' % (self.pkginfo["packdir"], origtargz, srcname), self.logger)
 
     def create_src_package(self):
@@ -789,7 +838,8 @@ class Parser():
             os.mkdir(self.pkginfo["srcdir"])
         else:
             # cp the .git folder, the git meta files in .git are symbol link, so need -L
-            run_shell_cmd('cp -rL %s %s' % (src_path, self.pkginfo["srcdir"]), self.logger)
+            # The tree is modified afterwards, so reflink/copy instead of hardlink
+            stage_tree(src_path, self.pkginfo["srcdir"], self.logger, follow_symlinks=True)
 
         self.copy_custom_files()
         self.create_orig_tarball()
@@ -822,6 +872,67 @@ class Parser():
         self.update_deb_folder()
         self.apply_deb_patches()
 
+    def fetch_dl_file(self, dl_file, dl_file_info):
+        url = dl_file_info['url']
+        if "sha256sum" in dl_file_info:
+            check_cmd = "sha256sum"
+            check_sum = dl_file_info['sha256sum']
+        else:
+            self.logger.warning(f"{dl_file} missing sha256sum")
+            check_cmd = "md5sum"
+            check_sum = dl_file_info['md5sum']
+        if checksum(dl_file, check_sum, check_cmd, self.logger):
+            return
+
+        # Only sha256sum is usable as the key of the download cache
+        if check_cmd == "sha256sum" and self.dl_cache.place(check_sum, dl_file):
+            if checksum(dl_file, check_sum, check_cmd, self.logger):
+                return
+            self.logger.warning("Discard corrupted %s from the download cache", dl_file)
+            self.dl_cache.discard(check_sum)
+
+        (dl_url, alt_dl_url) = get_download_url(url, self.strategy)
+        if alt_dl_url:
+            try:
+                download(dl_url, dl_file, self.logger)
+            except:
+                download(alt_dl_url, dl_file, self.logger)
+        else:
+            download(dl_url, dl_file, self.logger)
+        if not checksum(dl_file, check_sum, check_cmd, self.logger):
+            raise Exception(f'Failed to download {dl_file}')
+        if check_cmd == "sha256sum":
+            self.dl_cache.add(dl_file, check_sum)
+
+    def place_dsc_files(self, dsc_filename):
+        '''
+        Place the dsc file and its members from the download cache,
+        the dsc file is only looked up when dsc_sha256 is known.
+        '''
+        if not self.dl_cache.enabled or not self.dsc_sha256:
+            return None
+        if not self.dl_cache.place(self.dsc_sha256, dsc_filename):
+            return None
+        with open(dsc_filename) as f:
+            dsc = debian.deb822.Dsc(f)
+        for member in dsc.get('Checksums-Sha256', []):
+            if not self.dl_cache.place(member['sha256'], member['name']):
+                return None
+        dsc_member_files = verify_dsc_file(dsc_filename, self.dsc_sha256, logger=self.logger)
+        if dsc_member_files:
+            self.logger.info("%s: placed from the download cache", dsc_filename)
+        return dsc_member_files
+
+    def cache_dsc_files(self, dsc_filename, dsc_member_files):
+        if not self.dl_cache.enabled or not self.dsc_sha256:
+            return
+        self.dl_cache.add(dsc_filename, self.dsc_sha256)
+        with open(dsc_filename) as f:
+            dsc = debian.deb822.Dsc(f)
+        for member in dsc.get('Checksums-Sha256', []):
+            if member['name'] in dsc_member_files:
+                self.dl_cache.add(member['name'], member['sha256'])
+
     def download(self, pkgpath, mirror):
 
         rel_used_dl_files = []
@@ -840,50 +951,12 @@ class Parser():
         os.chdir(saveto)
         if "dl_files" in self.meta_data:
             for dl_file in self.meta_data['dl_files']:
-                dl_file_info = self.meta_data['dl_files'][dl_file]
-                url = dl_file_info['url']
-                if "sha256sum" in dl_file_info:
-                    check_cmd = "sha256sum"
-                    check_sum = dl_file_info['sha256sum']
-                else:
-                    self.logger.warning(f"{dl_file} missing sha256sum")
-                    check_cmd = "md5sum"
-                    check_sum = dl_file_info['md5sum']
-                if not checksum(dl_file, check_sum, check_cmd, self.logger):
-                    (dl_url, alt_dl_url) = get_download_url(url, self.strategy)
-                    if alt_dl_url:
-                        try:
-                            download(dl_url, dl_file, self.logger)
-                        except:
-                            download(alt_dl_url, dl_file, self.logger)
-
-                    else:
-                        download(dl_url, dl_file, self.logger)
-                    if not checksum(dl_file, check_sum, check_cmd, self.logger):
-                        raise Exception(f'Fail to download {dl_file}')
+                self.fetch_dl_file(dl_file, self.meta_data['dl_files'][dl_file])
                 rel_used_dl_files.append(dl_file)
 
         if "dl_path" in self.meta_data:
             dl_file = self.meta_data["dl_path"]["name"]
-            url = self.meta_data["dl_path"]["url"]
-            if "sha256sum" in self.meta_data["dl_path"]:
-                check_cmd = "sha256sum"
-                check_sum = self.meta_data["dl_path"]['sha256sum']
-            else:
-                self.logger.warning(f"{dl_file} missing sha256sum")
-                check_cmd = "md5sum"
-                check_sum = self.meta_data["dl_path"]['md5sum']
-            if not checksum(dl_file, check_sum, check_cmd, self.logger):
-                (dl_url, alt_dl_url) = get_download_url(url, self.strategy)
-                if alt_dl_url:
-                    try:
-                        download(dl_url, dl_file, self.logger)
-                    except:
-                        download(alt_dl_url, dl_file, self.logger)
-                else:
-                    download(dl_url, dl_file, self.logger)
-                if not checksum(dl_file, check_sum, check_cmd, self.logger):
-                    raise Exception(f'Failed to download {dl_file}')
+            self.fetch_dl_file(dl_file, self.meta_data["dl_path"])
             rel_used_dl_files.append(dl_file)
 
         elif "archive" in self.meta_data:
@@ -891,6 +964,8 @@ class Parser():
             dsc_filename = self.pkginfo["debname"] + "_" + ver + ".dsc"
 
             dsc_member_files = verify_dsc_file(dsc_filename, self.dsc_sha256, logger=self.logger)
+            if not dsc_member_files:
+                dsc_member_files = self.place_dsc_files(dsc_filename)
             if not dsc_member_files:
                 self.logger.info ('%s: file not found, or integrity verification failed; (re-)downloading...', dsc_filename)
 
@@ -919,6 +994,8 @@ class Parser():
                     if not dsc_member_files:
                         raise Exception('%s: %s: DSC file verification failed' % (self.meta_data_file, dsc_filename))
 
+                    self.cache_dsc_files(dsc_filename, dsc_member_files)
+
                     # move downloaded files into place
                     run_shell_cmd('find "%s" -mindepth 1 -maxdepth 1 -exec mv -f -t "%s" "{}" "+"' % (dl_dir, saveto), self.logger)
                     run_shell_cmd('rmdir "%s"' % dl_dir, self.logger)
@@ -940,6 +1017,8 @@ class Parser():
             # See also comments in the "archive" section above.
 
             dsc_member_files = verify_dsc_file(dsc_filename, self.dsc_sha256, logger=self.logger)
+            if not dsc_member_files:
+                dsc_member_files = self.place_dsc_files(dsc_filename)
             if not dsc_member_files:
                 self.logger.info ('%s: file not found, or integrity verification failed; (re-)downloading...', dsc_filename)
 
@@ -975,6 +1054,8 @@ class Parser():
                     if not dsc_member_files:
                         raise Exception('%s: %s: DSC file verification failed' % (self.meta_data_file, dsc_filename))
 
+                    self.cache_dsc_files(dsc_filename, dsc_member_files)
+
                     # move downloaded files into place
                     run_shell_cmd('find "%s" -mindepth 1 -maxdepth 1 -exec mv -t "%s" "{}" "+"' % (dl_dir, saveto), self.logger)
                     run_shell_cmd('rmdir "%s"' % dl_dir, self.logger)
@@ -1018,7 +1099,10 @@ class Parser():
 
         sources = os.path.join(mirror, self.pkginfo["pkgname"])
         if os.path.exists(sources):
-            run_shell_cmd('cp -r %s %s' % (sources, self.basedir), self.logger)
+            # The mirror files are only read, or detached before being rewritten.
+            # dl_hook is free to do anything in packdir, so it gets copies.
+            stage_tree(sources, self.pkginfo["packdir"], self.logger,
+                       hardlink="dl_hook" not in self.meta_data)
 
         if "dl_hook" in self.meta_data:
             self.run_dl_hook()
@@ -1047,6 +1131,12 @@ class Parser():
         # strip epoch
         ver = ver.split(":")[-1]
 
+        # dpkg-source rewrites its outputs in place, detach any staged one
+        for f in os.listdir(self.pkginfo["packdir"]):
+            if f.startswith(src + "_" + ver + ".") or f.startswith(src + "_" + ver + "_"):
+                if ".orig." not in f:
+                    detach_file(os.path.join(self.pkginfo["packdir"], f))
+
         # Skip building(-S) and skip checking dependence(-d)
         run_shell_cmd('cd %s; dpkg-buildpackage -nc -us -uc -S -d' % self.pkginfo["srcdir"], self.logger)
 
@@ -1059,9 +1149,10 @@ class Parser():
         for f in c['Files']:
             files.append(f['name'])
 
+        # The outputs are never modified once created, share them with self.output
         for f in files:
             source = os.path.join(self.pkginfo["packdir"], f)
-            run_shell_cmd('cp -Lr %s %s' % (source, self.output), self.logger)
+            link_file(os.path.realpath(source), os.path.join(self.output, f))
 
         self.logger.removeHandler(logfile_handler)
 
@@ -33,18 +33,23 @@ def get_pkg_by_deb(clue, debname, logger):
     return None
 
 
-def get_subdebs(clue, package, logger):
+def load_subdebs(clue, logger):
+    """
+    Load the whole debs clue, a dict of source package to its subdebs
+    """
     try:
         with open(clue, 'rb') as fclue:
             try:
-                debs = pickle.load(fclue)
-                if package in debs.keys():
-                    return debs[package]
+                return pickle.load(fclue)
             except (EOFError, ValueError, AttributeError, ImportError, IndexError, pickle.UnpicklingError) as e:
                 logger.warn(f"debs_entry:failed to load {clue}, return None")
     except IOError:
         logger.warn(f"debs_entry:{clue} does not exist")
-    return None
+    return {}
+
+
+def get_subdebs(clue, package, logger):
+    return load_subdebs(clue, logger).get(package)
 
 
 def set_subdebs(clue, package, debs, logger):
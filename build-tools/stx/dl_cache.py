@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright (C) 2026 Wind River Systems,Inc
+
+'''
+Content addressed store of downloaded files, shared by several workspaces.
+-)  Files are keyed by their sha256, as known from meta_data.yaml or the
+      Packages indexes, and stored as <root>/sha256/<xx>/<sha256>.
+-)  Files are placed into a workspace, and added to the store, as private
+      copies: reflinks where the filesystem supports them, plain copies
+      otherwise. A workspace never shares an inode with the store, editing
+      a placed file cannot corrupt the store.
+-)  Writes are lock free: an object is written to a private temporary
+      file and renamed into place, concurrent writers of the same object
+      write the same bytes.
+-)  The store is bounded in size, the least recently used objects are
+      evicted first. Every writer evicts once it added a fraction of the
+      size limit.
+The store is enabled by setting STX_DL_CACHE_DIR.
+'''
+
+import file_utils
+import hashlib
+import os
+import tempfile
+import threading
+
+STX_DL_CACHE_DIR = os.environ.get('STX_DL_CACHE_DIR')
+
+# Default maximum size of the store in GiB, STX_DL_CACHE_SIZE overrides it
+STX_DL_CACHE_SIZE = 100
+
+# A writer evicts after adding 1/EVICT_FRACTION of the maximum size
+EVICT_FRACTION = 16
+
+
+def get_max_size(logger):
+    '''
+    Maximum size of the store in bytes, from STX_DL_CACHE_SIZE (GiB)
+    '''
+    value = os.environ.get('STX_DL_CACHE_SIZE')
+    if value:
+        try:
+            size = int(value)
+            if size > 0:
+                return size << 30
+        except ValueError:
+            pass
+        logger.warning("dl_cache: invalid STX_DL_CACHE_SIZE '%s', use %d GiB",
+                       value, STX_DL_CACHE_SIZE)
+    return STX_DL_CACHE_SIZE << 30
+
+
+def sha256sum(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class DownloadCache():
+    def __init__(self, logger, root=STX_DL_CACHE_DIR, max_size=None):
+        self.logger = logger
+        self.root = root
+        self.max_size = max_size if max_size else get_max_size(logger)
+        # Bytes added since the last eviction
+        self.added = 0
+        self.added_lock = threading.Lock()
+        if self.root:
+            os.makedirs(os.path.join(self.root, 'sha256'), exist_ok=True)
+            os.makedirs(os.path.join(self.root, 'tmp'), exist_ok=True)
+
+    @property
+    def enabled(self):
+        return bool(self.root)
+
+    def path(self, sha256):
+        return os.path.join(self.root, 'sha256', sha256[:2], sha256)
+
+    def __clone(self, src, dst):
+        '''
+        Replace dst atomically with a private copy of src
+        '''
+        tmp = '%s.stage.%d' % (dst, os.getpid())
+        try:
+            file_utils.clone_file(src, tmp)
+            os.replace(tmp, dst)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def place(self, sha256, dest):
+        '''
+        Place the object "sha256" at "dest", return False if it is not cached.
+        The caller still verifies "dest" as if it had been downloaded.
+        '''
+        if not self.enabled or not sha256:
+            return False
+        obj = self.path(sha256.lower())
+        try:
+            self.__clone(obj, dest)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            self.logger.debug("dl_cache: failed to place %s: %s", dest, str(e))
+            return False
+        try:
+            # mtime is the LRU clock, the object may belong to another user
+            os.utime(obj)
+        except OSError as e:
+            self.logger.debug("dl_cache: failed to touch %s: %s", obj, str(e))
+        self.logger.debug("dl_cache: %s placed from the cache", dest)
+        return True
+
+    def add(self, src, sha256=None, verified=False):
+        '''
+        Insert the downloaded file "src" into the store.
+        If "sha256" is given, the file is only stored when it matches.
+        verified: the caller already checked "src" against "sha256"
+        '''
+        if not self.enabled or not os.path.isfile(src):
+            return False
+        actual = sha256.lower() if verified and sha256 else sha256sum(src)
+        if sha256 and actual != sha256.lower():
+            self.logger.warning("dl_cache: %s does not match %s, not cached", src, sha256)
+            return False
+        obj = self.path(actual)
+        if os.path.exists(obj):
+            return True
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.root, 'tmp'))
+        os.close(fd)
+        try:
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            file_utils.clone_file(src, tmp)
+            os.replace(tmp, obj)
+        except OSError as e:
+            self.logger.warning("dl_cache: failed to add %s: %s", src, str(e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        with self.added_lock:
+            self.added += os.path.getsize(obj)
+            evict = self.added >= self.max_size // EVICT_FRACTION
+            if evict:
+                self.added = 0
+        if evict:
+            self.evict()
+        return True
+
+    def discard(self, sha256):
+        '''
+        Remove a corrupted object
+        '''
+        if self.enabled and sha256:
+            try:
+                os.remove(self.path(sha256.lower()))
+            except OSError:
+                pass
+
+    def evict(self):
+        '''
+        Remove the least recently used objects until the store fits max_size
+        '''
+        if not self.enabled:
+            return 0
+        objects = []
+        total = 0
+        for root, _, files in os.walk(os.path.join(self.root, 'sha256')):
+            for name in files:
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                objects.append((st.st_mtime, st.st_size, os.path.join(root, name)))
+                total += st.st_size
+        evicted = 0
+        for mtime, size, obj in sorted(objects):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(obj)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        if evicted:
+            self.logger.info("dl_cache: evicted %d objects, %d bytes left", evicted, total)
+        return evicted
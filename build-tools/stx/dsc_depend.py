@@ -26,6 +26,7 @@ Scan a set of dsc files and get their build order
 
 import apt
 import copy
+import dsc_graph
 import os
 import re
 import shutil
@@ -60,9 +61,10 @@ def apt_copy(src, dest):
     partial_path = os.path.join(dest, "var/lib/apt/lists/partial")
     os.makedirs(partial_path, exist_ok=True)
 
-def get_aptcache():
+def update_apt_chroot():
     '''
-    `apt update` for specified Debian repositories.
+    `apt update` for specified Debian repositories inside the apt chroot,
+    this refreshes the Packages indexes of the chroot.
     '''
     try:
         stx_apt_cache.create_apt_chroot()
@@ -71,6 +73,13 @@ def get_aptcache():
         print(e)
         raise Exception('APT root dir build error')
 
+
+def get_aptcache():
+    '''
+    `apt update` for specified Debian repositories.
+    '''
+    update_apt_chroot()
+
     try:
         apt_cache = apt.Cache(rootdir=stx_apt_cache.apt_rootdir)
     except Exception as e:
@@ -975,17 +984,24 @@ class Dsc_build_order(Circular_break):
     Manage the build order of a set of dsc files.
     '''
 
-    def __init__(self, dsc_list, target_pkgs, logger, circular_conf_file=DEFAULT_CIRCULAR_CONFIG):
+    def __init__(self, dsc_list, target_pkgs, logger, circular_conf_file=DEFAULT_CIRCULAR_CONFIG,
+                 dep_graph=None):
         '''
         Construct the build relationship of all those dsc files in "dsc_list"
+        dep_graph: a prebuilt dsc_graph.DepGraph, if specified, the relationship
+                   is taken from it and no apt cache is required.
         '''
         self.logger = logger
-        self.aptcache = get_aptcache()
         self.meta_info = [dict(), dict()]
         # information from file debian/control, for runtime depend relationship:
         # self.ctl_info[A] = {B, C} Binary package A runtime depend on B and C.
         self.ctl_info = dict()
-        self.__scan_dsc_list(dsc_list)
+        if dep_graph:
+            self.aptcache = None
+            self.meta_info = dep_graph.meta_info(dsc_graph.read_dsc_list(dsc_list))
+        else:
+            self.aptcache = get_aptcache()
+            self.__scan_dsc_list(dsc_list)
         self.__recheck_target_pkgs(set(target_pkgs))
         super().__init__(logger, self.meta_info, circular_conf_file)
 
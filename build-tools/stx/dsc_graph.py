@@ -0,0 +1,374 @@
+#!/usr/bin/python3
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright (C) 2026 Wind River Systems,Inc
+
+'''
+Build the build-dependency graph of a set of dsc files without an apt chroot.
+-)  All dsc files (and their debian/control files) are parsed with deb822
+      in parallel worker processes.
+-)  Runtime relationships and "Provides" are read straight from local
+      Packages index files, plain or compressed, so it works offline.
+-)  The result is serialized into a graph file together with a fingerprint
+      of all inputs, a later run with unchanged inputs just loads it.
+'''
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from debian import deb822
+from debian import debian_support
+import glob
+import gzip
+import hashlib
+import logging
+import lzma
+import os
+import pickle
+import re
+import stx_apt_cache
+import time
+
+# Bump this whenever the layout of the serialized graph changes
+GRAPH_FORMAT_VERSION = 1
+
+# The default number of worker processes used to parse dsc/Packages files
+DEFAULT_GRAPH_JOBS = min(os.cpu_count() or 1, 16)
+
+# Packages indexes downloaded by `apt update` inside the stx apt chroot
+DEFAULT_PACKAGES_INDEXES = os.path.join(stx_apt_cache.apt_rootdir,
+                                        'var/lib/apt/lists/*_Packages*')
+
+SUBSTVAR_RE = re.compile(r'\$\{.*?\}')
+
+
+def get_packages_indexes(pattern=DEFAULT_PACKAGES_INDEXES):
+    '''
+    Return the sorted list of local Packages index files matching "pattern"
+    '''
+    return sorted(f for f in glob.glob(pattern) if not f.endswith('.diff_Index'))
+
+
+def relation_names(relation_str, skip_cross=False):
+    '''
+    Get the package names from a relationship field like "Build-Depends".
+    All alternatives of "|" are returned, version and arch qualifiers are
+    ignored, substitution variables are dropped.
+    skip_cross: ignore the relations restricted to the <cross> profile
+    '''
+    names = set()
+    relation_str = SUBSTVAR_RE.sub('', relation_str)
+    for alternatives in deb822.PkgRelation.parse_relations(relation_str):
+        for rel in alternatives:
+            if not rel['name']:
+                continue
+            if skip_cross and rel['restrictions']:
+                if any(term.enabled and term.profile == 'cross'
+                       for group in rel['restrictions'] for term in group):
+                    continue
+            names.add(rel['name'])
+    return names
+
+
+def control_file_of(dsc_file):
+    '''
+    Locate the debian/control file based on pathname of the dsc file.
+    p-p_x.y.z.dsc => p-p-x.y.z/debian/control
+    p-p_x.y-z.dsc => p-p-x.y/debian/control
+    '''
+    base_dir = os.path.dirname(dsc_file)
+    base_name = os.path.basename(dsc_file)
+    src_dir = base_name.split('_')[0] + '-' + base_name.split('_')[1].split('-')[0]
+    if src_dir.endswith('.dsc'):
+        src_dir = os.path.splitext(src_dir)[0]
+    return os.path.join(base_dir, src_dir, 'debian/control')
+
+
+def parse_dsc(dsc_file):
+    '''
+    Worker: parse one dsc file and its debian/control file.
+    Return a dict with the source name/version, the binaries it builds,
+    its direct build depends and the runtime depends from debian/control.
+    '''
+    with open(dsc_file, 'r') as fh:
+        dsc = deb822.Dsc(fh)
+    b_depends = []
+    for field in ['Build-Depends', 'Build-Depends-Indep', 'Build-Depends-Arch']:
+        if field in dsc.keys():
+            b_depends.append(dsc[field])
+    binary = set(dsc.get('Binary', '').replace(' ', '').split(','))
+    binary.discard('')
+
+    ctl_info = dict()
+    try:
+        with open(control_file_of(dsc_file), 'r') as f_ctl:
+            for ctl in deb822.Deb822.iter_paragraphs(f_ctl):
+                if 'Package' not in ctl.keys():
+                    continue
+                deps = ', '.join([ctl[f] for f in ['Depends', 'Pre-Depends'] if f in ctl.keys()])
+                depend_pkgs = relation_names(deps)
+                if depend_pkgs:
+                    ctl_info[ctl['Package']] = depend_pkgs
+    except Exception:
+        # Same as dsc_depend: a missing control file is not fatal
+        pass
+
+    return {
+        'dsc': dsc_file,
+        'source': dsc['Source'],
+        'version': dsc['Version'],
+        'binary': binary,
+        'build_depends': relation_names(', '.join(b_depends), skip_cross=True),
+        'ctl_info': ctl_info,
+    }
+
+
+def open_index(index_file):
+    if index_file.endswith('.gz'):
+        return gzip.open(index_file, 'rt'), False
+    if index_file.endswith('.xz'):
+        return lzma.open(index_file, 'rt'), False
+    return open(index_file, 'r'), True
+
+
+def parse_packages_index(index_file):
+    '''
+    Worker: read one Packages index file.
+    Return (runtime, provides):
+        runtime = {bin: (version, {bin, bin})}  Depends + Pre-Depends
+        provides = {virtual: {bin, bin}}
+    '''
+    runtime = dict()
+    provides = dict()
+    fh, use_apt_pkg = open_index(index_file)
+    with fh:
+        for para in deb822.Packages.iter_paragraphs(fh, use_apt_pkg=use_apt_pkg):
+            name = para.get('Package')
+            if not name:
+                continue
+            version = para.get('Version', '')
+            if name in runtime and debian_support.version_compare(runtime[name][0], version) >= 0:
+                continue
+            deps = ', '.join([para[f] for f in ['Depends', 'Pre-Depends'] if f in para.keys()])
+            runtime[name] = (version, relation_names(deps))
+            if 'Provides' in para.keys():
+                for virtual in relation_names(para['Provides']):
+                    provides.setdefault(virtual, set()).add(name)
+    return runtime, provides
+
+
+def fingerprint(dsc_files, index_files):
+    '''
+    Cheap fingerprint of all graph inputs, based on stat() only
+    '''
+    digest = hashlib.sha256(str(GRAPH_FORMAT_VERSION).encode())
+    inputs = set(dsc_files) | set(control_file_of(d) for d in dsc_files) | set(index_files)
+    for path in sorted(inputs):
+        try:
+            st = os.stat(path)
+            digest.update(('%s:%d:%d\n' % (path, st.st_mtime_ns, st.st_size)).encode())
+        except OSError:
+            digest.update(('%s:-\n' % path).encode())
+    return digest.hexdigest()
+
+
+class DepGraph():
+    '''
+    Build dependency graph of a set of dsc files.
+        build_bin = {dsc: {bin, bin}}       binaries built from the dsc
+        build_depends = {dsc: {bin, bin}}   direct build depends of the dsc
+        depend_on_b = {dsc: {bin, bin}}     build depends + runtime closure
+    build_bin/depend_on_b have the layout of dsc_depend's "meta_info".
+    '''
+    def __init__(self, fingerprint=None):
+        self.fingerprint = fingerprint
+        self.sources = dict()
+        self.build_bin = dict()
+        self.build_depends = dict()
+        self.depend_on_b = dict()
+
+    @staticmethod
+    def runtime_closure(bin_pkg_set, runtime, provides, ctl_info):
+        '''
+        Get all runtime depend packages of a bundle of packages
+        '''
+        pkgs_set = set(bin_pkg_set)
+        pkgs_t0 = list(pkgs_set)
+        while pkgs_t0:
+            pkg = pkgs_t0.pop()
+            deps = set(ctl_info.get(pkg, ()))
+            if pkg in runtime:
+                deps |= runtime[pkg][1]
+            elif pkg in provides:
+                # Virtual package, depends on the packages providing it
+                deps |= provides[pkg]
+            for dep in deps - pkgs_set:
+                pkgs_set.add(dep)
+                pkgs_t0.append(dep)
+        return pkgs_set
+
+    def meta_info(self, dsc_list=None):
+        '''
+        Return [build_bin, depend_on_b] for the dscs in "dsc_list", or for
+        all the dscs of the graph. The returned dicts are owned by the caller.
+        '''
+        if dsc_list is None:
+            dsc_list = self.build_bin.keys()
+        build_bin = dict()
+        depend_on_b = dict()
+        for dsc in dsc_list:
+            if dsc not in self.build_bin:
+                raise Exception('%s is not in the dependency graph' % dsc)
+            build_bin[dsc] = set(self.build_bin[dsc])
+            depend_on_b[dsc] = set(self.depend_on_b[dsc])
+        return [build_bin, depend_on_b]
+
+    def save(self, graph_file):
+        '''
+        Atomically write the graph into "graph_file"
+        '''
+        os.makedirs(os.path.dirname(os.path.abspath(graph_file)), exist_ok=True)
+        tmp_file = '%s.%d.tmp' % (graph_file, os.getpid())
+        with open(tmp_file, 'wb') as fgraph:
+            pickle.dump((GRAPH_FORMAT_VERSION, self), fgraph, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, graph_file)
+
+    @classmethod
+    def load(cls, graph_file, fprint=None):
+        '''
+        Load a graph from "graph_file", return None if it does not exist,
+        is unreadable or does not match the fingerprint "fprint"
+        '''
+        try:
+            with open(graph_file, 'rb') as fgraph:
+                version, graph = pickle.load(fgraph)
+        except Exception:
+            return None
+        if version != GRAPH_FORMAT_VERSION or not isinstance(graph, cls):
+            return None
+        if fprint and graph.fingerprint != fprint:
+            return None
+        return graph
+
+
+def build_graph(dsc_files, index_files, logger, jobs=DEFAULT_GRAPH_JOBS):
+    '''
+    Parse all dsc files and Packages indexes in parallel and create the graph
+    '''
+    dsc_files = list(dict.fromkeys(dsc_files))
+    graph = DepGraph(fingerprint(dsc_files, index_files))
+    runtime = dict()
+    provides = dict()
+    ctl_info = dict()
+
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        index_futures = [pool.submit(parse_packages_index, f) for f in index_files]
+        dsc_results = pool.map(parse_dsc, dsc_files, chunksize=8)
+
+        duplicate_pkgs = set()
+        pkg_vers = set()
+        for result in dsc_results:
+            dsc = result['dsc']
+            pkg_ver = result['source'] + '_' + result['version']
+            if pkg_ver in pkg_vers:
+                duplicate_pkgs.add(pkg_ver)
+            pkg_vers.add(pkg_ver)
+            graph.sources[dsc] = pkg_ver
+            graph.build_bin[dsc] = result['binary']
+            graph.build_depends[dsc] = result['build_depends']
+            for pkg, deps in result['ctl_info'].items():
+                ctl_info.setdefault(pkg, set()).update(deps)
+        if duplicate_pkgs:
+            logger.error('Duplicate source packages detected, please check.')
+            for pkg_ver in duplicate_pkgs:
+                logger.error('Source package: %s.' % pkg_ver)
+            raise Exception('Duplicate packages detected.')
+
+        for future in index_futures:
+            idx_runtime, idx_provides = future.result()
+            for name, entry in idx_runtime.items():
+                if name in runtime and debian_support.version_compare(runtime[name][0], entry[0]) >= 0:
+                    continue
+                runtime[name] = entry
+            for virtual, pkgs in idx_provides.items():
+                provides.setdefault(virtual, set()).update(pkgs)
+    logger.debug('Parsed %d dscs and %d Packages indexes in %.2fs',
+                 len(dsc_files), len(index_files), time.time() - start)
+
+    for dsc, deps in graph.build_depends.items():
+        graph.depend_on_b[dsc] = DepGraph.runtime_closure(deps, runtime, provides, ctl_info)
+    logger.debug('Dependency graph of %d dscs created in %.2fs',
+                 len(dsc_files), time.time() - start)
+    return graph
+
+
+def get_graph(dsc_files, graph_file, logger, index_files=None, jobs=DEFAULT_GRAPH_JOBS):
+    '''
+    Load the graph from "graph_file" if all the inputs are unchanged,
+    otherwise build it again and store it into "graph_file"
+    '''
+    if index_files is None:
+        index_files = get_packages_indexes()
+    fprint = fingerprint(dsc_files, index_files)
+    graph = DepGraph.load(graph_file, fprint)
+    if graph:
+        logger.debug('Loaded dependency graph %s', graph_file)
+        return graph
+    graph = build_graph(dsc_files, index_files, logger, jobs)
+    try:
+        graph.save(graph_file)
+    except Exception as e:
+        logger.warning('Failed to save dependency graph %s: %s', graph_file, str(e))
+    return graph
+
+
+def read_dsc_list(dsc_list_file):
+    '''
+    Return the dsc files listed in "dsc_list_file", comments ignored
+    '''
+    dsc_files = []
+    with open(dsc_list_file, 'r') as fh:
+        for line in fh:
+            dsc_file = line.strip().split('#')[0]
+            if not dsc_file:
+                continue
+            if not dsc_file.endswith('dsc'):
+                raise Exception('dsc list error, please check line: %s' % line)
+            dsc_files.append(dsc_file)
+    return dsc_files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the dependency graph of a dsc list offline")
+    parser.add_argument('dsc_list', help="File listing the dsc files, one per line")
+    parser.add_argument('graph_file', help="Where to store the serialized graph")
+    parser.add_argument('-i', '--index', action='append', default=None,
+                        help="Packages index file, repeatable. Default: %s" % DEFAULT_PACKAGES_INDEXES)
+    parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_GRAPH_JOBS,
+                        help="Number of worker processes")
+    args = parser.parse_args()
+
+    logger = logging.getLogger('dsc_graph')
+    logging.basicConfig(level=logging.DEBUG)
+    dsc_files = read_dsc_list(args.dsc_list)
+    index_files = args.index if args.index else get_packages_indexes()
+
+    start = time.time()
+    graph = build_graph(dsc_files, index_files, logger, args.jobs)
+    graph.save(args.graph_file)
+    build_time = time.time() - start
+    start = time.time()
+    DepGraph.load(args.graph_file, fingerprint(dsc_files, index_files))
+    print('build: %.3fs load: %.3fs dscs: %d indexes: %d'
+          % (build_time, time.time() - start, len(dsc_files), len(index_files)))
@@ -22,6 +22,22 @@ class DscCache():
     def __init__(self, logger, cache_file):
         self.logger = logger
         self.cache_file = cache_file
+        # Last loaded content and the (mtime, size) of the file it came from
+        self.loaded = None
+        self.loaded_stamp = None
+
+    def __read(self):
+        """
+        Load the cache file, the unpickled content is kept in memory and
+        only loaded again when the file changes
+        """
+        st = os.stat(self.cache_file)
+        stamp = (st.st_mtime_ns, st.st_size)
+        if self.loaded is None or self.loaded_stamp != stamp:
+            with open(self.cache_file, 'rb') as fcache:
+                self.loaded = pickle.load(fcache)
+            self.loaded_stamp = stamp
+        return self.loaded
 
     def get_package(self, package):
         if not os.path.exists(self.cache_file):
@@ -29,8 +45,7 @@ class DscCache():
             return None, None
 
         try:
-            with open(self.cache_file, 'rb') as fcache:
-                dsc_cache = pickle.load(fcache)
+            dsc_cache = self.__read()
         except Exception as e:
             self.logger.error(str(e))
             self.logger.error("DscCache failed to open the cache file")
@@ -47,8 +62,7 @@ class DscCache():
             return None, None
 
         try:
-            with open(self.cache_file, 'rb') as fcache:
-                dsc_cache = pickle.load(fcache)
+            dsc_cache = self.__read()
         except Exception as e:
             self.logger.error(str(e))
             self.logger.error("DscCache failed to open the cache file")
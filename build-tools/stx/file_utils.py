@@ -0,0 +1,59 @@
+# Copyright (c) 2026 Wind River Systems, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import fcntl
+import os
+import shutil
+
+# ioctl to share the data blocks of two files (reflink), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+def clone_file(src, dst):
+    '''
+    Create dst as a private copy of the regular file src. On filesystems
+    supporting reflinks (btrfs, xfs ...) the data blocks are shared copy-on-write,
+    otherwise the bytes are copied. Like `cp`, only the mode is preserved.
+    '''
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+    shutil.copymode(src, dst)
+
+
+def copy_file(src, dst):
+    '''
+    Like shutil.copy2: create dst as a private copy of the regular file src,
+    keeping its mode and times, with a reflink where possible.
+    '''
+    clone_file(src, dst)
+    shutil.copystat(src, dst)
+
+
+def link_file(src, dst):
+    '''
+    Hardlink the regular file src at dst, replacing dst atomically if it exists.
+    Fall back to copy_file when hardlinks are not possible (cross device ...)
+    '''
+    tmp = '%s.stage.%d' % (dst, os.getpid())
+    try:
+        os.link(src, tmp)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+        copy_file(src, tmp)
+    os.replace(tmp, dst)
@@ -46,6 +46,10 @@ class FetchDebs(object):
         self.setup_apt_source()
         self.debs_fetcher = repo_manage.AptFetch(logger, self.apt_src_file, self.output_dir)
 
+        # Built on first use: base list index and ISO packages
+        self.base_index = None
+        self.iso_pkgs = None
+
 
     def get_debs_clue(self, btype):
         if btype != 'rt':
@@ -56,14 +60,15 @@ class FetchDebs(object):
     def get_all_debs(self):
         all_debs = []
         failed_pkgs = []
-        debs_clue_std = self.get_debs_clue('std')
-        debs_clue_rt = self.get_debs_clue('rt')
+        # Each clue is loaded once for all the packages
+        debs_std = debsentry.load_subdebs(self.get_debs_clue('std'), logger)
+        debs_rt = debsentry.load_subdebs(self.get_debs_clue('rt'), logger)
 
         logger.debug("Binaries found for each STX source pkg:")
         for pkg in self.need_dl_stx_pkgs:
             subdebs = []
-            subdebs_std = debsentry.get_subdebs(debs_clue_std, pkg, logger)
-            subdebs_rt = debsentry.get_subdebs(debs_clue_rt, pkg, logger)
+            subdebs_std = debs_std.get(pkg)
+            subdebs_rt = debs_rt.get(pkg)
             if not subdebs_std and not subdebs_rt:
                 failed_pkgs.append(pkg)
                 continue
@@ -105,15 +110,57 @@ class FetchDebs(object):
             sys.exit(1)
 
 
-    def fetch_stx_packages(self):
-        '''
-        Download all debs and subdebs from the build system
-        Save the files to ${BUILD_ROOT}/dl_debs
-        '''
+    def get_iso_pkgs(self):
+        """
+        Set of the STX packages installed into the ISO, for all build types
+        """
+        if self.iso_pkgs is None:
+            self.iso_pkgs = set()
+            for build_type in discovery.get_all_build_types():
+                self.iso_pkgs.update(discovery.package_iso_list(build_type))
+        return self.iso_pkgs
+
+
+    def get_base_index(self):
+        """
+        Index of base-<dist_codename>.lst: package name to '<name> <version>'
+        """
+        if self.base_index is not None:
+            return self.base_index
 
+        # Example:
+        # https://opendev.org/starlingx/tools/src/branch/master/debian-mirror-tools/config/debian/bullseye/common/base-bullseye.lst
+        external_binaries_list = os.path.join(
+            self.designer_root,
+            "stx-tools",
+            "debian-mirror-tools", "config", "debian",
+            discovery.STX_DEFAULT_DISTRO_CODENAME,
+            "common",
+            "base-" + discovery.STX_DEFAULT_DISTRO_CODENAME + ".lst")
+
+        if not os.path.isfile(external_binaries_list):
+            msg = f"Could not find external binaries list: {external_binaries_list}"
+            raise Exception(msg)
+
+        self.base_index = {}
+        with open(external_binaries_list, 'r') as f:
+            for line in f:
+                fields = line.split()
+                # The first line of a package wins
+                if fields and fields[0] not in self.base_index:
+                    self.base_index[fields[0]] = ' '.join(fields[:2])
+
+        return self.base_index
+
+
+    def resolve_stx_packages(self):
+        """
+        Resolve the STX source packages to the set of '<name> <version>'
+        binaries to download
+        """
         if not self.need_dl_stx_pkgs:
             logger.warning("No STX packages to download")
-            return
+            return set()
 
         dl_debs = self.get_all_debs()
         if not dl_debs:
@@ -128,16 +175,11 @@ class FetchDebs(object):
                 dl_debs_dict[name] = version
 
         # Get list of STX packages that are installed into the ISO
-        stx_pkg_list_file = []
-        for build_type in discovery.get_all_build_types():
-            stx_pkg_list_file.extend(discovery.package_iso_list(build_type))
+        stx_pkg_list_file = self.get_iso_pkgs()
+        need_dl_stx_pkgs = set(self.need_dl_stx_pkgs)
 
-        debs_to_remove = []
-        for deb in dl_debs_dict.keys():
-            # try to find the deb in the package list
-            if deb not in stx_pkg_list_file:
-                # remove if not found in all lines
-                debs_to_remove.append(deb)
+        debs_to_remove = [deb for deb in dl_debs_dict.keys()
+                          if deb not in stx_pkg_list_file]
 
         if debs_to_remove:
             logger.debug("These binaries are not installed into the STX ISO, and so they are not included in the patch:")
@@ -145,18 +187,54 @@ class FetchDebs(object):
 
         for deb in debs_to_remove:
             # If package is explicitly in the patch recipe it should NOT be removed
-            if deb not in self.need_dl_stx_pkgs:
+            if deb not in need_dl_stx_pkgs:
                 dl_debs_dict.pop(deb)
 
         logger.info(f'STX packages selected:')
         for name,version in dl_debs_dict.items():
             logger.info('%s  %s', name, version)
 
+        return {f'{k} {v}' for k, v in dl_debs_dict.items()}
+
+
+    def resolve_external_binaries(self):
+        """
+        Resolve the third-party binary packages to the set of
+        '<name> <version>' from base-<dist_codename>.lst
+        """
+        if not self.need_dl_binary_pkgs:
+            logger.debug("No binary packages to download")
+            return set()
+
+        base_index = self.get_base_index()
+
+        # find pkgs in the list file
+        logger.debug(f'Packages to find {self.need_dl_binary_pkgs}')
+        missing = [pkg for pkg in self.need_dl_binary_pkgs if pkg not in base_index]
+        for pkg in missing:
+            logger.error(f"Package '{pkg}' not found in the package list")
+        if missing:
+            sys.exit(1)
+
+        all_debs = {base_index[pkg] for pkg in self.need_dl_binary_pkgs}
+        logger.debug('Third-party binaries to fetch:%s', all_debs)
+
+        return all_debs
+
+
+    def fetch_stx_packages(self):
+        '''
+        Download all debs and subdebs from the build system
+        Save the files to ${BUILD_ROOT}/dl_debs
+        '''
+        dl_debs = self.resolve_stx_packages()
+        if not dl_debs:
+            return
+
         dl_bin_debs_dir = os.path.join(self.output_dir, 'downloads/binary')
 
         logger.info(f'Fetching STX debs to {dl_bin_debs_dir} \n')
-        dl_debs_with_ver = [f'{k} {v}' for k, v in dl_debs_dict.items()]
-        fetch_ret = self.download(dl_debs_with_ver)
+        fetch_ret = self.download(dl_debs)
 
 
     def fetch_external_binaries(self):
@@ -164,48 +242,27 @@ class FetchDebs(object):
         Download all binaries from the build system
         apt_item = apt_item + ' '.join(['deb [trusted=yes]', repo_url + 'deb-local-binary', codename, 'main\n'])
         '''
-        # Get debs from base-<dist_codename>.lst
-        # Example:
-        # https://opendev.org/starlingx/tools/src/branch/master/debian-mirror-tools/config/debian/bullseye/common/base-bullseye.lst
-        if not self.need_dl_binary_pkgs:
-            logger.debug("No binary packages to download")
+        all_debs = self.resolve_external_binaries()
+        if not all_debs:
             return
 
-        all_debs = set()
-
-        external_binaries_list = os.path.join(
-            self.designer_root,
-            "stx-tools",
-            "debian-mirror-tools", "config", "debian",
-            discovery.STX_DEFAULT_DISTRO_CODENAME,
-            "common",
-            "base-" + discovery.STX_DEFAULT_DISTRO_CODENAME + ".lst")
+        dl_bin_debs_dir = os.path.join(self.output_dir, 'downloads/binary')
 
-        if not os.path.isfile(external_binaries_list):
-            msg = f"Could not find external binaries list: {external_binaries_list}"
-            raise Exception(msg)
+        logger.info(f'Fetching debs to {dl_bin_debs_dir} \n')
+        fetch_ret = self.download(all_debs)
 
-        # find pkgs in the list file
-        logger.debug(f'Packages to find {self.need_dl_binary_pkgs}')
-        for pkg in self.need_dl_binary_pkgs:
-            logger.debug(f'checking {pkg}')
-            with open(external_binaries_list, 'r') as f:
-                for line in f.readlines():
-                    if pkg == line.split()[0]:
-                        logger.debug(f'Line for package {pkg} found')
-                        pkg_entry = ' '.join(line.split()[:2])
-                        logger.debug(f'Adding "{pkg_entry}" to be downloaded')
-                        all_debs.add(pkg_entry)
-                        break
-                else:
-                    logger.error(f"Package '{pkg}' not found in the package list")
-                    sys.exit(1)
 
-        logger.debug('Third-party binaries to fetch:%s', all_debs)
+    def fetch_all(self):
+        '''
+        Download the STX and third-party debs of the patch in a single batch
+        '''
+        all_debs = self.resolve_stx_packages() | self.resolve_external_binaries()
+        if not all_debs:
+            return
 
         dl_bin_debs_dir = os.path.join(self.output_dir, 'downloads/binary')
 
-        logger.info(f'Fetching debs to {dl_bin_debs_dir} \n')
+        logger.info(f'Fetching {len(all_debs)} debs to {dl_bin_debs_dir} \n')
         fetch_ret = self.download(all_debs)
 
 
@@ -12,12 +12,13 @@ Class that holds the patch metadata information
 import json
 import logging
 import os
+import stat
 import sys
 sys.path.append('..')
 import utils
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
 from lxml import etree
-from xml.dom import minidom
 
 from constants import PATCH_SCRIPTS
 
@@ -102,6 +103,25 @@ class PatchMetadata(object):
     def __repr__(self):
         return self.__str__()
 
+    def __write_xml_element(self, outfile, element, indent):
+        """
+        Write an element pretty printed, in the exact format of minidom's
+        toprettyxml(indent="  "), without parsing the serialized tree again
+        :param outfile: File object to write to
+        :param element: Element without attributes, with text or children
+        :param indent: Indentation of the element
+        """
+        if len(element):
+            outfile.write(f"{indent}<{element.tag}>\n")
+            for child in element:
+                self.__write_xml_element(outfile, child, indent + "  ")
+            outfile.write(f"{indent}</{element.tag}>\n")
+        elif element.text:
+            text = escape(element.text, {'"': "&quot;"})
+            outfile.write(f"{indent}<{element.tag}>{text}</{element.tag}>\n")
+        else:
+            outfile.write(f"{indent}<{element.tag}/>\n")
+
     def __add_text_tag_to_xml(self, parent, name, text):
         """
         Utility function for adding a text tag to an XML object
@@ -114,26 +134,40 @@ class PatchMetadata(object):
         tag.text = text
         return tag
 
-    def __xml_to_dict(self, element):
+    def __xml_to_dict(self, xml_file, xml_schema):
         """
-        Converts xml into a dict
-        :param xml element
+        Converts xml into a dict, in a single pass validating the xml
+        against the schema as it is parsed
+        :param xml_file: xml file path
+        :param xml_schema: etree.XMLSchema
         """
-        if len(element) == 0:
-            return element.text.strip() if element.text else ""
-        result = {}
-        for child in element:
-            child_data = self.__xml_to_dict(child)
-            # Verify if child.tag is comment
-            if child.tag == etree.Comment:
+        # children[-1]: (tag, data) pairs of the children of the current element
+        children = []
+        result = None
+        for event, element in etree.iterparse(xml_file, events=("start", "end"),
+                                              schema=xml_schema, remove_comments=True):
+            if event == "start":
+                children.append([])
                 continue
-            if child.tag in result:
-                if isinstance(result[child.tag], list):
-                    result[child.tag].append(child_data)
-                else:
-                    result[child.tag] = [result[child.tag], child_data]
+            element_children = children.pop()
+            if not element_children:
+                data = element.text.strip() if element.text else ""
+            else:
+                data = {}
+                for tag, child_data in element_children:
+                    if tag in data:
+                        if isinstance(data[tag], list):
+                            data[tag].append(child_data)
+                        else:
+                            data[tag] = [data[tag], child_data]
+                    else:
+                        data[tag] = child_data
+            # The element is converted, drop it from the tree
+            element.clear()
+            if children:
+                children[-1].append((element.tag, data))
             else:
-                result[child.tag] = child_data
+                result = data
         return result
 
 
@@ -265,19 +299,8 @@ class PatchMetadata(object):
         the current directory, then fallback to MY_REPO_ROOT_DIR
         (ie.: /localdisk/designer/USER/PROJECT/)
         """
-        if not item:
-            # No input provided
-            return None
-
-        # Cases: Absolute path and path relative to curdir
-        candidate = os.path.abspath(item)
-        if os.path.exists(candidate):
-            return candidate
-
-        # Case: Path relative to MY_REPO_ROOT_DIR
-        parent = utils.get_env_variable('MY_REPO_ROOT_DIR')
-        candidate = os.path.join(parent, item)
-        if os.path.exists(candidate):
+        candidate = self.resolve_path(item, file_only=False)
+        if candidate or not item:
             return candidate
 
         msg = f"Extra content not found: {item}"
@@ -294,26 +317,18 @@ class PatchMetadata(object):
         """
 
         # Parse and validate the XML
+        xml_schema = etree.XMLSchema(etree.parse(INPUT_XML_SCHEMA))
         try:
-            xml_tree = etree.parse(self.patch_recipe_file)
+            xml_dict = self.__xml_to_dict(self.patch_recipe_file, xml_schema)
+        except etree.XMLSyntaxError as e:
+            logger.error("XML is not well formed or not valid against the schema. Errors:")
+            for error in e.error_log:
+                logger.error(f"Line {error.line}: {error.message}")
+            sys.exit(1)
         except Exception as e:
             logger.error(f"Error while parsing the input xml {e}")
             sys.exit(1)
-
-        root = xml_tree.getroot()
-        xml_schema = etree.XMLSchema(etree.parse(INPUT_XML_SCHEMA))
-
-        # Validate the XML against the schema
-        is_valid = xml_schema.validate(root)
-        xml_dict = {}
-        if is_valid:
-            logger.info("XML is valid against the schema.")
-            xml_dict = self.__xml_to_dict(root)
-        else:
-            logger.error("XML is not valid against the schema. Validation errors:")
-            for error in xml_schema.error_log:
-                logger.error(f"Line {error.line}: {error.message}")
-            sys.exit(1)
+        logger.info("XML is valid against the schema.")
 
         self.parse_metadata(xml_dict)
 
@@ -327,24 +342,44 @@ class PatchMetadata(object):
         (ie.: /localdisk/designer/USER/PROJECT/)
         """
 
+        candidate = self.resolve_path(script_path, file_only=True)
+        if candidate or not script_path:
+            return candidate
+
+        msg = f"Script not found: {script_path}"
+        logger.error(msg)
+        raise FileNotFoundError(msg)
+
+
+    def resolve_path(self, path, file_only):
+        """ Find the content a recipe path points to
+
+        Absolute paths and paths relative to the current directory are
+        tried first, then paths relative to MY_REPO_ROOT_DIR. Each
+        candidate is checked with a single stat.
+
+        :param path: Path from the patch recipe
+        :param file_only: Whether the path must point to a regular file
+        :return: Resolved path, None if not found or no input provided
+        """
+
         # Case: No input provided
-        if not script_path:
+        if not path:
             return None
 
         # Cases: Absolute path and path relative to curdir
-        candidate = os.path.abspath(script_path)
-        if os.path.isfile(candidate):
-            return candidate
-
         # Case: Path relative to MY_REPO_ROOT_DIR
-        parent = utils.get_env_variable('MY_REPO_ROOT_DIR')
-        candidate = os.path.join(parent, script_path)
-        if os.path.isfile(candidate):
+        for candidate in (os.path.abspath(path),
+                          os.path.join(utils.get_env_variable('MY_REPO_ROOT_DIR'), path)):
+            try:
+                st = os.stat(candidate)
+            except OSError:
+                continue
+            if file_only and not stat.S_ISREG(st.st_mode):
+                continue
             return candidate
 
-        msg = f"Script not found: {script_path}"
-        logger.error(msg)
-        raise FileNotFoundError(msg)
+        return None
 
 
     def generate_patch_metadata(self, file_path):
@@ -406,9 +441,9 @@ class PatchMetadata(object):
             self.__add_text_tag_to_xml(packages_tag, "deb", package)
 
         # Save xml
-        outfile = open(file_path, "w")
-        tree = ET.tostring(top_tag)
-        outfile.write(minidom.parseString(tree).toprettyxml(indent="  "))
+        with open(file_path, "w") as outfile:
+            outfile.write('<?xml version="1.0" ?>\n')
+            self.__write_xml_element(outfile, top_tag, "")
 
 
 if __name__ == "__main__":
@@ -32,7 +32,11 @@ import xml.etree.ElementTree as ET
 
 import constants
 import metadata
-from signing.patch_signing import sign_files
+from patch_archive import PATCH_ARCHIVE_MODE
+from patch_archive import PatchTarFile
+from signing.patch_signing import HashingReader
+from signing.patch_signing import new_data_hash
+from signing.patch_signing import sign_hash
 
 sys.path.append('..')
 import utils
@@ -87,46 +91,51 @@ class PatchEditor(object):
             raise Exception(msg)
 
 
-    # TODO: This should be in the "signing" library
-    def get_md5(self, path):
-        '''
-        Utility function for generating the md5sum of a file
-        :param path: Path to file
-        '''
-        md5 = hashlib.md5()
-        block_size = 8192
-        with open(path, 'rb') as f:
-            for chunk in iter(lambda: f.read(block_size), b''):
-                md5.update(chunk)
-        return int(md5.hexdigest(), 16)
-
-
     def run(self):
 
         tmpdir = tempfile.mkdtemp(prefix="patch_")
         os.chdir(tmpdir)
 
+        edit_metadata = self.new_metadata or self.set_release
+
+        # The patch members are streamed in a single pass. The signatures
+        # are not extracted since they are regenerated, and the metadata
+        # XML is read straight from metadata.tar when it is edited.
         logger.debug("Extracting input patch...")
-        with tarfile.open(self.patch_path, "r") as input_patch_file:
-            input_patch_file.extractall()
+        with tarfile.open(self.patch_path, "r|*") as input_patch_file:
+            for member in input_patch_file:
+                if member.name in (MD5SUM_SIGNATURE_FILENAME,
+                                   DETACHED_SIGNATURE_FILENAME):
+                    continue
+
+                if member.name == "metadata.tar" and edit_metadata:
+                    if not self.new_metadata:
+                        self.__extract_metadata_xml(
+                            input_patch_file.extractfile(member))
+                    continue
+
+                # Only plain files and directories, inside the work directory
+                name = os.path.normpath(member.name)
+                if not (member.isfile() or member.isdir()) or \
+                        os.path.isabs(name) or name == ".." or \
+                        name.startswith(".." + os.sep):
+                    logger.warning("Skipping unsafe patch member %s", member.name)
+                    continue
+                if hasattr(tarfile, "data_filter"):
+                    input_patch_file.extract(member, filter="data")
+                else:
+                    input_patch_file.extract(member)
 
         # TODO: These filenames (metadata.xml, metadata.tar) should be moved to the constants lib
 
         # Modify metadata
-        if self.new_metadata or self.set_release:
+        if edit_metadata:
 
             if self.new_metadata:
                 # Generate new metadata XML from new recipe provided
                 logger.debug("Updating metadata...")
-                os.remove("metadata.tar")
                 self.new_metadata.generate_patch_metadata("metadata.xml")
 
-            else:
-                # Extract metadata XML from input patch file
-                with tarfile.open("metadata.tar", "r") as metadata_tar:
-                    metadata_tar.extractall()
-                os.remove("metadata.tar")
-
             if self.set_release:
                 metadata.update_tag("metadata.xml", "status", "REL")
 
@@ -136,12 +145,25 @@ class PatchEditor(object):
             os.remove("metadata.xml")
 
         # Create new signatures and pack contents into a .patch file
-        os.remove(MD5SUM_SIGNATURE_FILENAME)
-        os.remove(DETACHED_SIGNATURE_FILENAME)
-
         self.__sign_and_pack(self.patch_name)
 
 
+    def __extract_metadata_xml(self, metadata_tar_file):
+        """
+        Extract metadata.xml from a metadata.tar stream
+        :param metadata_tar_file: File object of the metadata tarball
+        """
+        with tarfile.open(fileobj=metadata_tar_file, mode="r|") as metadata_tar:
+            for member in metadata_tar:
+                if member.name == "metadata.xml":
+                    metadata_tar.extract(member)
+                    return
+
+        msg = "Input patch metadata.tar does not contain metadata.xml"
+        logger.error(msg)
+        raise Exception(msg)
+
+
     # TODO: Generating the md5 signature and packing the files into a tarball
     #       should be two separate functions. We need to be able to generate
     #       generate the md5 sig function with just a list of files as input,
@@ -163,12 +185,26 @@ class PatchEditor(object):
             if os.path.exists(script_name):
                 filelist.append(script_name)
 
-        # Generate the local signature file
+        if not os.path.exists(DEFAULT_PATCH_OUTPUT_DIR):
+            os.makedirs(DEFAULT_PATCH_OUTPUT_DIR)
+        patch_full_path = os.path.join(DEFAULT_PATCH_OUTPUT_DIR, patch_file)
+        tar = PatchTarFile.open(patch_full_path, PATCH_ARCHIVE_MODE)
+
+        # The signed files are read once: while they are saved into the
+        # .patch, the same bytes feed their md5 and the detached signature
+        # hash (which covers all files, in order).
         logger.debug(f"Generating signature for patch files: {filelist}")
         sig = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
+        data_hash = new_data_hash()
         for f in filelist:
-            sig ^= self.get_md5(f)
+            logger.info(f"Saving file {f}")
+            md5 = hashlib.md5()
+            with open(f, "rb") as infile, \
+                    HashingReader(infile, [md5, data_hash]) as reader:
+                tar.addfile(tar.gettarinfo(f), reader)
+            sig ^= int(md5.hexdigest(), 16)
 
+        # Generate the local signature file
         sigfile = open(MD5SUM_SIGNATURE_FILENAME, "w")
         sigfile.write("%x" % sig)
         sigfile.close()
@@ -179,20 +215,17 @@ class PatchEditor(object):
         # Note: if cert_type requests a formal signature, but the signing key
         #    is not found, we'll instead sign with the "dev" key and
         #    need_resign_with_formal is set to True.
-        need_resign_with_formal = sign_files(
-            filelist,
+        need_resign_with_formal = sign_hash(
+            data_hash,
             DETACHED_SIGNATURE_FILENAME,
             cert_type=None)
 
         logger.info(f"Formal signing status: {need_resign_with_formal}")
 
-        # Save files into .patch
-        files = [f for f in os.listdir('.') if os.path.isfile(f)]
+        # Save the remaining files into .patch
+        files = [f for f in os.listdir('.')
+                 if os.path.isfile(f) and f not in filelist]
 
-        if not os.path.exists(DEFAULT_PATCH_OUTPUT_DIR):
-            os.makedirs(DEFAULT_PATCH_OUTPUT_DIR)
-        patch_full_path = os.path.join(DEFAULT_PATCH_OUTPUT_DIR, patch_file)
-        tar = tarfile.open(patch_full_path, "w:gz")
         for file in files:
             logger.info(f"Saving file {file}")
             tar.add(file)
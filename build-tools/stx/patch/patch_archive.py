@@ -0,0 +1,153 @@
+#
+# Copyright (c) 2026 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+'''
+Writer for .patch archives (gzip compressed tarballs)
+
+PatchTarFile.open() accepts the usual tarfile modes plus "w:pgz", which
+compresses with a block-parallel gzip encoder: the input is cut in blocks,
+each block is deflated by a worker thread (primed with the last 32K of the
+previous block, like pigz) and the blocks are written in order as a single
+standard gzip member, readable by tarfile, gzip, etc.
+'''
+import collections
+import logging
+import os
+import struct
+import sys
+import tarfile
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append('..')
+import utils
+
+
+logger = logging.getLogger('patch_archive')
+utils.set_logger(logger)
+
+# Mode used to write .patch files, "w:gz" for the single-threaded tarfile
+# compressor
+PATCH_ARCHIVE_MODE = os.environ.get('PATCH_ARCHIVE_MODE', 'w:pgz')
+
+# Size of the blocks compressed in parallel
+PGZ_BLOCK_SIZE = 1024 * 1024
+# Deflate window, each block is primed with this much of the previous one
+PGZ_DICT_SIZE = 32 * 1024
+
+
+def _deflate_block(block, zdict, level, last):
+    '''
+    Deflate a block (raw deflate, no header), ending it on a byte boundary
+    so the compressed blocks can be concatenated.
+    '''
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                      zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    flush_mode = zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    return compressor.compress(block) + compressor.flush(flush_mode)
+
+
+class ParallelGzipWriter(object):
+    '''
+    Write-only gzip file compressing blocks on several threads
+    '''
+
+    def __init__(self, name, compresslevel=9, jobs=None,
+                 block_size=PGZ_BLOCK_SIZE):
+        self.name = name
+        self.level = compresslevel
+        self.jobs = jobs if jobs else os.cpu_count() or 1
+        self.block_size = block_size
+        self.fileobj = open(name, 'wb')
+        self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.zdict = b''
+        self.crc = 0
+        self.size = 0
+        self.compressed = 0
+        self.start = time.monotonic()
+        self.closed = False
+
+        # gzip header: deflate, no flags, no mtime, unix
+        self.__write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, 0, 0, 3))
+
+    def __write(self, data):
+        self.fileobj.write(data)
+        self.compressed += len(data)
+
+    def __submit(self, block, last=False):
+        self.pending.append(self.executor.submit(
+            _deflate_block, block, self.zdict, self.level, last))
+        self.zdict = block[-PGZ_DICT_SIZE:]
+        # Bound the memory used by blocks waiting to be written
+        while len(self.pending) > 2 * self.jobs:
+            self.__write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self.__submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.__submit(bytes(self.buffer), last=True)
+            self.buffer = bytearray()
+            while self.pending:
+                self.__write(self.pending.popleft().result())
+            self.__write(struct.pack('<II', self.crc & 0xffffffff,
+                                     self.size & 0xffffffff))
+        finally:
+            self.executor.shutdown()
+            self.fileobj.close()
+
+        elapsed = time.monotonic() - self.start
+        ratio = self.compressed / self.size if self.size else 1
+        logger.info("%s: %d -> %d bytes (ratio %.3f) in %.1fs with %d threads",
+                    os.path.basename(self.name), self.size, self.compressed,
+                    ratio, elapsed, self.jobs)
+
+
+class PatchTarFile(tarfile.TarFile):
+    '''
+    TarFile with the "pgz" parallel gzip compression for writing
+    '''
+
+    OPEN_METH = dict(tarfile.TarFile.OPEN_METH, pgz="pgzopen")
+
+    @classmethod
+    def pgzopen(cls, name, mode="r", fileobj=None, compresslevel=9,
+                jobs=None, **kwargs):
+        '''
+        Open a gzip compressed tar archive, compressed on "jobs" threads
+        when writing. Reading falls back to the standard gzip support.
+        '''
+        if mode != "w" or fileobj is not None:
+            return cls.gzopen(name, mode, fileobj, compresslevel, **kwargs)
+
+        gzfile = ParallelGzipWriter(name, compresslevel, jobs)
+        try:
+            t = cls.taropen(name, mode, gzfile, **kwargs)
+        except Exception:
+            gzfile.close()
+            raise
+        # The tar file owns gzfile and closes it
+        t._extfileobj = False
+        return t
@@ -30,6 +30,41 @@ private_key_files = {
 }
 
 
+class HashingReader(object):
+    """
+    Read-through wrapper of a binary file: every chunk read is also fed to
+    the given hash objects, so a file can be hashed while it is consumed
+    (e.g. by tarfile) and is read only once.
+    """
+
+    def __init__(self, fileobj, hashes):
+        self.fileobj = fileobj
+        self.hashes = hashes
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        for h in self.hashes:
+            h.update(data)
+        return data
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def new_data_hash():
+    """
+    Hash object to pass to sign_hash(), fed with the data of all the
+    signed files, in order.
+    """
+    return SHA256.new()
+
+
 def sign_files(filenames, signature_file, private_key=None, cert_type=None):
     """
     Utility function for signing data in files.
@@ -45,7 +80,7 @@ def sign_files(filenames, signature_file, private_key=None, cert_type=None):
 
     # Hash the data across all files
     blocksize = default_blocksize
-    data_hash = SHA256.new()
+    data_hash = new_data_hash()
     for filename in filenames:
         with open(filename, 'rb') as infile:
             data = infile.read(blocksize)
@@ -53,6 +88,20 @@ def sign_files(filenames, signature_file, private_key=None, cert_type=None):
                 data_hash.update(data)
                 data = infile.read(blocksize)
 
+    return sign_hash(data_hash, signature_file, private_key, cert_type)
+
+
+def sign_hash(data_hash, signature_file, private_key=None, cert_type=None):
+    """
+    Sign a hash of the data, as computed by sign_files().
+    :param data_hash: Hash object returned by new_data_hash(), already fed
+                      with the data to be signed
+    :param signature_file: The name of the file to which the signature will be
+                           stored
+    :param private_key: See sign_files()
+    :param cert_type: See sign_files()
+    """
+
     # Find a private key to use, if not already provided
     need_resign_with_formal = False
     if private_key is None:
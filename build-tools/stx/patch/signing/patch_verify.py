@@ -4,9 +4,16 @@
 # SPDX-License-Identifier: Apache-2.0
 #
 
+import functools
+import glob
 import os
 import logging
+import shutil
+import tarfile
+import tempfile
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from Cryptodome.Signature import PKCS1_v1_5
 from Cryptodome.Signature import PKCS1_PSS
 from Cryptodome.Hash import SHA256
@@ -17,6 +24,8 @@ from binascii import a2b_base64
 from signing.certificates import dev_certificate
 from signing.certificates import formal_certificate
 
+import constants
+
 # To save memory, read and hash 1M of files at a time
 default_blocksize = 1 * 1024 * 1024
 
@@ -30,6 +39,20 @@ cert_type_dev = [cert_type_dev_str]
 cert_type_formal = [cert_type_formal_str]
 cert_type_all = [cert_type_dev_str, cert_type_formal_str]
 
+# Detached signature of a patch, and the patch files it covers, in the
+# order they are hashed
+detached_signature_file = 'signature.v2'
+signed_patch_files = ['metadata.tar', 'software.tar', 'extra.tar'] + \
+    list(constants.PATCH_SCRIPTS.values())
+required_patch_files = ['metadata.tar', 'software.tar']
+
+# Signed files found out of order in a patch are kept in memory up to this
+# size while the patch is verified, then in a temporary file
+spool_max_size = 64 * 1024 * 1024
+
+# Number of patches verified concurrently
+default_verify_jobs = 4
+
 
 def verify_hash(data_hash, signature_bytes, certificate_list):
     """
@@ -42,33 +65,8 @@ def verify_hash(data_hash, signature_bytes, certificate_list):
                             which the signature is validated against
     :return: True if the signature was validated against a certificate
     """
-    verified = False
-    for cert in certificate_list:
-        if verified:
-            break
-        pub_key = read_RSA_key(cert)
-        pub_key.exportKey()
-
-        # PSS is the recommended signature scheme, but some tools (like OpenSSL)
-        # use the older v1_5 scheme.  We try to validate against both.
-        #
-        # We use PSS for patch validation, but use v1_5 for ISO validation
-        # since we want to generate detached sigs that a customer can validate
-        # OpenSSL
-        verifier = PKCS1_PSS.new(pub_key)
-        try:
-            verified = verifier.verify(data_hash, signature_bytes)  # pylint: disable=not-callable
-        except ValueError:
-            verified = False
-
-        if not verified:
-            verifier = PKCS1_v1_5.new(pub_key)
-            try:
-                verified = verifier.verify(data_hash, signature_bytes)  # pylint: disable=not-callable
-            except ValueError:
-                verified = False
-
-    return verified
+    return VerificationContext(certificate_list).verify_hash(data_hash,
+                                                             signature_bytes)
 
 
 def get_public_certificates_by_type(cert_type=None):
@@ -124,6 +122,7 @@ def get_public_certificates():
     return cert_list
 
 
+@functools.lru_cache(maxsize=None)
 def read_RSA_key(key_data):
     """
     Utility function for reading an RSA key half from encoded data
@@ -189,3 +188,160 @@ def verify_files(filenames, signature_file, cert_type=None):
         certificate_list = get_public_certificates_by_type(cert_type=cert_type)
     return verify_hash(data_hash, signature_bytes, certificate_list)
 
+
+
+def hash_stream(data_hash, stream):
+    """
+    Feed a file object to a hash, 1M at a time
+    """
+    data = stream.read(default_blocksize)
+    while len(data) > 0:
+        data_hash.update(data)
+        data = stream.read(default_blocksize)
+
+
+class VerificationContext(object):
+    """
+    Verifies signatures against a fixed list of certificates.
+    The certificates are parsed once, and the signature scheme each public
+    key matched is remembered and tried first for the next signatures.
+    A context can be shared by several threads.
+    """
+
+    def __init__(self, certificate_list):
+        self.keys = [read_RSA_key(cert) for cert in certificate_list]
+        # PSS is the recommended signature scheme, but some tools (like
+        # OpenSSL) use the older v1_5 scheme.  We try to validate against both.
+        #
+        # We use PSS for patch validation, but use v1_5 for ISO validation
+        # since we want to generate detached sigs that a customer can validate
+        # OpenSSL
+        self.schemes = [[PKCS1_PSS, PKCS1_v1_5] for _ in self.keys]
+
+    @classmethod
+    def from_cert_type(cls, cert_type=None):
+        """
+        Context for the certificates of the given types, or the certificates
+        accepted on this system if cert_type is None
+        """
+        if cert_type is None:
+            return cls(get_public_certificates())
+        return cls(get_public_certificates_by_type(cert_type=cert_type))
+
+    def verify_hash(self, data_hash, signature_bytes):
+        """
+        Checks that a hash's signature can be validated against one of the
+        certificates of the context
+        :param data_hash: A hash of the data to be validated
+        :param signature_bytes: A pre-generated signature
+        :return: True if the signature was validated against a certificate
+        """
+        for i, pub_key in enumerate(self.keys):
+            for scheme in self.schemes[i]:
+                verifier = scheme.new(pub_key)
+                try:
+                    verified = verifier.verify(data_hash, signature_bytes)  # pylint: disable=not-callable
+                except ValueError:
+                    verified = False
+                if verified:
+                    # Try the matching scheme first next time
+                    self.schemes[i] = [scheme] + \
+                        [s for s in self.schemes[i] if s is not scheme]
+                    return True
+        return False
+
+    def verify_patch(self, patch_file):
+        """
+        Verify the detached signature of a patch file.
+        The patch is read in a single pass, the signed files are hashed as
+        they are streamed out of it, the ones found out of order are spooled
+        until their turn comes.
+        :param patch_file: Path to the patch file
+        :return: True if the signature was verified, False otherwise
+        """
+        data_hash = SHA256.new()
+        signature_bytes = None
+        spooled = {}
+        next_index = 0
+
+        def hash_ready():
+            # Hash the spooled files that are next in order
+            nonlocal next_index
+            while next_index < len(signed_patch_files) and \
+                    signed_patch_files[next_index] in spooled:
+                with spooled.pop(signed_patch_files[next_index]) as spool:
+                    hash_stream(data_hash, spool)
+                next_index += 1
+
+        try:
+            with tarfile.open(patch_file, 'r|*') as patch_tar:
+                for member in patch_tar:
+                    if member.name == detached_signature_file:
+                        signature_bytes = patch_tar.extractfile(member).read()
+                        continue
+                    if member.name not in signed_patch_files:
+                        continue
+
+                    stream = patch_tar.extractfile(member)
+                    if signed_patch_files.index(member.name) == next_index:
+                        hash_stream(data_hash, stream)
+                        next_index += 1
+                        hash_ready()
+                    else:
+                        spool = tempfile.SpooledTemporaryFile(
+                            max_size=spool_max_size)
+                        shutil.copyfileobj(stream, spool, default_blocksize)
+                        spool.seek(0)
+                        spooled[member.name] = spool
+
+            # Signed files which are not in the patch are skipped
+            while next_index < len(signed_patch_files):
+                name = signed_patch_files[next_index]
+                if name not in spooled:
+                    if name in required_patch_files:
+                        LOG.error("%s: missing %s", patch_file, name)
+                        return False
+                    next_index += 1
+                hash_ready()
+        finally:
+            for spool in spooled.values():
+                spool.close()
+
+        if signature_bytes is None:
+            LOG.error("%s: missing %s", patch_file, detached_signature_file)
+            return False
+
+        return self.verify_hash(data_hash, signature_bytes)
+
+    def verify_patches(self, patch_files, jobs=default_verify_jobs):
+        """
+        Verify several patch files concurrently
+        :param patch_files: List of paths to patch files
+        :param jobs: Number of patches verified at the same time
+        :return: Dict of patch file to verification result
+        """
+        def verify(patch_file):
+            start = time.monotonic()
+            try:
+                verified = self.verify_patch(patch_file)
+            except (OSError, tarfile.TarError) as e:
+                LOG.error("%s: %s", patch_file, str(e))
+                verified = False
+            LOG.info("%s: signature %s in %.1fs", patch_file,
+                     "verified" if verified else "NOT verified",
+                     time.monotonic() - start)
+            return verified
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = executor.map(verify, patch_files)
+            return dict(zip(patch_files, results))
+
+    def verify_patch_dir(self, patch_dir, jobs=default_verify_jobs):
+        """
+        Verify all the .patch files of a directory concurrently
+        :param patch_dir: Directory containing the patch files
+        :param jobs: Number of patches verified at the same time
+        :return: Dict of patch file to verification result
+        """
+        patch_files = sorted(glob.glob(os.path.join(patch_dir, '*.patch')))
+        return self.verify_patches(patch_files, jobs)
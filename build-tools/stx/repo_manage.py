@@ -21,15 +21,19 @@ import aptly_deb_usage
 import argparse
 from concurrent.futures import as_completed
 from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 import debian.deb822
 import debian.debfile
+import fcntl
+import hashlib
+import json
 import logging
 import os
 import requests
 from requests.compat import urljoin
 import shutil
 from threading import Lock
-import urllib.request
+import time
 import utils
 
 REPOMGR_URL = os.environ.get('REPOMGR_URL')
@@ -37,73 +41,180 @@ REPOMGR_ORIGIN = os.environ.get('REPOMGR_ORIGIN')
 REPOMGR_DEPLOY_URL = os.environ.get('REPOMGR_DEPLOY_URL')
 
 APTFETCH_JOBS = 20
+# Persistent apt roots of AptFetch, one per sources.list content
+APTFETCH_CACHE = os.path.join(os.environ.get('MY_WORKSPACE', '/tmp'), 'apt-fetch-cache')
+# Concurrent requests to check the files of a source package in deployed repos
+ORIG_CHECK_JOBS = 16
+# Seconds a file size seen in a deployed repo is trusted without checking again
+ORIG_CHECK_TTL = 300
+
+# apt caches opened by AptFetch in this process, shared by instances with
+# the same sources.list: {fingerprint: (apt.Cache, Lock)}
+apt_fetch_caches = dict()
+apt_fetch_caches_lock = Lock()
 
 
 class AptFetch():
     '''
     Fetch Debian packages from a set of repositories.
     '''
-    def __init__(self, logger, sources_list='', workdir='/tmp/apt-fetch'):
+    def __init__(self, logger, sources_list='', workdir='/tmp/apt-fetch', aptlock=None):
+        '''
+        aptlock: lock serializing the apt_pkg lookups, to share with other
+                 users of apt_pkg in the process. Downloads run without it.
+        '''
         self.logger = logger
         self.aptcache = None
-        self.aptlock = Lock()
+        self.aptlock = aptlock if aptlock else Lock()
+        # src_records[(source name, version)] = ((file path, uri, sha256), ...)
+        self.src_records = None
+        # src_versions[source name] = [version, ...], in apt lookup order
+        self.src_versions = None
         self.workdir = workdir
         self.sources_list = sources_list
+        self.fingerprint = None
+        self.apt_root = None
         self.__construct_workdir(sources_list)
         self.__init_apt_cache()
 
     def __construct_workdir(self, sources_list):
         '''construct some directories for repo and temporary files'''
-        # In case the sources_list is specified:
+        # In case the sources_list is specified, the apt root is kept in
+        # APTFETCH_CACHE, named after the fingerprint of the sources.list:
         #
-        # ├── apt-root               # For apt cache
-        # │   ├── etc
-        # │   │   └── apt
-        # │   │       └── sources.list
-        # │   └── var
-        # │       ├── cache/apt
-        # │       │   ├── lists/partial
-        # │       │   └── archives/partial
-        # │       └── lib/apt/lists/partial
-        # └── downloads              # Sub directory to store downloaded packages
-        #       ├── binary
-        #       └── source
+        # APTFETCH_CACHE/<fingerprint>
+        # ├── etc
+        # │   └── apt
+        # │       └── sources.list
+        # ├── release-stamps.json   # ETag/Last-Modified of the Release files
+        # └── var
+        #     ├── cache/apt
+        #     │   ├── lists/partial
+        #     │   └── archives/partial
+        #     └── lib/apt/lists/partial
         #
-        # In case the sources_list is ''
-        # |
+        # workdir
         # └── downloads              # Sub directory to store downloaded packages
         #       ├── binary
         #       └── source
+        #
+        # Only the downloads are cleaned, other content of workdir is kept.
         basedir = self.workdir
         try:
-            if os.path.exists(basedir):
-                shutil.rmtree(basedir)
-            os.makedirs(basedir)
+            os.makedirs(basedir, exist_ok=True)
             if self.sources_list:
                 # check to see if meta file exist
                 if not os.path.exists(sources_list):
                     raise Exception('Specified sources list file %s does not exist' % sources_list)
-                aptdir = os.path.join(basedir, 'apt-root/etc/apt')
-                os.makedirs(aptdir)
-                shutil.copyfile(sources_list, os.path.join(aptdir, 'sources.list'))
+                with open(sources_list, 'rb') as f:
+                    sources = f.read()
+                self.fingerprint = hashlib.sha256(sources).hexdigest()
+                self.apt_root = os.path.join(APTFETCH_CACHE, self.fingerprint[:16])
+                aptdir = os.path.join(self.apt_root, 'etc/apt')
+                os.makedirs(aptdir, exist_ok=True)
+                apt_sources = os.path.join(aptdir, 'sources.list')
+                if not os.path.exists(apt_sources):
+                    with open(apt_sources + '.tmp', 'wb') as f:
+                        f.write(sources)
+                    os.replace(apt_sources + '.tmp', apt_sources)
                 # Create apt cache directory skeleton required by apt.Cache()
                 # apt.Cache(rootdir=...) does not consistently create all
                 # subdirectories before update() tries to acquire lock files.
                 # This is a known python-apt gap that varies by version.
                 # Pre-creating with exist_ok=True is a safe no-op if apt
                 # handles it, and prevents lock failures when it does not.
-                apt_root = os.path.join(basedir, 'apt-root')
                 for d in ['var/cache/apt/lists/partial',
                           'var/cache/apt/archives/partial',
                           'var/lib/apt/lists/partial']:
-                    os.makedirs(os.path.join(apt_root, d), exist_ok=True)
-            os.makedirs(os.path.join(basedir, 'downloads', 'binary'))
-            os.makedirs(os.path.join(basedir, 'downloads', 'source'))
+                    os.makedirs(os.path.join(self.apt_root, d), exist_ok=True)
+            for d in ['binary', 'source']:
+                dl_dir = os.path.join(basedir, 'downloads', d)
+                if os.path.exists(dl_dir):
+                    shutil.rmtree(dl_dir)
+                os.makedirs(dl_dir)
         except Exception as e:
             self.logger.error(str(e))
             self.logger.error('Failed to construct workdir %s' % basedir)
             raise Exception('Failed to construct workdir %s' % basedir)
 
+    # The URLs of the (In)Release files of the repositories in sources.list
+    # Index types the lists directory must contain for the sources.list:
+    # 'Packages' for "deb" lines, 'Sources' for "deb-src" lines
+    def __list_types(self):
+        types = set()
+        with open(self.sources_list, 'r') as f:
+            for line in f:
+                fields = line.split('#')[0].split()
+                if fields and fields[0] == 'deb':
+                    types.add('Packages')
+                elif fields and fields[0] == 'deb-src':
+                    types.add('Sources')
+        return types
+
+    def __release_urls(self):
+        urls = []
+        with open(self.sources_list, 'r') as f:
+            for line in f:
+                fields = line.split('#')[0].split()
+                if not fields or fields[0] not in ['deb', 'deb-src']:
+                    continue
+                fields = fields[1:]
+                # Skip options: [trusted=yes] or [ arch=amd64 ]
+                if fields and fields[0].startswith('['):
+                    while fields and not fields[0].endswith(']'):
+                        fields = fields[1:]
+                    fields = fields[1:]
+                if len(fields) < 2:
+                    continue
+                url, suite = fields[0].rstrip('/'), fields[1]
+                if suite.endswith('/'):
+                    # flat repository
+                    base = '/'.join([url, suite.strip('/')]).rstrip('/')
+                else:
+                    base = '/'.join([url, 'dists', suite])
+                if base not in urls:
+                    urls.append(base)
+        return urls
+
+    # Revalidate the Release files of the repositories with their ETag and
+    # Last-Modified seen at the last update.
+    # Return: (changed, stamps), stamps should be saved after a successful update
+    def __revalidate_releases(self):
+        stamps_file = os.path.join(self.apt_root, 'release-stamps.json')
+        try:
+            with open(stamps_file, 'r') as f:
+                old_stamps = json.load(f)
+        except Exception:
+            old_stamps = dict()
+        changed = not old_stamps
+        stamps = dict()
+        for base in self.__release_urls():
+            for release in ['InRelease', 'Release']:
+                url = '/'.join([base, release])
+                headers = dict()
+                if url in old_stamps:
+                    if old_stamps[url].get('etag'):
+                        headers['If-None-Match'] = old_stamps[url]['etag']
+                    if old_stamps[url].get('last_modified'):
+                        headers['If-Modified-Since'] = old_stamps[url]['last_modified']
+                try:
+                    res = requests.get(url, headers=headers, timeout=30)
+                except requests.RequestException as e:
+                    self.logger.debug('Failed to revalidate %s: %s' % (url, e))
+                    changed = True
+                    break
+                if res.status_code == 304:
+                    stamps[url] = old_stamps[url]
+                    break
+                if res.status_code == 200:
+                    changed = True
+                    stamps[url] = {'etag': res.headers.get('ETag'),
+                                   'last_modified': res.headers.get('Last-Modified')}
+                    break
+            else:
+                changed = True
+        return changed, stamps
+
     def __init_apt_cache(self):
         '''Construct APT cache based on specified rootpath. Just like `apt update` on host'''
         # In case we use host's apt settings, no need to apt-upgrade.
@@ -111,7 +222,7 @@ class AptFetch():
             self.aptcache = apt.Cache()
             return None
         try:
-            apt_root = os.path.join(self.workdir, 'apt-root')
+            apt_root = self.apt_root
             cachedir = os.path.join(apt_root, 'var', 'cache', 'apt')
             # Explicitly set apt_pkg config paths so update() uses our
             # rootdir instead of a random temp dir. Without this,
@@ -121,11 +232,32 @@ class AptFetch():
             apt_pkg.config.set("Dir::Etc", os.path.join(apt_root, "etc", "apt"))
             apt_pkg.config.set("Dir::State::lists", os.path.join(cachedir, "lists"))
             apt_pkg.config.set("Dir::Cache::archives", os.path.join(cachedir, "archives"))
-            self.aptcache = apt.Cache(rootdir=apt_root)
-            ret = self.aptcache.update()
-            if not ret:
-                raise Exception('APT cache update failed')
-            self.aptcache.open()
+            with apt_fetch_caches_lock:
+                if self.fingerprint in apt_fetch_caches:
+                    self.aptcache, self.aptlock = apt_fetch_caches[self.fingerprint]
+                    return None
+                # apt_root is shared by all processes using the same
+                # sources.list, serialize the update of the lists
+                with open(os.path.join(apt_root, '.lock'), 'w') as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    self.aptcache = apt.Cache(rootdir=apt_root)
+                    changed, stamps = self.__revalidate_releases()
+                    lists = os.listdir(os.path.join(cachedir, 'lists'))
+                    for list_type in self.__list_types():
+                        if not any(list_type in name for name in lists):
+                            changed = True
+                    if changed:
+                        ret = self.aptcache.update()
+                        if not ret:
+                            raise Exception('APT cache update failed')
+                        stamps_file = os.path.join(apt_root, 'release-stamps.json')
+                        with open(stamps_file + '.tmp', 'w') as f:
+                            json.dump(stamps, f)
+                        os.replace(stamps_file + '.tmp', stamps_file)
+                    else:
+                        self.logger.info('Package lists of %s are up to date' % self.sources_list)
+                    self.aptcache.open()
+                apt_fetch_caches[self.fingerprint] = (self.aptcache, self.aptlock)
         except Exception as e:
             self.logger.error(str(e))
             self.logger.error('apt cache init failed.')
@@ -183,14 +315,11 @@ class AptFetch():
 
         uri = candidate.uri
         filename = candidate.filename
+        expected_sha256 = candidate.sha256
         self.aptlock.release()
         try:
-            res = requests.get(uri, stream=True)
             self.logger.debug('Fetching package file %s' % uri)
-            with open(os.path.join(destdir, os.path.basename(filename)), 'wb') as download_file:
-                for chunk in res.iter_content(chunk_size=1024 * 1024):
-                    if chunk:
-                        download_file.write(chunk)
+            self.__download(uri, os.path.join(destdir, os.path.basename(filename)), expected_sha256)
         except Exception as e:
             self.logger.error(str(e))
             self.logger.error('Binary package %s %s download error' % (pkg_name, pkg_version))
@@ -199,40 +328,76 @@ class AptFetch():
             self.logger.debug('Binary package %s %s downloaded.' % (pkg_name, pkg_version))
             return ' '.join(['DEB', pkg_name, pkg_version]).strip()
 
+    # Download a file, verify its sha256 on the fly
+    def __download(self, uri, path, expected_sha256=None):
+        res = requests.get(uri, stream=True)
+        res.raise_for_status()
+        sha256 = hashlib.sha256()
+        with open(path, 'wb') as download_file:
+            for chunk in res.iter_content(chunk_size=1024 * 1024):
+                if chunk:
+                    sha256.update(chunk)
+                    download_file.write(chunk)
+        if expected_sha256 and expected_sha256 != sha256.hexdigest():
+            os.remove(path)
+            raise Exception('Checksum mismatch for %s' % uri)
+
+    # Resolve all source records of the apt cache once. apt_pkg is not thread
+    # safe, so lookups used to be serialized by aptlock; with the table built,
+    # fetch_dsc workers resolve source packages without the lock.
+    def __source_records(self):
+        if self.src_records is not None:
+            return self.src_records, self.src_versions
+        with self.aptlock:
+            if self.src_records is None:
+                src_records = dict()
+                src_versions = dict()
+                src = apt_pkg.SourceRecords()
+                while src.step():
+                    key = (src.package, src.version)
+                    if key in src_records:
+                        continue
+                    src_files = []
+                    for src_file in src.files:
+                        sha256 = src_file.hashes.find('SHA256')
+                        src_files.append((src_file.path, src.index.archive_uri(src_file.path),
+                                          sha256.hashvalue if sha256 else None))
+                    src_records[key] = tuple(src_files)
+                    src_versions.setdefault(src.package, []).append(src.version)
+                self.logger.debug('%d source records resolved' % len(src_records))
+                self.src_versions = src_versions
+                self.src_records = src_records
+        return self.src_records, self.src_versions
+
     # Download a source package into downloaded folder
-    def fetch_dsc(self, pkg_name, pkg_version=''):
+    # file_threads: pool downloading the source files, by default a pool of this call
+    def fetch_dsc(self, pkg_name, pkg_version='', file_threads=None):
         '''Download a source package'''
         if not pkg_name:
             raise Exception('Source package name empty')
+        if not file_threads:
+            with ThreadPoolExecutor(max_workers=APTFETCH_JOBS) as file_threads:
+                return self.fetch_dsc(pkg_name, pkg_version, file_threads)
 
         destdir = os.path.join(self.workdir, 'downloads', 'source')
-        self.aptlock.acquire()
-        src = apt_pkg.SourceRecords()
-        source_find = False
-        source_lookup = src.lookup(pkg_name)
-        while source_lookup:
-            if pkg_name == src.package and pkg_version in ['', src.version]:
-                source_find = True
-                break
-            source_lookup = src.lookup(pkg_name)
-        if not source_find:
-            self.aptlock.release()
+        src_records, src_versions = self.__source_records()
+        if not pkg_version and pkg_name in src_versions:
+            src_files = src_records[(pkg_name, src_versions[pkg_name][0])]
+        else:
+            src_files = src_records.get((pkg_name, pkg_version))
+        if not src_files:
             raise ValueError("Source package %s %s was not found" % (pkg_name, pkg_version))
-        dict_files = dict()
-        for src_file in src.files:
-            dict_files[src_file.path] = src.index.archive_uri(src_file.path)
-        self.aptlock.release()
 
-        # Here the src.files is a list, each one points to a source file
-        # Download those source files one by one with requests
+        # Here the src_files is a list, each one points to a source file
+        # Download those source files concurrently with requests
         try:
-            for file_path, uri in dict_files.items():
-                res = requests.get(uri, stream=True)
+            obj_list = []
+            for file_path, uri, sha256 in src_files:
                 self.logger.debug('Fetch package file %s' % uri)
-                with open(os.path.join(destdir, os.path.basename(file_path)), 'wb') as download_file:
-                    for chunk in res.iter_content(chunk_size=1024 * 1024):
-                        if chunk:
-                            download_file.write(chunk)
+                obj_list.append(file_threads.submit(self.__download, uri,
+                                os.path.join(destdir, os.path.basename(file_path)), sha256))
+            for future in as_completed(obj_list):
+                future.result()
         except Exception as e:
             self.logger.error(str(e))
             self.logger.error('Source package %s %s download error' % (pkg_name, pkg_version))
@@ -266,7 +431,10 @@ class AptFetch():
         fetch_result['deb-failed'] = list()
         fetch_result['dsc'] = list()
         fetch_result['dsc-failed'] = list()
-        with ThreadPoolExecutor(max_workers=APTFETCH_JOBS) as threads:
+        # The source files are downloaded on a pool of their own, the package
+        # workers wait for them. Both pools are shut down once the fetch completes.
+        with ThreadPoolExecutor(max_workers=APTFETCH_JOBS) as threads, \
+                ThreadPoolExecutor(max_workers=APTFETCH_JOBS) as file_threads:
             obj_list = []
             # Download binary packages
             for pkg_ver in deb_set:
@@ -284,7 +452,7 @@ class AptFetch():
                     pkg_version = ''
                 else:
                     pkg_version = pkg_ver.split()[1]
-                obj = threads.submit(self.fetch_dsc, pkg_name, pkg_version)
+                obj = threads.submit(self.fetch_dsc, pkg_name, pkg_version, file_threads)
                 obj_list.append(obj)
             # Wait...
             for future in as_completed(obj_list):
@@ -320,28 +488,48 @@ class RepoMgr():
         self.aptcache = None
         self.logger = logger
         self.workdir = workdir
-
-    def __sync_pkg_list(self, check_list, pkg_list_file, pkg_type='binary'):
+        # HTTP session to REPOMGR_DEPLOY_URL, keeps connections alive between requests
+        self.http = None
+        # deployed_sizes[url] = (file size, time of the check)
+        self.deployed_sizes = dict()
+
+    # Index the packages of several repositories with one listing per repository
+    # Return: {'binary': set, 'source': set}, each set contains both "name" and
+    #         "name version" of the packages, the format of package list files.
+    def __index_pkgs(self, repo_list):
+        pkg_index = {'binary': set(), 'source': set()}
+        for repo in repo_list:
+            for key in self.repo.iter_pkgs(repo):
+                # 0: pkg_arch  1: pkg_name  2: pkg_version
+                pkg_arch, pkg_name, pkg_version = key.split()[0:3]
+                pkg_type = 'source' if pkg_arch == 'Psource' else 'binary'
+                pkg_index[pkg_type].add(pkg_name)
+                pkg_index[pkg_type].add(pkg_name + ' ' + pkg_version)
+        return pkg_index
+
+    def __sync_pkg_list(self, pkg_index, pkg_set, pkg_type='binary'):
         '''Sync packages, return packages need to be downloaded'''
         if pkg_type not in ['binary', 'source']:
             self.logger.error('Parameter pkg_tye:%s error. Can only be binary or source' % pkg_type)
             raise Exception('Parameter pkg_tye:%s error. Can only be binary or source' % pkg_type)
-        pkg_req = set()
-        # scan the package list file
-        pkg_set = self.__scan_pkg_list(pkg_list_file)
-        for pkg_ver in pkg_set:
-            pkg_name = pkg_ver.split()[0]
-            if len(pkg_ver.split()) == 1:
-                pkg_version = ''
-            else:
-                pkg_version = pkg_ver.split()[1]
-            # Search package in check_list
-            if self.repo.pkg_exist(check_list, pkg_name, pkg_type, pkg_version):
-                continue
-            pkg_req.add(pkg_ver)
+        pkg_req = pkg_set - pkg_index[pkg_type]
         self.logger.info('%d %s packages need to be downloaded.' % (len(pkg_req), pkg_type))
         return pkg_req
 
+    # Find packages of a local repository which are not in the package lists
+    # A package type whose list is None is not checked, its packages are kept
+    # Output: list of aptly package keys
+    def __stale_pkgs(self, repo_name, deb_set, dsc_set):
+        stale_keys = []
+        for key in self.repo.iter_pkgs(repo_name):
+            pkg_arch, pkg_name, pkg_version = key.split()[0:3]
+            pkg_set = dsc_set if pkg_arch == 'Psource' else deb_set
+            if pkg_set is None:
+                continue
+            if pkg_name not in pkg_set and pkg_name + ' ' + pkg_version not in pkg_set:
+                stale_keys.append(key)
+        return stale_keys
+
     # Scan package list file, return required package_version in a set
     def __scan_pkg_list(self, pkg_list_file):
         pkg_set = set()
@@ -454,11 +642,14 @@ class RepoMgr():
     # repo_list: String separated with space, contains serials of aptly/pulp
     #            repos can be used for OBS/LAT.
     # no_clear: do not delete downloaded packages. For debug
+    # prune: remove packages of the local repository which are not in the lists,
+    #        only for the package types whose list is given: binary packages
+    #        are kept without deb_list, source packages without dsc_list
     # kwargs:sources_list: file contains trusted upstream repositories
     # kwargs:deb_list: file lists all needed binary packages
     # kwargs:dsc_list: file lists all needed source packages
     # Output: None
-    def sync(self, repo_name, repo_list, no_clear=False, **kwargs):
+    def sync(self, repo_name, repo_list, no_clear=False, prune=False, **kwargs):
         '''
         Sync a set of repositories with specified package lists, if any packages
         missed, download and deploy them through a specified local repo
@@ -474,6 +665,9 @@ class RepoMgr():
 
         if not deb_list and not dsc_list:
             raise Exception('deb_list and dsc_list, at least one is required.')
+        phase_start = time.monotonic()
+        phase_time = dict()
+        fetched_bytes = 0
         # construct repo list will be checked
         local_list = self.repo.list_local(quiet=True)
         remote_list = self.repo.list_remotes(quiet=True)
@@ -491,14 +685,28 @@ class RepoMgr():
             else:
                 self.logger.warning('%s in the list but does not exists.' % repo)
 
-        # Download missing packages from remote repo
-        deb_set = set()
-        dsc_set = set()
+        # Diff the package lists against the packages of all checked repos
+        deb_list_set = set()
+        dsc_list_set = set()
         if deb_list:
-            deb_set = self.__sync_pkg_list(check_list, deb_list, 'binary')
+            deb_list_set = self.__scan_pkg_list(deb_list)
         if dsc_list:
-            dsc_set = self.__sync_pkg_list(check_list, dsc_list, 'source')
-        # Download packages
+            dsc_list_set = self.__scan_pkg_list(dsc_list)
+        pkg_index = self.__index_pkgs(check_list)
+        deb_set = self.__sync_pkg_list(pkg_index, deb_list_set, 'binary')
+        dsc_set = self.__sync_pkg_list(pkg_index, dsc_list_set, 'source')
+        stale_keys = list()
+        if prune:
+            stale_keys = self.__stale_pkgs(repo_name,
+                                           deb_list_set if deb_list else None,
+                                           dsc_list_set if dsc_list else None)
+            self.logger.info('%d packages of %s are not listed any more and will be removed.' %
+                             (len(stale_keys), repo_name))
+        phase_time['scan'] = time.monotonic() - phase_start
+
+        # Download missing packages from remote repo
+        phase_start = time.monotonic()
+        pkg_files = set()
         if deb_set or dsc_set:
             apt_fetch = AptFetch(self.logger, kwargs['sources_list'], self.workdir)
             fetch_result = apt_fetch.fetch_pkg_list(deb_set=deb_set, dsc_set=dsc_set)
@@ -516,20 +724,30 @@ class RepoMgr():
                     self.logger.debug('Source package %s' % pkg_ver)
                 for pkg_ver in fetch_result['dsc-failed']:
                     self.logger.info('Failed to download source package %s' % pkg_ver)
-            # Add packages into local repo
             pkg_folder = os.path.join(self.workdir, 'downloads', 'binary')
-            package_files = set()
             for filename in os.listdir(pkg_folder):
-                package_files.add(os.path.join(pkg_folder, filename))
-            self.repo.upload_pkg_local(package_files, repo_name)
+                pkg_files.add(os.path.join(pkg_folder, filename))
             pkg_folder = os.path.join(self.workdir, 'downloads', 'source')
             for filename in os.listdir(pkg_folder):
                 if filename.endswith('.dsc'):
-                    self.upload_pkg(repo_name, os.path.join(pkg_folder, filename))
-            self.repo.upload_pkg_local(package_files, repo_name)
+                    _, dsc_files = self.__source_files(os.path.join(pkg_folder, filename))
+                    if dsc_files:
+                        pkg_files |= dsc_files
+            fetched_bytes = sum(os.path.getsize(pkg_file) for pkg_file in pkg_files)
+        phase_time['fetch'] = time.monotonic() - phase_start
+
+        # Add and remove packages of the local repo in one batch each
+        phase_start = time.monotonic()
+        if pkg_files:
+            self.repo.upload_pkg_local(pkg_files, repo_name)
+        if stale_keys:
+            self.repo.delete_pkg_keys(repo_name, stale_keys)
+        phase_time['upload'] = time.monotonic() - phase_start
 
         # Deploy local repo
+        phase_start = time.monotonic()
         repo_str = self.repo.deploy_local(repo_name)
+        phase_time['publish'] = time.monotonic() - phase_start
         if not no_clear:
             try:
                 if os.path.exists(self.workdir):
@@ -539,6 +757,10 @@ class RepoMgr():
                 self.logger.error('Clear work folder %s failed.' % self.workdir)
                 raise Exception('Clear work folder %s failed.' % self.workdir)
         self.logger.info('local repo can be accessed through: %s ' % repo_str)
+        self.logger.info('Sync %s: %d packages missing, %d files (%d bytes) uploaded, %d packages removed' %
+                         (repo_name, len(deb_set) + len(dsc_set), len(pkg_files), fetched_bytes, len(stale_keys)))
+        self.logger.info('Sync %s: ' % repo_name +
+                         ', '.join('%s %.1fs' % (phase, secs) for phase, secs in phase_time.items()))
 
     # Merge all packages of several repositories into a new publication(aptly)
     # NOTE: aptly only. Not find similar feature in pulp...
@@ -563,16 +785,26 @@ class RepoMgr():
             with_sources = False
         else:
             with_sources = kwargs['with_sources']
-        self.repo.remove_remote(repo_name)
-        if with_sources:
-            self.repo.create_remote(repo_name, url, distribution,
-                                    components=[component],
-                                    architectures=[architectures],
-                                    with_sources=True)
+        # Keep an existing mirror of the same upstream, deploy_remote only
+        # updates it when the upstream content changed.
+        remote = self.repo.get_remote(repo_name)
+        if remote and remote.archiveurl.rstrip('/') == url.rstrip('/') \
+                and remote.distribution == distribution \
+                and list(remote.components or []) == [component] \
+                and list(remote.architectures or []) == [architectures] \
+                and bool(getattr(remote, 'download_sources', False)) == bool(with_sources):
+            self.logger.debug('Mirror %s exists with the same settings, reuse it.' % repo_name)
         else:
-            self.repo.create_remote(repo_name, url, distribution,
-                                    components=[component],
-                                    architectures=[architectures])
+            self.repo.remove_remote(repo_name)
+            if with_sources:
+                self.repo.create_remote(repo_name, url, distribution,
+                                        components=[component],
+                                        architectures=[architectures],
+                                        with_sources=True)
+            else:
+                self.repo.create_remote(repo_name, url, distribution,
+                                        components=[component],
+                                        architectures=[architectures])
         repo_str = self.repo.deploy_remote(repo_name)
         if repo_str != None:
             self.logger.info('New mirror can be accessed through: %s' % repo_str)
@@ -619,31 +851,27 @@ class RepoMgr():
     # list a repository
     # repo_name: the name of the repo been listed.
     # Output: True is all works in order
-    def list_pkgs(self, repo_name, quiet=False):
+    def list_pkgs(self, repo_name, quiet=False, query=None):
         '''List a specified repository.'''
-        local_list = self.repo.list_local(quiet=True)
-        remote_list = self.repo.list_remotes(quiet=True)
-        pkg_list = []
-        for repo in local_list:
-            if repo == repo_name:
-                self.logger.info('List a local repo')
-                pkgs = self.repo.pkg_list([repo])
-                pkg_list.extend(pkgs)
-                if not quiet:
-                    self.logger.info("Local repo %s:" % repo_name)
-                    for pkg in sorted(pkgs):
-                        self.logger.info("  %s" % pkg)
-        for repo in remote_list:
-            if repo == repo_name:
-                self.logger.info('List a remote mirror')
-                pkgs = self.repo.pkg_list([repo])
-                pkg_list.extend(pkgs)
-                if not quiet:
-                    self.logger.info("Remote repo %s:" % repo_name)
-                    for pkg in sorted(pkgs):
-                        self.logger.info("  %s" % pkg)
+        pkg_list = list(self.iter_pkgs(repo_name, query))
+        if not quiet:
+            if repo_name.startswith(aptly_deb_usage.PREFIX_LOCAL):
+                self.logger.info("Local repo %s:" % repo_name)
+            else:
+                self.logger.info("Remote repo %s:" % repo_name)
+            for pkg in sorted(pkg_list):
+                self.logger.info("  %s" % pkg)
         return pkg_list
 
+    # Iterate the packages of a repository
+    # query: aptly package query, see aptly_deb_usage.pkg_query()
+    # Output: package file names, name_version_arch.deb or name_version.dsc
+    def iter_pkgs(self, repo_name, query=None):
+        '''Iterate packages of a specified repository, filtered by aptly.'''
+        if not self.repo.repo_exist(repo_name):
+            return iter(())
+        return self.repo.iter_pkg_files([repo_name], query)
+
     # delete a repository
     # repo_name: the name of the repo been deleted.
     # Output: True is all works in order
@@ -664,41 +892,109 @@ class RepoMgr():
         self.logger.warning("Remove repo failed: repo '%s' not found" % repo_name)
         return False
 
+    # Get the size of a file deployed by the repository manager
+    # Output: None if the file does not exist
+    def __deployed_file_size(self, url):
+        cached = self.deployed_sizes.get(url)
+        if cached and time.monotonic() - cached[1] < ORIG_CHECK_TTL:
+            return cached[0]
+        try:
+            response = self.http.head(url, allow_redirects=True, timeout=30)
+            if response.status_code != 200:
+                return None
+            length = response.headers.get('Content-Length')
+            if length is None:
+                with self.http.get(url, stream=True, timeout=30) as response:
+                    length = response.headers.get('Content-Length')
+        except requests.RequestException as e:
+            self.logger.debug('Failed to check %s: %s' % (url, e))
+            return None
+        if length is None:
+            return None
+        self.deployed_sizes[url] = (int(length), time.monotonic())
+        return int(length)
+
     # Before uploading a source package into a local repo, scan all repos,
     # find all duplicate files with different size.
     # dsc: Dsc data of the source package. <class 'debian.deb822.Dsc'>
     # Return a dictionary: {repo_1: {file_a, ...}, ...}
     #   Input dsc contains file_a, while repo_1 also contains such a file
     #   with different size.
+    # The (repo, file) pairs are checked concurrently, the check stops at the
+    # first different file since the upload will be refused anyway.
     def __check_orig_files(self, dsc):
         different_files = {}
         repo_list = self.repo.list_local(quiet=True)
         repo_list += self.repo.list_remotes(quiet=True)
-        for repo in repo_list:
-            for meta_file in dsc['Files']:
-                if meta_file['name'].find('.orig.'):
-                    new_file_size = meta_file['size']
-                    if dsc['Source'].startswith('lib'):
-                        prefix_dir = dsc['Source'][:4] + '/' + dsc['Source']
+        if dsc['Source'].startswith('lib'):
+            prefix_dir = dsc['Source'][:4] + '/' + dsc['Source']
+        else:
+            prefix_dir = dsc['Source'][0] + '/' + dsc['Source']
+        if not self.http:
+            self.http = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=ORIG_CHECK_JOBS)
+            self.http.mount('http://', adapter)
+            self.http.mount('https://', adapter)
+
+        with ThreadPoolExecutor(max_workers=ORIG_CHECK_JOBS) as threads:
+            checks = {}
+            for repo in repo_list:
+                for meta_file in dsc['Files']:
+                    # NOTE: find() is true unless the name starts with '.orig.', so every
+                    # file of the package is checked, not only *.orig.* ones
+                    if meta_file['name'].find('.orig.'):
+                        target_path = repo + '/pool/main/' + prefix_dir + '/' + meta_file['name']
+                        target_url = urljoin(REPOMGR_DEPLOY_URL, target_path)
+                        obj = threads.submit(self.__deployed_file_size, target_url)
+                        checks[obj] = (repo, meta_file)
+            for future in as_completed(checks):
+                repo, meta_file = checks[future]
+                deployed_size = future.result()
+                if deployed_size is None:
+                    # no such file in repo, that is good
+                    self.logger.debug('%s does not contain %s' % (repo, meta_file['name']))
+                    continue
+                if deployed_size != int(meta_file['size']):
+                    self.logger.debug('File %s is not same as the one in %s.' %
+                                      (meta_file['name'], repo))
+                    if repo not in different_files.keys():
+                        different_files[repo] = {meta_file['name']}
                     else:
-                        prefix_dir = dsc['Source'][0] + '/' + dsc['Source']
-                    target_path = repo + '/pool/main/' + prefix_dir + '/' + meta_file['name']
-                    target_url = urljoin(REPOMGR_DEPLOY_URL, target_path)
-                    try:
-                        orig_file = urllib.request.urlopen(target_url)
-                    except Exception:
-                        # no such file in repo, that is good
-                        self.logger.debug('%s does not contain %s' % (repo, meta_file['name']))
-                        continue
-                    if orig_file.length != int(new_file_size):
-                        self.logger.debug('File %s is not same as the one in %s.' %
-                                          (meta_file['name'], repo))
-                        if repo not in different_files.keys():
-                            different_files[repo] = {meta_file['name']}
-                        else:
-                            different_files[repo].add(meta_file['name'])
+                        different_files[repo].add(meta_file['name'])
+                    for obj in checks:
+                        obj.cancel()
+                    break
         return different_files
 
+    # Collect the files of a source package to be uploaded
+    # package: pathname of the dsc file
+    # Output: (Dsc, set of files), files is None if any of them conflicts with
+    #         a deployed file of the same name.
+    def __source_files(self, package):
+        try:
+            dsc = debian.deb822.Dsc(open(package, 'r'))
+        except Exception as e:
+            self.logger.error('Error: %s' % e)
+            self.logger.error('Source package %s read error.' % package)
+            raise Exception('Source package error.')
+
+        # In case there is already an *.orig.* file with different size in any repos,
+        # refuse to upload it.
+        different_files = self.__check_orig_files(dsc)
+        if different_files:
+            for repo, meta_files in different_files.items():
+                self.logger.error('%s contains different file: %s' % (repo, str(meta_files)))
+                self.logger.error('Package %s upload failed.  Repo %s already contains '
+                                  'file %s with different content.' %
+                                  (package, repo, str(meta_files)))
+            return dsc, None
+
+        pkg_files = set()
+        pkg_files.add(package)
+        for meta_file in dsc['Files']:
+            pkg_files.add(os.path.join(os.path.dirname(package), meta_file['name']))
+        return dsc, pkg_files
+
     # upload a Debian package and deploy it
     # repo_name: the name of the repository used to contain and deploy the package
     # package: pathname of the package(xxx.deb or xxx.dsc) to be uploaded
@@ -731,30 +1027,11 @@ class RepoMgr():
             self.repo.upload_pkg_local({package}, repo_name)
         elif '.dsc' == os.path.splitext(package)[-1]:
             pkg_type = 'source'
-            try:
-                dsc = debian.deb822.Dsc(open(package, 'r'))
-            except Exception as e:
-                self.logger.error('Error: %s' % e)
-                self.logger.error('Source package %s read error.' % package)
-                raise Exception('Source package error.')
+            dsc, pkg_files = self.__source_files(package)
+            if not pkg_files:
+                return False
             pkg_name = dsc['Source']
             pkg_version = dsc['Version']
-
-            # In case there is already an *.orig.* file with different size in any repos,
-            # refuse to upload it.
-            different_files = self.__check_orig_files(dsc)
-            if different_files:
-                for repo, meta_files in different_files.items():
-                    self.logger.error('%s contains different file: %s' % (repo, str(meta_files)))
-                    self.logger.error('Package %s upload failed.  Repo %s already contains '
-                                      'file %s with different content.' %
-                                      (package, repo, str(meta_files)))
-                return False
-
-            pkg_files = set()
-            pkg_files.add(package)
-            for meta_file in dsc['Files']:
-                pkg_files.add(os.path.join(os.path.dirname(package), meta_file['name']))
             self.repo.upload_pkg_local(pkg_files, repo_name)
         else:
             self.logger.warning('Only Debian style files, like deb and dsc, are supported.')
@@ -780,22 +1057,12 @@ class RepoMgr():
     # Output: True if find, or False
     def search_pkg(self, repo_name, pkg_name, pkg_version=None, binary=True):
         '''Find a package from a specified repo.'''
-        repo_find = False
-        repo_list = []
-        repo = None
-
-        r_list = self.repo.list_local(quiet=True)
-        for repo in r_list:
-            if not repo_name or repo == repo_name:
-                repo_list.append(repo)
-                repo_find = True
-        r_list = self.repo.list_remotes(quiet=True)
-        for repo in r_list:
-            if not repo_name or repo == repo_name:
-                repo_list.append(repo)
-                repo_find = True
-
-        if not repo_find:
+        if repo_name:
+            repo_list = [repo_name] if self.repo.repo_exist(repo_name) else []
+        else:
+            repo_list = self.repo.list_local(quiet=True) + self.repo.list_remotes(quiet=True)
+
+        if not repo_list:
             self.logger.error('Search package, repository does not exist.')
             return False
 
@@ -818,6 +1085,20 @@ class RepoMgr():
             return
         return self.repo.deploy_local(repo_name, suffix)
 
+    # Deploy a local repository in the background
+    # Output: Future
+    def deploy_repo_async(self, repo_name, suffix=''):
+        '''Deploy a local repository asynchronously, return its future.'''
+        return self.repo.submit(self.deploy_repo, repo_name, suffix)
+
+    # Deploy several local repositories concurrently and wait for all of them
+    # Output: dict, the deploy result of each repository
+    def deploy_repos(self, repo_names, suffix=''):
+        '''Deploy a set of local repositories concurrently.'''
+        deploys = dict((repo_name, self.deploy_repo_async(repo_name, suffix))
+                       for repo_name in dict.fromkeys(repo_names))
+        wait(deploys.values())
+        return dict((repo_name, deploy.result()) for repo_name, deploy in deploys.items())
 
     # Delete a Debian package from a local repository
     # repo_name: name of the LOCAL repository to delete the package from
@@ -827,8 +1108,6 @@ class RepoMgr():
     # Output: True if find and delete, or False
     def delete_pkg(self, repo_name, pkg_name, pkg_type, pkg_version='', deploy=True):
         '''Find and delete a binary package from a specified local repo.'''
-        repo_find = False
-        repo = None
         if pkg_type not in {'binary', 'source'}:
             self.logger.error('Delete package, pkg_type must be one of '
                               'either "binary" or "source".')
@@ -836,19 +1115,13 @@ class RepoMgr():
         if not repo_name.startswith(aptly_deb_usage.PREFIX_LOCAL):
             self.logger.error('Delete package, only local repositories support this operation.')
             return False
-        local_list = self.repo.list_local(quiet=True)
-        for repo in local_list:
-            if repo == repo_name:
-                repo_find = True
-        if not repo_find:
+        if not self.repo.repo_exist(repo_name):
             self.logger.error('Delete package, repository does not exist.')
             return False
 
-        if not self.repo.pkg_exist([repo_name], pkg_name, pkg_type, pkg_version):
+        if not self.repo.delete_pkg_local(repo_name, pkg_name, pkg_type, pkg_version):
             self.logger.info('Delete package, package not found.')
             return False
-
-        self.repo.delete_pkg_local(repo_name, pkg_name, pkg_type, pkg_version)
         # deploy = False only effect on binary packages
         if 'binary' == pkg_type and not deploy:
             return True
@@ -871,7 +1144,7 @@ def _handleSync(args):
     repomgr = RepoMgr('aptly', REPOMGR_URL, args.basedir, REPOMGR_ORIGIN, applogger)
     kwargs = {'sources_list': args.sources_list, 'deb_list': args.deb_list,
               'dsc_list': args.dsc_list}
-    repomgr.sync(args.repository, args.repo_list, **kwargs, no_clear=args.no_clear)
+    repomgr.sync(args.repository, args.repo_list, **kwargs, no_clear=args.no_clear, prune=args.prune)
 
 
 def _handleMirror(args):
@@ -924,7 +1197,8 @@ def _handleList(_args):
 
 def _handleListPkgs(args):
     repomgr = RepoMgr('aptly', REPOMGR_URL, '/tmp', REPOMGR_ORIGIN, applogger)
-    repomgr.list_pkgs(args.repository)
+    query = aptly_deb_usage.pkg_query(args.package_name, args.package_version, args.arch)
+    repomgr.list_pkgs(args.repository, query=query)
 
 
 def _handleClean(_args):
@@ -965,6 +1239,10 @@ def subcmd_sync(subparsers):
     sync_parser.add_argument('--sources_list', help='Upstream sources list file', required=False,
                              default='')
     sync_parser.add_argument('--no-clear', help='Not remove temporary files', action='store_true')
+    sync_parser.add_argument('--prune', help='Remove packages of the local repository which are not listed. '
+                             'Binary packages are pruned only if --deb_list is given, source packages '
+                             'only if --dsc_list is given; with both lists, both types are pruned',
+                             action='store_true')
     sync_parser.set_defaults(handle=_handleSync)
 
 
@@ -1072,6 +1350,12 @@ def main():
                                         help='List contents of a specific repo.\n\n')
     list_pkgs_parser.add_argument('--repository', '-r',
                                   help='Name of the repo to be listed')
+    list_pkgs_parser.add_argument('--package_name', '-p', required=False,
+                                  help='Only list packages of this name, wildcards allowed')
+    list_pkgs_parser.add_argument('--package_version', '-v', required=False,
+                                  help='Only list packages of this version')
+    list_pkgs_parser.add_argument('--arch', '-a', required=False,
+                                  help='Only list packages of this architecture, "source" for source packages')
     list_pkgs_parser.set_defaults(handle=_handleListPkgs)
 
     args = parser.parse_args()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2026 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Track aptly tasks of Deb_aptly against a local fake aptly REST server.
+#
+# The fake server answers the few requests Deb_aptly needs: the version, the
+# list of local repositories and the state of a task. A task completes, with
+# the state requested by the test, a given time after it was created.
+
+import http.server
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import unittest
+
+PROGNAME = os.path.basename(sys.argv[0])
+
+try:
+    import aptly_api  # noqa: F401
+    import debian  # noqa: F401
+    import requests  # noqa: F401
+except ImportError as e:
+    print('%s: WARNING: %s, skipping tests' % (PROGNAME, e), file=sys.stderr)
+    sys.exit(0)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stx'))
+import aptly_deb_usage  # noqa: E402
+
+
+# tasks[task_id] = [name, final state, completion time]
+class FakeAptlyHandler(http.server.BaseHTTPRequestHandler):
+    tasks = dict()
+    polls = 0
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, data, code=200):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path == '/api/version':
+            self.send_json({'Version': 'fake'})
+        elif path == '/api/repos':
+            self.send_json([])
+        elif path.startswith('/api/tasks/'):
+            task_id = int(path.split('/')[3])
+            if task_id not in self.tasks:
+                self.send_json({'error': 'not found'}, 404)
+                return
+            FakeAptlyHandler.polls += 1
+            name, state, done = self.tasks[task_id]
+            if time.monotonic() < done:
+                state = 'RUNNING'
+            self.send_json({'ID': task_id, 'Name': name, 'State': state})
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+
+class TestAptlyTasks(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeAptlyHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        logger = logging.getLogger('aptly-tasks')
+        logger.addHandler(logging.NullHandler())
+        cls.repo = aptly_deb_usage.Deb_aptly('http://127.0.0.1:%d' % cls.server.server_port, None, logger)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def new_task(self, duration, state='SUCCEEDED'):
+        task_id = len(FakeAptlyHandler.tasks) + 1
+        FakeAptlyHandler.tasks[task_id] = ['task-%d' % task_id, state, time.monotonic() + duration]
+        return self.repo.aptly.tasks.show(task_id)
+
+    def wait_for_tasks(self, tasks):
+        return self.repo._Deb_aptly__wait_for_tasks(tasks)
+
+    def test_tasks_overlap(self):
+        tasks = [self.new_task(1) for _ in range(5)]
+        start = time.monotonic()
+        states = self.wait_for_tasks(tasks)
+        elapsed = time.monotonic() - start
+        self.assertEqual(states, ['SUCCEEDED'] * 5)
+        # Tracked together, five tasks of one second complete in about one second
+        self.assertLess(elapsed, 3)
+
+    def test_task_states_in_order(self):
+        tasks = [self.new_task(0.5, 'FAILED'), self.new_task(0.2), self.new_task(0.8, 'FAILED')]
+        self.assertEqual(self.wait_for_tasks(tasks), ['FAILED', 'SUCCEEDED', 'FAILED'])
+
+    def test_completed_task(self):
+        task = self.new_task(0)
+        self.assertEqual(task.state, 'SUCCEEDED')
+        self.assertEqual(self.wait_for_tasks([task, None]), ['SUCCEEDED', 'SUCCEEDED'])
+
+    def test_backoff(self):
+        polls = FakeAptlyHandler.polls
+        self.assertEqual(self.wait_for_tasks([self.new_task(3)]), ['SUCCEEDED'])
+        # Polled every 0.2s it would take 15 polls, backing off takes far fewer
+        self.assertLess(FakeAptlyHandler.polls - polls, 12)
+
+    def test_timeout(self):
+        task = self.new_task(3600)
+        self.assertEqual(self.repo.tasks.track(task, 0.5).result(timeout=10), 'TIMEOUTED')
+
+    def test_submit(self):
+        start = time.monotonic()
+        futures = [self.repo.submit(self.wait_for_tasks, [self.new_task(1)]) for _ in range(3)]
+        self.assertEqual([future.result(timeout=10) for future in futures], [['SUCCEEDED']] * 3)
+        self.assertLess(time.monotonic() - start, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
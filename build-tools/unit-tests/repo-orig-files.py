@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2026 Wind River Systems, Inc.
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Check the files of a source package against the files deployed in the
+# repositories, served by a local HTTP server in place of REPOMGR_DEPLOY_URL.
+#
+# The server serves a fixed set of pool files. HEAD requests do not send
+# a Content-Length for the files listed in no_length, so RepoMgr falls back
+# to a GET request for them.
+
+import http.server
+import logging
+import os
+import sys
+import threading
+import unittest
+
+PROGNAME = os.path.basename(sys.argv[0])
+
+try:
+    import apt  # noqa: F401
+    import aptly_api  # noqa: F401
+    import debian  # noqa: F401
+    import requests  # noqa: F401
+except ImportError as e:
+    print('%s: WARNING: %s, skipping tests' % (PROGNAME, e), file=sys.stderr)
+    sys.exit(0)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stx'))
+import repo_manage  # noqa: E402
+
+POOL = '/pool/main/h/hello/'
+ORIG = 'hello_2.10.orig.tar.gz'
+DEBIAN = 'hello_2.10-3.debian.tar.xz'
+
+
+# files[url path] = size, heads[url path] = number of HEAD requests
+class DeployedFilesHandler(http.server.BaseHTTPRequestHandler):
+    files = {
+        '/deb-local-build' + POOL + ORIG: 1000,
+        '/deb-local-build' + POOL + DEBIAN: 200,
+        '/deb-remote-mirror' + POOL + ORIG: 1000,
+        '/deb-remote-mirror' + POOL + DEBIAN: 300,
+    }
+    no_length = set()
+    heads = dict()
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, send_length):
+        size = self.files.get(self.path)
+        if size is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        self.send_response(200)
+        if send_length:
+            self.send_header('Content-Length', str(size))
+        else:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        return size
+
+    def do_HEAD(self):
+        self.heads[self.path] = self.heads.get(self.path, 0) + 1
+        self.reply(self.path not in self.no_length)
+
+    def do_GET(self):
+        size = self.reply(True)
+        if size:
+            self.wfile.write(b'\0' * size)
+
+
+class FakeAptly():
+    def __init__(self, local, remote):
+        self.local = local
+        self.remote = remote
+
+    def list_local(self, quiet=False):
+        return list(self.local)
+
+    def list_remotes(self, quiet=False):
+        return list(self.remote)
+
+
+class TestCheckOrigFiles(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), DeployedFilesHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        repo_manage.REPOMGR_DEPLOY_URL = 'http://127.0.0.1:%d/' % cls.server.server_port
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        DeployedFilesHandler.no_length = set()
+        DeployedFilesHandler.heads = dict()
+        logger = logging.getLogger('repo-orig-files')
+        logger.addHandler(logging.NullHandler())
+        # No aptly server: only the attributes used to check the files
+        self.repomgr = repo_manage.RepoMgr.__new__(repo_manage.RepoMgr)
+        self.repomgr.repo = FakeAptly(['deb-local-build'], ['deb-remote-mirror'])
+        self.repomgr.logger = logger
+        self.repomgr.http = None
+        self.repomgr.deployed_sizes = dict()
+
+    def check(self, files, source='hello'):
+        dsc = {'Source': source,
+               'Files': [{'name': name, 'size': str(size)} for name, size in files.items()]}
+        return self.repomgr._RepoMgr__check_orig_files(dsc)
+
+    def test_found_same(self):
+        self.repomgr.repo = FakeAptly(['deb-local-build'], [])
+        self.assertEqual(self.check({ORIG: 1000, DEBIAN: 200}), {})
+
+    def test_different(self):
+        self.assertEqual(self.check({ORIG: 1000, DEBIAN: 200}),
+                         {'deb-remote-mirror': {DEBIAN}})
+
+    def test_missing(self):
+        self.assertEqual(self.check({'hello_2.10-4.debian.tar.xz': 250}), {})
+        self.assertEqual(self.check({ORIG: 1000}, source='other'), {})
+
+    def test_no_content_length(self):
+        DeployedFilesHandler.no_length = {'/deb-local-build' + POOL + ORIG}
+        self.repomgr.repo = FakeAptly(['deb-local-build'], [])
+        self.assertEqual(self.check({ORIG: 1000}), {})
+        self.assertEqual(self.check({ORIG: 999}), {'deb-local-build': {ORIG}})
+
+    def test_sizes_cached(self):
+        self.check({ORIG: 1000})
+        self.check({ORIG: 1000})
+        self.assertEqual(DeployedFilesHandler.heads,
+                         {'/deb-local-build' + POOL + ORIG: 1,
+                          '/deb-remote-mirror' + POOL + ORIG: 1})
+
+
+if __name__ == '__main__':
+    unittest.main()